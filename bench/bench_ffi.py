@@ -0,0 +1,92 @@
+r"""
+Compare the call and closure overhead of libffi builds, e.g. the 3.3 and
+3.4 builds of the libffi entry (--option=libffi.version=), to pick the
+version to ship.
+
+Run as python3 bench/bench_ffi.py v33=build\libffi-3.3 v34=build\libffi-3.4.6
+where each directory has ffi.h (or include\ffi.h) and libffi-N.lib with
+its dll, see bench/harness.py. The driver bench/ffi_bench.c is run
+--repeat times, the median ns per call is reported for ffi_call with
+several signatures, calls through a closure trampoline and closure
+preparation, next to a direct call.
+"""
+
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+from harness import compile_driver, find_build, labelled, median, save_results
+
+driver = os.path.join(os.path.dirname(os.path.realpath(__file__)), "ffi_bench.c")
+
+
+def compile_ffi(build, output):
+    """Compile ffi_bench.c against build (a directory, or None for the
+    system library), returns the path of the executable."""
+    includes, library = [], None
+    if build is not None:
+        names = ["libffi-*.lib", "libffi.lib"] if os.name == "nt" else ["libffi.so", "libffi.a"]
+        includes, library = find_build(build, "ffi.h", names)
+        if os.path.isdir(os.path.join(build, "src", "x86")):
+            # ffitarget.h of a source tree
+            includes.append(os.path.join(build, "src", "x86"))
+    return compile_driver(driver, output, includes, library, ["-lffi"], "libffi-dev", "libffi*.dll")
+
+
+def measure(exe, iterations, repeat):
+    runs = [
+        json.loads(subprocess.check_output([exe, str(iterations)]).decode())["ns_per_call"]
+        for _ in range(repeat)
+    ]
+    return {name: median([run[name] for run in runs]) for name in runs[0]}
+
+
+def print_results(results):
+    labels = list(results)
+    base = results[labels[0]]
+    print("{:<14}".format("ns per call") + "".join("{:>16}".format(label[:15]) for label in labels))
+    for name in base:
+        row = "{:<14}".format(name)
+        for label in labels:
+            value = results[label][name]
+            row += "{:>9.2f} {:>5.2f}x".format(value, base[name] / value if value else 0)
+        print(row)
+
+
+if __name__ == "__main__":
+    iterations = 10000000
+    repeat = 5
+    output = None
+    builds = []
+    for arg in sys.argv[1:]:
+        if arg.startswith("--iterations="):
+            iterations = int(arg[13:])
+        elif arg.startswith("--repeat="):
+            repeat = int(arg[9:])
+        elif arg.startswith("--output="):
+            output = arg[9:]
+        elif arg.startswith("-"):
+            raise ValueError("Unknown parameter: " + arg)
+        else:
+            label, path = labelled(arg)
+            builds.append((label, os.path.abspath(path)))
+    if not builds:
+        if os.name == "nt":
+            raise RuntimeError("Pass the directories of the libffi builds to compare")
+        builds.append(("system", None))
+
+    work = tempfile.mkdtemp(prefix="bench_ffi_")
+    results = {}
+    try:
+        for i, (label, build) in enumerate(builds):
+            # a directory per build, the dlls of all have the same name
+            os.mkdir(os.path.join(work, str(i)))
+            exe = compile_ffi(build, os.path.join(work, str(i), "ffi_bench"))
+            results[label] = measure(exe, iterations, repeat)
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+    print_results(results)
+    save_results(output, results)
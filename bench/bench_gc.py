@@ -0,0 +1,93 @@
+r"""
+Allocation throughput and pause times of Boehm GC builds, e.g. gc-7.1 of
+the boehm entry against bdwgc (--bdwgc) with parallel marking.
+
+Run as python3 bench/bench_gc.py old=path\to\boehm new=build\gc-8.2.8
+where each directory has gc.h (or include\gc.h) and the import library,
+see bench/harness.py. The driver bench/gc_bench.c is run with 1, 2, 4 and
+8 allocating threads, once with a single marker thread (GC_MARKERS=1) and
+once with the default, which is one marker per core when parallel marking
+is enabled.
+"""
+
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+from harness import compile_driver, find_build, labelled, save_results
+
+driver = os.path.join(os.path.dirname(os.path.realpath(__file__)), "gc_bench.c")
+
+
+def compile_gc(build, output):
+    """Compile gc_bench.c against build (a directory, or None for the
+    system library), returns the path of the executable."""
+    includes, library = [], None
+    if build is not None:
+        names = ["gc.lib", "gc64_dll.lib", "gc*.lib"] if os.name == "nt" else ["libgc.so", "libgc.a", "libgc*"]
+        includes, library = find_build(build, "gc.h", names)
+    return compile_driver(driver, output, includes, library, ["-lgc", "-lpthread"], "libgc-dev")
+
+
+def measure(exe, threads, allocs, markers):
+    env = dict(os.environ)
+    env.pop("GC_MARKERS", None)
+    if markers is not None:
+        env["GC_MARKERS"] = str(markers)
+    out = subprocess.check_output([exe, str(threads), str(allocs // threads)], env=env)
+    return json.loads(out.decode())
+
+
+def print_results(results):
+    print("{:<12}{:>8}{:>9}{:>14}{:>7}{:>11}{:>11}{:>11}".format(
+        "build", "threads", "markers", "allocs/s", "GCs", "pause ms", "max ms", "p50 ms"
+    ))
+    for label, runs in results.items():
+        for run in runs:
+            print("{:<12}{:>8}{:>9}{:>14.0f}{:>7}{:>11.1f}{:>11.2f}{:>11.2f}".format(
+                label[:11], run["threads"], run["markers"], run["allocs_per_s"], run["collections"],
+                run["pause_total_ms"], run["pause_max_ms"], run["pause_p50_ms"],
+            ))
+    for label, runs in results.items():
+        print("%s: gc %s" % (label, runs[0]["gc_version"]))
+
+
+if __name__ == "__main__":
+    allocs = 4000000
+    thread_counts = [1, 2, 4, 8]
+    output = None
+    builds = []
+    for arg in sys.argv[1:]:
+        if arg.startswith("--allocs="):
+            allocs = int(arg[9:])
+        elif arg.startswith("--threads="):
+            thread_counts = [int(n) for n in arg[10:].split(",")]
+        elif arg.startswith("--output="):
+            output = arg[9:]
+        elif arg.startswith("-"):
+            raise ValueError("Unknown parameter: " + arg)
+        else:
+            label, path = labelled(arg)
+            builds.append((label, os.path.abspath(path)))
+    if not builds:
+        if os.name == "nt":
+            raise RuntimeError("Pass the directories of the gc builds to compare")
+        builds.append(("system", None))
+
+    work = tempfile.mkdtemp(prefix="bench_gc_")
+    results = {}
+    try:
+        for i, (label, build) in enumerate(builds):
+            exe = compile_gc(build, os.path.join(work, "gc_bench%d" % i))
+            runs = results[label] = []
+            # the total work is the same for every thread count
+            for threads in thread_counts:
+                for markers in (1, None):
+                    runs.append(measure(exe, threads, allocs, markers))
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+    print_results(results)
+    save_results(output, results)
@@ -0,0 +1,306 @@
+r"""
+Compare OpenSSL builds in the style of openssl speed: symmetric cipher and
+digest throughput through the EVP interface, and full TLS handshakes per
+second between a client and a server in memory.
+
+Run as python3 bench/bench_openssl.py prebuilt=bin new=build\openssl-3.5.4
+where each directory holds a libcrypto and a libssl dll (or .so), see
+bench/harness.py. The prebuilt 1.1.1 dlls have no openssl.exe, so
+everything goes through ctypes.
+
+The handshake certificates are made with the openssl command (PATH, or
+--openssl=EXE, e.g. the apps\openssl.exe of a source build); without one
+only the cipher throughput is measured.
+"""
+
+import ctypes
+import glob
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from harness import child_done, labelled, measure_in_children, save_results, system_library
+
+ciphers = ["aes-128-gcm", "aes-256-gcm", "chacha20-poly1305", "aes-128-cbc"]
+digests = ["sha256", "sha512"]
+block_sizes = [1024, 8192, 16384]
+
+# (name, protocol version, certificate)
+handshakes = [
+    ("tls1.2/rsa2048", 0x0303, "rsa2048"),
+    ("tls1.3/rsa2048", 0x0304, "rsa2048"),
+    ("tls1.3/p256", 0x0304, "p256"),
+]
+
+SSL_FILETYPE_PEM = 1
+SSL_ERROR_WANT_READ = 2
+SSL_ERROR_WANT_WRITE = 3
+SSL_CTRL_SET_SESS_CACHE_MODE = 44
+SSL_CTRL_SET_MIN_PROTO_VERSION = 123
+SSL_CTRL_SET_MAX_PROTO_VERSION = 124
+
+
+def find_libraries(directory):
+    """Return the paths of libcrypto and libssl in directory."""
+    found = []
+    for name in ("libcrypto", "libssl"):
+        candidates = sorted(glob.glob(os.path.join(directory, name + "*.dll")))
+        candidates += sorted(glob.glob(os.path.join(directory, name + ".so*")))
+        if not candidates:
+            raise RuntimeError("No %s found in %s" % (name, directory))
+        found.append(candidates[0])
+    return found
+
+
+class OpenSSL(object):
+    """The EVP and SSL functions the benchmarks need, present in 1.1.1 and 3.x."""
+
+    def __init__(self, crypto_path, ssl_path):
+        if hasattr(os, "add_dll_directory"):
+            # libssl loads libcrypto from its own directory
+            os.add_dll_directory(os.path.dirname(os.path.abspath(crypto_path)))
+        crypto = self.crypto = ctypes.CDLL(crypto_path)
+        ssl = self.ssl = ctypes.CDLL(ssl_path)
+        p = ctypes.c_void_p
+        c_int_p = ctypes.POINTER(ctypes.c_int)
+        crypto.OpenSSL_version.argtypes = [ctypes.c_int]
+        crypto.OpenSSL_version.restype = ctypes.c_char_p
+        for name, restype, argtypes in [
+            ("EVP_get_cipherbyname", p, [ctypes.c_char_p]),
+            ("EVP_get_digestbyname", p, [ctypes.c_char_p]),
+            ("EVP_CIPHER_CTX_new", p, []),
+            ("EVP_CIPHER_CTX_free", None, [p]),
+            ("EVP_EncryptInit_ex", ctypes.c_int, [p, p, p, ctypes.c_char_p, ctypes.c_char_p]),
+            ("EVP_EncryptUpdate", ctypes.c_int, [p, ctypes.c_char_p, c_int_p, ctypes.c_char_p, ctypes.c_int]),
+            ("EVP_MD_CTX_new", p, []),
+            ("EVP_MD_CTX_free", None, [p]),
+            ("EVP_DigestInit_ex", ctypes.c_int, [p, p, p]),
+            ("EVP_DigestUpdate", ctypes.c_int, [p, ctypes.c_char_p, ctypes.c_size_t]),
+            ("EVP_DigestFinal_ex", ctypes.c_int, [p, ctypes.c_char_p, p]),
+            ("BIO_new_bio_pair", ctypes.c_int, [
+                ctypes.POINTER(p), ctypes.c_size_t, ctypes.POINTER(p), ctypes.c_size_t
+            ]),
+        ]:
+            func = getattr(crypto, name)
+            func.restype = restype
+            func.argtypes = argtypes
+        for name, restype, argtypes in [
+            ("TLS_method", p, []),
+            ("SSL_CTX_new", p, [p]),
+            ("SSL_CTX_free", None, [p]),
+            ("SSL_CTX_ctrl", ctypes.c_long, [p, ctypes.c_int, ctypes.c_long, p]),
+            ("SSL_CTX_use_certificate_file", ctypes.c_int, [p, ctypes.c_char_p, ctypes.c_int]),
+            ("SSL_CTX_use_PrivateKey_file", ctypes.c_int, [p, ctypes.c_char_p, ctypes.c_int]),
+            ("SSL_new", p, [p]),
+            ("SSL_free", None, [p]),
+            ("SSL_set_bio", None, [p, p, p]),
+            ("SSL_set_connect_state", None, [p]),
+            ("SSL_set_accept_state", None, [p]),
+            ("SSL_do_handshake", ctypes.c_int, [p]),
+            ("SSL_get_error", ctypes.c_int, [p, ctypes.c_int]),
+        ]:
+            func = getattr(ssl, name)
+            func.restype = restype
+            func.argtypes = argtypes
+        self.version = crypto.OpenSSL_version(0).decode()
+
+    def cipher(self, name, size, seconds):
+        """Encrypt blocks of size bytes for about seconds, returns bytes/s."""
+        crypto = self.crypto
+        cipher = crypto.EVP_get_cipherbyname(name.encode())
+        if not cipher:
+            return None
+        ctx = crypto.EVP_CIPHER_CTX_new()
+        crypto.EVP_EncryptInit_ex(ctx, cipher, None, b"k" * 32, b"i" * 16)
+        data = b"\0" * size
+        out = ctypes.create_string_buffer(size + 64)
+        outl = ctypes.c_int()
+        done = 0
+        start = time.perf_counter()
+        while True:
+            for _ in range(64):
+                if crypto.EVP_EncryptUpdate(ctx, out, ctypes.byref(outl), data, size) != 1:
+                    raise RuntimeError("EVP_EncryptUpdate failed for " + name)
+            done += 64 * size
+            elapsed = time.perf_counter() - start
+            if elapsed >= seconds:
+                break
+        crypto.EVP_CIPHER_CTX_free(ctx)
+        return done / elapsed
+
+    def digest(self, name, size, seconds):
+        """Hash messages of size bytes for about seconds, returns bytes/s."""
+        crypto = self.crypto
+        md = crypto.EVP_get_digestbyname(name.encode())
+        if not md:
+            return None
+        ctx = crypto.EVP_MD_CTX_new()
+        data = b"\0" * size
+        out = ctypes.create_string_buffer(64)
+        done = 0
+        start = time.perf_counter()
+        while True:
+            for _ in range(64):
+                crypto.EVP_DigestInit_ex(ctx, md, None)
+                crypto.EVP_DigestUpdate(ctx, data, size)
+                crypto.EVP_DigestFinal_ex(ctx, out, None)
+            done += 64 * size
+            elapsed = time.perf_counter() - start
+            if elapsed >= seconds:
+                break
+        crypto.EVP_MD_CTX_free(ctx)
+        return done / elapsed
+
+    def context(self, version, cert=None, key=None):
+        ssl = self.ssl
+        ctx = ssl.SSL_CTX_new(ssl.TLS_method())
+        ssl.SSL_CTX_ctrl(ctx, SSL_CTRL_SET_MIN_PROTO_VERSION, version, None)
+        ssl.SSL_CTX_ctrl(ctx, SSL_CTRL_SET_MAX_PROTO_VERSION, version, None)
+        # every handshake is a full one
+        ssl.SSL_CTX_ctrl(ctx, SSL_CTRL_SET_SESS_CACHE_MODE, 0, None)
+        if cert is not None:
+            if ssl.SSL_CTX_use_certificate_file(ctx, cert.encode(), SSL_FILETYPE_PEM) != 1 or \
+                    ssl.SSL_CTX_use_PrivateKey_file(ctx, key.encode(), SSL_FILETYPE_PEM) != 1:
+                raise RuntimeError("Cannot load " + cert)
+        return ctx
+
+    def handshake(self, version, cert, key, seconds):
+        """Run client/server handshakes over a BIO pair for about seconds,
+        returns handshakes/s."""
+        ssl = self.ssl
+        server_ctx = self.context(version, cert, key)
+        client_ctx = self.context(version)
+        done = 0
+        start = time.perf_counter()
+        while True:
+            client = ssl.SSL_new(client_ctx)
+            server = ssl.SSL_new(server_ctx)
+            client_bio = ctypes.c_void_p()
+            server_bio = ctypes.c_void_p()
+            self.crypto.BIO_new_bio_pair(ctypes.byref(client_bio), 0, ctypes.byref(server_bio), 0)
+            ssl.SSL_set_bio(client, client_bio, client_bio)
+            ssl.SSL_set_bio(server, server_bio, server_bio)
+            ssl.SSL_set_connect_state(client)
+            ssl.SSL_set_accept_state(server)
+            finished = set()
+            while len(finished) < 2:
+                for conn in (client, server):
+                    if conn in finished:
+                        continue
+                    rc = ssl.SSL_do_handshake(conn)
+                    if rc == 1:
+                        finished.add(conn)
+                    elif ssl.SSL_get_error(conn, rc) not in (SSL_ERROR_WANT_READ, SSL_ERROR_WANT_WRITE):
+                        raise RuntimeError("Handshake failed")
+            ssl.SSL_free(client)
+            ssl.SSL_free(server)
+            done += 1
+            elapsed = time.perf_counter() - start
+            if elapsed >= seconds:
+                break
+        ssl.SSL_CTX_free(client_ctx)
+        ssl.SSL_CTX_free(server_ctx)
+        return done / elapsed
+
+
+def make_certificates(openssl, directory):
+    """Create self-signed certificates for the handshakes with the openssl
+    command, returns {name: (cert, key)}."""
+    keys = {
+        "rsa2048": ["-newkey", "rsa:2048"],
+        "p256": ["-newkey", "ec", "-pkeyopt", "ec_paramgen_curve:P-256"],
+    }
+    certificates = {}
+    for name, newkey in keys.items():
+        cert = os.path.join(directory, name + ".crt")
+        key = os.path.join(directory, name + ".key")
+        subprocess.check_call(
+            [openssl, "req", "-x509", "-nodes", "-days", "1", "-subj", "/CN=localhost",
+             "-keyout", key, "-out", cert] + newkey,
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+        certificates[name] = (cert, key)
+    return certificates
+
+
+def measure(crypto_path, ssl_path, certificates, seconds):
+    lib = OpenSSL(crypto_path, ssl_path)
+    results = {}
+    for name in ciphers:
+        for size in block_sizes:
+            results["%s/%d" % (name, size)] = lib.cipher(name, size, seconds)
+    for name in digests:
+        for size in block_sizes:
+            results["%s/%d" % (name, size)] = lib.digest(name, size, seconds)
+    for name, version, cert in handshakes:
+        if cert in certificates:
+            results[name] = lib.handshake(version, *certificates[cert], seconds=seconds)
+    return {"crypto": crypto_path, "ssl": ssl_path, "version": lib.version, "results": results}
+
+
+def print_results(results):
+    labels = list(results)
+    base = results[labels[0]]["results"]
+    print("{:<32}".format("") + "".join("{:>22}".format(label[:21]) for label in labels))
+    for name in base:
+        unit = "handshakes/s" if name.startswith("tls") else "MB/s"
+        row = "{:<32}".format("%s %s" % (name, unit))
+        for label in labels:
+            value = results[label]["results"].get(name)
+            if value is None or not base[name]:
+                row += "{:>22}".format("-")
+                continue
+            shown = value if name.startswith("tls") else value / 1e6
+            row += "{:>14.1f} {:>6.2f}x".format(shown, value / base[name])
+        print(row)
+    for label in labels:
+        print("%s: %s, %s" % (label, results[label]["version"], results[label]["crypto"]))
+
+
+if __name__ == "__main__":
+    seconds = 1.0
+    output = None
+    openssl = shutil.which("openssl")
+    child = None
+    certificates = {}
+    builds = []
+    for arg in sys.argv[1:]:
+        if arg.startswith("--seconds="):
+            seconds = float(arg[10:])
+        elif arg.startswith("--output="):
+            output = arg[9:]
+        elif arg.startswith("--openssl="):
+            openssl = arg[10:]
+        elif arg.startswith("--child="):
+            child = json.loads(arg[8:])
+        elif arg.startswith("-"):
+            raise ValueError("Unknown parameter: " + arg)
+        else:
+            label, directory = labelled(arg)
+            builds.append((label, find_libraries(os.path.abspath(directory))))
+
+    if child is not None:
+        child_done(measure(child["crypto"], child["ssl"], child["certificates"], seconds))
+
+    if not builds:
+        builds.append(("system", [system_library("crypto"), system_library("ssl")]))
+
+    work = tempfile.mkdtemp(prefix="bench_openssl_")
+    try:
+        if openssl is not None:
+            certificates = make_certificates(openssl, work)
+        else:
+            print("No openssl command found, skipping the handshakes")
+        children = [
+            (label, json.dumps({"crypto": crypto, "ssl": ssl, "certificates": certificates}))
+            for label, (crypto, ssl) in builds
+        ]
+        results = measure_in_children(__file__, children, ["--seconds=%s" % seconds])
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+    print_results(results)
+    save_results(output, results)
@@ -0,0 +1,445 @@
+r"""
+Benchmark build_prepare.py against synthetic archives served from a local
+HTTP server, through its command line like a build agent runs it and its
+Python-side stages in process.
+
+Run as python3 bench/bench_prepare.py --output=results.json
+and compare two runs (e.g. before and after a change) with
+python3 bench/bench_prepare.py --compare=old.json new.json
+
+The command line stages are one build_prepare.py invocation each, timed
+from the outside, so the times include the interpreter start-up (see the
+"check" stage). The in-process stages call the functions of an imported
+build_prepare on the archives fetched by the first stage. All stages run
+cold (empty archive cache and build tree) and warm (archives already
+cached, the tree left by the previous run):
+
+    fetch         --prefetch, downloading the archives and packing a bundle
+    mirror        --prefetch --mirror=BUNDLE, copying the archives from it
+    plan          --plan=json, fingerprinting the archives
+    extract       extract_dep() of every archive
+    patch         apply_patches() of every patched file
+    get_footer    get_footer() of every dependency, 1000 times
+    write_script  build_dep(), writing the build scripts
+    rmtree        removing the extracted trees, as prepare_dep() does first
+    prepare       a full run with --timings, which needs Visual Studio; its
+                  download and extract times are read from build\timings
+    check         --check
+
+Throughput is reported in MB/s of archive or extracted data and files/s.
+Peak memory is measured with tracemalloc in a separate pass, so it does
+not skew the timings; command line stages are traced in the child.
+"""
+
+import http.server
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+import tracemalloc
+import zipfile
+
+from harness import median, save_results
+
+winbuild_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+script = os.path.join(winbuild_dir, "build_prepare.py")
+sys.path.insert(0, winbuild_dir)
+import build_prepare  # noqa: E402
+
+# runs a script with tracemalloc, writing the peak to the file given first
+traced = """
+import runpy, sys, tracemalloc
+output = sys.argv.pop(1)
+del sys.argv[0]
+tracemalloc.start()
+try:
+    runpy.run_path(sys.argv[0], run_name="__main__")
+finally:
+    with open(output, "w") as f:
+        f.write(str(tracemalloc.get_traced_memory()[1]))
+"""
+
+
+class RangeHandler(http.server.BaseHTTPRequestHandler):
+    """Serves the files in root with keep-alive and single range support."""
+
+    protocol_version = "HTTP/1.1"
+    root = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        path = os.path.join(self.root, self.path.lstrip("/").split("?")[0])
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return
+        with open(path, "rb") as f:
+            data = f.read()
+        start = 0
+        if self.headers.get("Range", "").startswith("bytes="):
+            start = int(self.headers["Range"][6:].split("-")[0])
+            self.send_response(206)
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", str(len(data) - start))
+        self.end_headers()
+        self.wfile.write(data[start:])
+
+
+class ThreadedServer(http.server.HTTPServer):
+    def process_request(self, request, client_address):
+        threading.Thread(
+            target=self.process_request_thread, args=(request, client_address), daemon=True
+        ).start()
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+
+def serve(directory):
+    """Start a local HTTP server for directory, returns (server, base url)."""
+    handler = type("Handler", (RangeHandler,), {"root": directory})
+    server = ThreadedServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, "http://127.0.0.1:%d/" % server.server_port
+
+
+def make_tree(rng, files, size):
+    """Return a list of (name, data) with text-like, compressible content."""
+    words = [b"proc", b"set", b"return", b"namespace", b"variable", b"if", b"else",
+             b"foreach", b"expr", b"string", b"list", b"dict", b"incr", b"::tcl"]
+    tree = []
+    for i in range(files):
+        out = io.BytesIO()
+        while out.tell() < size:
+            out.write(b" ".join(rng.choice(words) for _ in range(12)) + b"\n")
+        tree.append(("dir%02d/file%05d.tcl" % (i % 37, i), out.getvalue()[:size]))
+    return tree
+
+
+def make_archives(directory, files, size, base_url):
+    """Write one zip, tar.gz and tar.xz archive each with the same tree.
+    Returns the deps.json contents describing them, the uncompressed size
+    and the number of files of the tree."""
+    rng = random.Random(42)
+    tree = make_tree(rng, files, size)
+    table = {}
+    for name, ext in (("synth-zip", ".zip"), ("synth-tgz", ".tar.gz"), ("synth-txz", ".tar.xz")):
+        filename = name + ext
+        top = name + "-1.0"
+        path = os.path.join(directory, filename)
+        if ext == ".zip":
+            with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as zf:
+                for member, data in tree:
+                    zf.writestr(top + "/" + member, data)
+        else:
+            with tarfile.open(path, "w:" + ext[5:]) as tf:
+                for member, data in tree:
+                    info = tarfile.TarInfo(top + "/" + member)
+                    info.size = len(data)
+                    tf.addfile(info, io.BytesIO(data))
+        table[name] = {
+            "url": base_url + filename,
+            "filename": filename,
+            "dir": top,
+            "requires": [],
+            "patch": {
+                "dir00/file00000.tcl": {"namespace": "namespace", "variable": "variable"},
+            },
+            "build": [{"nmake": "makefile.vc", "target": "all"}],
+            "headers": [r"dir01\*.tcl"],
+            "libs": [r"dir02\*.tcl"],
+            "trees": [[r"dir03", r"{lib_dir}\dir03"]],
+        }
+    data = {"version": 1, "deps": table}
+    return data, sum(len(data) for member, data in tree), len(tree)
+
+
+def run(work, args, ok=(0,), trace=False):
+    """Run build_prepare.py on the synthetic deps.json in work, returns
+    (wall clock seconds, tracemalloc peak bytes or None)."""
+    peak_file = os.path.join(work, "peak.txt")
+    command = [sys.executable, "-c", traced, peak_file] if trace else [sys.executable]
+    command += [
+        script,
+        "--deps=" + os.path.join(work, "deps.json"),
+        "--depends=" + os.path.join(work, "cache"),
+        "--dir=" + os.path.join(work, "build"),
+    ] + args
+    start = time.perf_counter()
+    process = subprocess.run(
+        command, cwd=work, stdout=subprocess.PIPE, stderr=subprocess.STDOUT
+    )
+    elapsed = time.perf_counter() - start
+    if process.returncode not in ok:
+        sys.stdout.write(process.stdout.decode("utf-8", "replace"))
+        raise RuntimeError("%s failed with exit code %d" % (" ".join(args), process.returncode))
+    peak = None
+    if trace:
+        with open(peak_file) as f:
+            peak = int(f.read())
+    return elapsed, peak
+
+
+def configure(work):
+    """Point the build_prepare globals at the work directory."""
+    bp = build_prepare
+    bp.depends_dir = os.path.join(work, "cache")
+    bp.build_dir = os.path.join(work, "build")
+    bp.verbose = False
+    bp.disabled = []
+    bp.load_deps(os.path.join(work, "deps.json"))
+    bp.prefs = {
+        "architecture": "x64",
+        **bp.architectures["x64"],
+        "winbuild_dir": work,
+        "build_dir": bp.build_dir,
+        "inc_dir": os.path.join(work, "include"),
+        "lib_dir": os.path.join(work, "lib"),
+        "bin_dir": os.path.join(work, "bin"),
+        "aux_dir": os.path.join(work, "auxiliary"),
+        "tcltk_dir": os.path.join(work, "tcltk"),
+        "python": sys.executable,
+        "vs_dir": "vs",
+        "nmake": "nmake.exe",
+        "header": ["@echo on"],
+    }
+    os.makedirs(bp.build_dir, exist_ok=True)
+
+
+def quiet(func):
+    """Call func with stdout discarded."""
+    stdout = sys.stdout
+    sys.stdout = io.StringIO()
+    try:
+        return func()
+    finally:
+        sys.stdout = stdout
+
+
+def in_process_stages():
+    """The in-process stages in the order they run, as (name, function)
+    pairs."""
+    bp = build_prepare
+
+    def extract():
+        for dep in bp.deps.values():
+            bp.extract_dep(dep["url"], dep["filename"], None, dep.get("sha256"))
+
+    def patch():
+        for dep in bp.deps.values():
+            for patch_file, patch_list in dep["patch"].items():
+                bp.apply_patches(os.path.join(bp.build_dir, dep["dir"], patch_file), patch_list)
+
+    def footer():
+        for i in range(1000):
+            for dep in bp.deps.values():
+                bp.get_footer(dep)
+
+    def scripts():
+        for name in bp.deps:
+            bp.build_dep(name)
+
+    def rmtree():
+        for dep in bp.deps.values():
+            shutil.rmtree(os.path.join(bp.build_dir, dep["dir"]), onerror=bp.rmtree_onerror)
+
+    return [
+        ("extract", extract),
+        ("patch", patch),
+        ("get_footer", footer),
+        ("write_script", scripts),
+        ("rmtree", rmtree),
+    ]
+
+
+def run_in_process(func, trace):
+    """Call func quietly, returns (seconds, tracemalloc peak bytes or None)."""
+    if trace:
+        tracemalloc.start()
+    start = time.perf_counter()
+    quiet(func)
+    elapsed = time.perf_counter() - start
+    peak = None
+    if trace:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return elapsed, peak
+
+
+def logged(work):
+    """Sum the seconds of the build\\timings\\prepare.jsonl records by stage."""
+    totals = {}
+    path = os.path.join(work, "build", "timings", "prepare.jsonl")
+    if os.path.exists(path):
+        with open(path, "r") as f:
+            for line in f:
+                record = json.loads(line)
+                totals[record["stage"]] = totals.get(record["stage"], 0.0) + record["seconds"]
+    return totals
+
+
+def run_pass(work, cold, fetch_jobs, trace):
+    """Run all stages in order, returns {stage: (seconds, peak bytes)}."""
+    bundle = os.path.join(work, "bundle.tar")
+    jobs = "--fetch-jobs=%d" % fetch_jobs
+
+    def reset(*dirs):
+        for name in dirs:
+            if cold and os.path.isdir(os.path.join(work, name)):
+                shutil.rmtree(os.path.join(work, name))
+
+    results = {}
+    reset("cache", "build")
+    results["fetch"] = run(work, ["--prefetch=" + bundle, jobs], trace=trace)
+    reset("cache")
+    results["mirror"] = run(
+        work, ["--prefetch=" + os.path.join(work, "copy.tar"), "--mirror=" + bundle, jobs], trace=trace
+    )
+    results["plan"] = run(work, ["--plan=json"], trace=trace)
+    configure(work)
+    for name, func in in_process_stages():
+        results[name] = run_in_process(func, trace)
+    build_prepare.http_pool.close()
+    if os.name == "nt":
+        reset("cache", "build")
+        if os.path.isdir(os.path.join(work, "build", "timings")):
+            shutil.rmtree(os.path.join(work, "build", "timings"))
+        results["prepare"] = run(work, ["--timings", jobs], trace=trace)
+        for stage, seconds in logged(work).items():
+            results["prepare:" + stage] = (seconds, None)
+    # exits with 1 while anything needs to be built
+    results["check"] = run(work, ["--check"], ok=(0, 1), trace=trace)
+    return results
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=winbuild_dir,
+            stderr=subprocess.DEVNULL,
+        ).decode().strip()
+    except (subprocess.CalledProcessError, OSError):
+        return None
+
+
+def benchmark(files, size, repeat, fetch_jobs):
+    work = tempfile.mkdtemp(prefix="bench_prepare_")
+    served = os.path.join(work, "served")
+    os.makedirs(served)
+    try:
+        server, base_url = serve(served)
+        data, extracted, members = make_archives(served, files, size, base_url)
+        with open(os.path.join(work, "deps.json"), "w") as f:
+            json.dump(data, f, indent=4)
+        table = data["deps"]
+        archived = sum(os.path.getsize(os.path.join(served, dep["filename"])) for dep in table.values())
+        results = {
+            "revision": git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "files": members * len(table),
+            "archive_bytes": archived,
+            "extracted_bytes": extracted * len(table),
+            "stages": {},
+        }
+        if os.name != "nt":
+            print("Skipping the prepare stage, which needs Visual Studio")
+        for cache in ("cold", "warm"):
+            runs = [run_pass(work, cache == "cold", fetch_jobs, False) for _ in range(repeat)]
+            memory = run_pass(work, cache == "cold", fetch_jobs, True)
+            for stage in runs[0]:
+                seconds = median([run[stage][0] for run in runs])
+                entry = {"seconds": seconds, "peak_memory": memory[stage][1]}
+                if stage in ("fetch", "mirror", "plan", "prepare:download"):
+                    entry["mb_per_s"] = archived / seconds / 1e6
+                elif stage in ("extract", "rmtree", "prepare:extract"):
+                    entry["mb_per_s"] = extracted * len(table) / seconds / 1e6
+                    entry["files_per_s"] = members * len(table) / seconds
+                results["stages"]["%s/%s" % (stage, cache)] = entry
+        server.shutdown()
+        return results
+    finally:
+        build_prepare.http_pool.close()
+        shutil.rmtree(work, ignore_errors=True)
+
+
+def print_results(results):
+    print("revision %s, python %s, %d files, %.1f MB archived, %.1f MB extracted" % (
+        results["revision"], results["python"], results["files"],
+        results["archive_bytes"] / 1e6, results["extracted_bytes"] / 1e6,
+    ))
+    print("{:<24} {:>9} {:>9} {:>10} {:>10}".format("stage", "seconds", "MB/s", "files/s", "peak MB"))
+    for stage, entry in results["stages"].items():
+        print("{:<24} {:9.3f} {:>9} {:>10} {:>10}".format(
+            stage,
+            entry["seconds"],
+            "%.1f" % entry["mb_per_s"] if "mb_per_s" in entry else "-",
+            "%.0f" % entry["files_per_s"] if "files_per_s" in entry else "-",
+            "%.1f" % (entry["peak_memory"] / 1e6) if entry["peak_memory"] is not None else "-",
+        ))
+
+
+def compare(old, new):
+    print("{:<24} {:>9} {:>9} {:>8}".format("stage", "old", "new", "speedup"))
+    for stage, entry in new["stages"].items():
+        if stage not in old["stages"]:
+            continue
+        before = old["stages"][stage]["seconds"]
+        print("{:<24} {:9.3f} {:9.3f} {:7.2f}x".format(
+            stage, before, entry["seconds"], before / entry["seconds"] if entry["seconds"] else 0
+        ))
+
+
+if __name__ == "__main__":
+    files = 2000
+    size = 8192
+    repeat = 3
+    fetch_jobs = 4
+    output = None
+    compare_with = None
+    args = []
+    for arg in sys.argv[1:]:
+        if arg.startswith("--files="):
+            files = int(arg[8:])
+        elif arg.startswith("--size="):
+            size = int(arg[7:])
+        elif arg.startswith("--repeat="):
+            repeat = int(arg[9:])
+        elif arg.startswith("--fetch-jobs="):
+            fetch_jobs = int(arg[13:])
+        elif arg.startswith("--output="):
+            output = arg[9:]
+        elif arg.startswith("--compare="):
+            compare_with = arg[10:]
+        elif arg.startswith("-"):
+            raise ValueError("Unknown parameter: " + arg)
+        else:
+            args.append(arg)
+
+    if compare_with is not None:
+        with open(compare_with) as f:
+            old = json.load(f)
+        with open(args[0]) as f:
+            new = json.load(f)
+        compare(old, new)
+        sys.exit(0)
+
+    results = benchmark(files, size, repeat, fetch_jobs)
+    print_results(results)
+    save_results(output, results)
@@ -0,0 +1,185 @@
+r"""
+Compare builds of the sqlite3 library, e.g. the variants of sqlite3.nmake,
+by timing the same workloads through ctypes.
+
+Run as python3 bench/bench_sqlite3.py default\sqlite3.dll ltcg\sqlite3.dll
+or label the libraries with python3 bench/bench_sqlite3.py pgo=path\sqlite3.dll
+(see bench/harness.py).
+
+The workloads mirror the _sqlite3 module: prepared inserts and primary key
+lookups, schema queries, an aggregate scan and the pgo training script.
+"""
+
+import ctypes
+import os
+import sys
+import time
+
+from harness import child_done, labelled, measure_in_children, median, save_results, system_library
+
+SQLITE_OK = 0
+SQLITE_ROW = 100
+SQLITE_DONE = 101
+SQLITE_TRANSIENT = ctypes.c_void_p(-1)
+
+train_sql = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), "sqlite3_train.sql")
+
+
+class Library(object):
+    """The few sqlite3 entry points the workloads need."""
+
+    def __init__(self, path):
+        lib = self.lib = ctypes.CDLL(path)
+        p = ctypes.c_void_p
+        lib.sqlite3_libversion.restype = ctypes.c_char_p
+        lib.sqlite3_open.argtypes = [ctypes.c_char_p, ctypes.POINTER(p)]
+        lib.sqlite3_close.argtypes = [p]
+        lib.sqlite3_errmsg.argtypes = [p]
+        lib.sqlite3_errmsg.restype = ctypes.c_char_p
+        lib.sqlite3_exec.argtypes = [p, ctypes.c_char_p, p, p, p]
+        lib.sqlite3_prepare_v2.argtypes = [p, ctypes.c_char_p, ctypes.c_int, ctypes.POINTER(p), p]
+        lib.sqlite3_step.argtypes = [p]
+        lib.sqlite3_reset.argtypes = [p]
+        lib.sqlite3_finalize.argtypes = [p]
+        lib.sqlite3_bind_int64.argtypes = [p, ctypes.c_int, ctypes.c_int64]
+        lib.sqlite3_bind_text.argtypes = [p, ctypes.c_int, ctypes.c_char_p, ctypes.c_int, p]
+        lib.sqlite3_column_int64.argtypes = [p, ctypes.c_int]
+        lib.sqlite3_column_int64.restype = ctypes.c_int64
+        lib.sqlite3_column_text.argtypes = [p, ctypes.c_int]
+        lib.sqlite3_column_text.restype = ctypes.c_char_p
+        self.version = lib.sqlite3_libversion().decode()
+
+    def open(self):
+        db = ctypes.c_void_p()
+        if self.lib.sqlite3_open(b":memory:", ctypes.byref(db)) != SQLITE_OK:
+            raise RuntimeError("sqlite3_open failed")
+        return db
+
+    def check(self, db, rc, expected=SQLITE_OK):
+        if rc != expected:
+            raise RuntimeError(self.lib.sqlite3_errmsg(db).decode())
+
+    def execute(self, db, sql):
+        self.check(db, self.lib.sqlite3_exec(db, sql.encode(), None, None, None))
+
+    def prepare(self, db, sql):
+        stmt = ctypes.c_void_p()
+        self.check(db, self.lib.sqlite3_prepare_v2(db, sql.encode(), -1, ctypes.byref(stmt), None))
+        return stmt
+
+
+def workloads(sqlite, rows):
+    """Return the workloads as (name, function of a connection) pairs, each
+    starting from the table filled by "insert"."""
+    lib = sqlite.lib
+
+    def insert(db):
+        sqlite.execute(db, "BEGIN")
+        stmt = sqlite.prepare(db, "INSERT INTO item (id, name, size) VALUES (?, ?, ?)")
+        for i in range(rows):
+            lib.sqlite3_bind_int64(stmt, 1, i)
+            lib.sqlite3_bind_text(stmt, 2, b"item%d" % i, -1, SQLITE_TRANSIENT)
+            lib.sqlite3_bind_int64(stmt, 3, (i * 7919) % 100000)
+            sqlite.check(db, lib.sqlite3_step(stmt), SQLITE_DONE)
+            lib.sqlite3_reset(stmt)
+        lib.sqlite3_finalize(stmt)
+        sqlite.execute(db, "COMMIT")
+
+    def lookup(db):
+        stmt = sqlite.prepare(db, "SELECT name, size FROM item WHERE id = ?")
+        for i in range(rows):
+            lib.sqlite3_bind_int64(stmt, 1, (i * 31) % rows)
+            sqlite.check(db, lib.sqlite3_step(stmt), SQLITE_ROW)
+            lib.sqlite3_column_text(stmt, 0)
+            lib.sqlite3_reset(stmt)
+        lib.sqlite3_finalize(stmt)
+
+    def schema(db):
+        for i in range(rows // 20):
+            for sql in ("SELECT sql FROM sqlite_master WHERE name = 'item'", "PRAGMA table_info(item)"):
+                stmt = sqlite.prepare(db, sql)
+                while lib.sqlite3_step(stmt) == SQLITE_ROW:
+                    pass
+                lib.sqlite3_finalize(stmt)
+
+    def scan(db):
+        stmt = sqlite.prepare(
+            db, "SELECT size % 100, count(*), sum(size) FROM item "
+            "WHERE name LIKE 'item1%' GROUP BY 1 ORDER BY 3 DESC"
+        )
+        while lib.sqlite3_step(stmt) == SQLITE_ROW:
+            pass
+        lib.sqlite3_finalize(stmt)
+
+    def train(db):
+        with open(train_sql) as f:
+            sqlite.execute(db, f.read())
+
+    return [("insert", insert), ("lookup", lookup), ("schema", schema), ("scan", scan), ("train", train)]
+
+
+def measure(path, rows, repeat):
+    """Time every workload on a fresh database, returns the median seconds."""
+    sqlite = Library(path)
+    times = {}
+    funcs = workloads(sqlite, rows)
+    for _ in range(repeat):
+        for name, func in funcs:
+            db = sqlite.open()
+            sqlite.execute(db, "CREATE TABLE item (id INTEGER PRIMARY KEY, name TEXT, size INTEGER)")
+            if name != "insert":
+                funcs[0][1](db)
+            start = time.perf_counter()
+            func(db)
+            times.setdefault(name, []).append(time.perf_counter() - start)
+            sqlite.lib.sqlite3_close(db)
+    return {
+        "path": path,
+        "version": sqlite.version,
+        "workloads": {name: median(values) for name, values in times.items()},
+    }
+
+
+def print_results(results):
+    labels = list(results)
+    base = results[labels[0]]["workloads"]
+    print("{:<10}".format("workload") + "".join("{:>16}".format(label[:15]) for label in labels))
+    for name in base:
+        row = "{:<10}".format(name)
+        for label in labels:
+            seconds = results[label]["workloads"][name]
+            row += "{:>9.4f} {:>5.2f}x".format(seconds, base[name] / seconds if seconds else 0)
+        print(row)
+    for label in labels:
+        print("%s: sqlite %s, %s" % (label, results[label]["version"], results[label]["path"]))
+
+
+if __name__ == "__main__":
+    rows = 100000
+    repeat = 5
+    output = None
+    child = None
+    libraries = []
+    for arg in sys.argv[1:]:
+        if arg.startswith("--rows="):
+            rows = int(arg[7:])
+        elif arg.startswith("--repeat="):
+            repeat = int(arg[9:])
+        elif arg.startswith("--output="):
+            output = arg[9:]
+        elif arg.startswith("--child="):
+            child = arg[8:]
+        elif arg.startswith("-"):
+            raise ValueError("Unknown parameter: " + arg)
+        else:
+            libraries.append(labelled(arg))
+
+    if child is not None:
+        child_done(measure(child, rows, repeat))
+
+    if not libraries:
+        libraries.append(("system", system_library("sqlite3")))
+
+    results = measure_in_children(__file__, libraries, ["--rows=%d" % rows, "--repeat=%d" % repeat])
+    print_results(results)
+    save_results(output, results)
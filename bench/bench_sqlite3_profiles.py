@@ -0,0 +1,217 @@
+r"""
+Measure insert and query throughput of the sqlite profiles of
+build_prepare.py (sqlite_profiles), to back the choice of the shipped one.
+
+Run as python3 bench/bench_sqlite3_profiles.py compat=a\sqlite3.dll throughput=b\sqlite3.dll
+with dlls built with --option=sqlite3.profile=..., or on Linux as
+python3 bench/bench_sqlite3_profiles.py --amalgamation=sqlite-amalgamation-3400100
+which compiles sqlite3.c once per profile with the flags build_prepare.py
+generates. Without either, every profile is run against the system library
+with the options that have a runtime equivalent (sqlite3_config, pragmas)
+applied instead, the others are listed as not emulated.
+
+The database is a file in WAL mode: single row transactions, where the
+synchronous setting dominates, batched inserts, point lookups and range
+scans, reported in rows per second.
+"""
+
+import ctypes
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+import build_prepare  # noqa: E402
+from bench_sqlite3 import SQLITE_DONE, SQLITE_ROW, SQLITE_TRANSIENT, Library  # noqa: E402
+from harness import child_done, measure_in_children, save_results, system_library  # noqa: E402
+
+SQLITE_CONFIG_SINGLETHREAD = 1
+SQLITE_CONFIG_MULTITHREAD = 2
+SQLITE_CONFIG_SERIALIZED = 3
+SQLITE_CONFIG_MEMSTATUS = 9
+
+
+def runtime_settings(defines):
+    """Split the defines of a profile into the sqlite3_config calls and
+    pragmas with the same effect, and those without a runtime equivalent."""
+    config = []
+    pragmas = []
+    missing = []
+    for define in defines:
+        name, _, value = define.partition("=")
+        if name.startswith("SQLITE_ENABLE_"):
+            # features, the system library has them or not
+            continue
+        if name == "SQLITE_DEFAULT_MEMSTATUS":
+            config.append((SQLITE_CONFIG_MEMSTATUS, int(value)))
+        elif name == "SQLITE_THREADSAFE":
+            mode = [SQLITE_CONFIG_SINGLETHREAD, SQLITE_CONFIG_SERIALIZED, SQLITE_CONFIG_MULTITHREAD]
+            config.append((mode[int(value)],))
+        elif name == "SQLITE_DEFAULT_CACHE_SIZE":
+            pragmas.append("PRAGMA cache_size = " + value)
+        elif name == "SQLITE_DEFAULT_WAL_SYNCHRONOUS":
+            # the database is in WAL mode
+            pragmas.append("PRAGMA synchronous = " + value)
+        else:
+            missing.append(define)
+    return config, pragmas, missing
+
+
+def run(path, defines, rows):
+    """Run the workloads in this process, returns {workload: rows/s} and
+    the defines which were not emulated."""
+    sqlite = Library(path)
+    lib = sqlite.lib
+    config, pragmas, missing = runtime_settings(defines) if defines is not None else ([], [], [])
+    for args in config:
+        # before anything else initializes the library
+        if lib.sqlite3_config(*[ctypes.c_int(arg) for arg in args]) != 0:
+            missing.append("sqlite3_config%r" % (args,))
+
+    work = tempfile.mkdtemp(prefix="bench_sqlite3_")
+    try:
+        db = ctypes.c_void_p()
+        lib.sqlite3_open(os.path.join(work, "bench.db").encode(), ctypes.byref(db))
+        sqlite.execute(db, "PRAGMA journal_mode = WAL")
+        for pragma in pragmas:
+            sqlite.execute(db, pragma)
+        sqlite.execute(db, "CREATE TABLE item (id INTEGER PRIMARY KEY, name TEXT, size INTEGER)")
+        sqlite.execute(db, "CREATE INDEX item_size ON item(size)")
+        insert = sqlite.prepare(db, "INSERT INTO item (name, size) VALUES (?, ?)")
+
+        def add(i):
+            lib.sqlite3_bind_text(insert, 1, b"item%d" % i, -1, SQLITE_TRANSIENT)
+            lib.sqlite3_bind_int64(insert, 2, (i * 7919) % 100000)
+            sqlite.check(db, lib.sqlite3_step(insert), SQLITE_DONE)
+            lib.sqlite3_reset(insert)
+
+        results = {}
+        count = max(1, rows // 50)
+        start = time.perf_counter()
+        for i in range(count):
+            add(i)
+        results["insert/txn"] = count / (time.perf_counter() - start)
+
+        start = time.perf_counter()
+        sqlite.execute(db, "BEGIN")
+        for i in range(count, count + rows):
+            add(i)
+        sqlite.execute(db, "COMMIT")
+        results["insert/batch"] = rows / (time.perf_counter() - start)
+        lib.sqlite3_finalize(insert)
+        total = count + rows
+
+        stmt = sqlite.prepare(db, "SELECT name, size FROM item WHERE id = ?")
+        start = time.perf_counter()
+        for i in range(rows):
+            lib.sqlite3_bind_int64(stmt, 1, 1 + (i * 31) % total)
+            sqlite.check(db, lib.sqlite3_step(stmt), SQLITE_ROW)
+            lib.sqlite3_column_text(stmt, 0)
+            lib.sqlite3_reset(stmt)
+        results["query/point"] = rows / (time.perf_counter() - start)
+        lib.sqlite3_finalize(stmt)
+
+        stmt = sqlite.prepare(db, "SELECT id, name FROM item WHERE size BETWEEN ? AND ? + 100")
+        fetched = 0
+        start = time.perf_counter()
+        for i in range(rows // 100):
+            low = (i * 7919) % 100000
+            lib.sqlite3_bind_int64(stmt, 1, low)
+            lib.sqlite3_bind_int64(stmt, 2, low)
+            while lib.sqlite3_step(stmt) == SQLITE_ROW:
+                lib.sqlite3_column_text(stmt, 1)
+                fetched += 1
+            lib.sqlite3_reset(stmt)
+        results["query/range"] = fetched / (time.perf_counter() - start)
+        lib.sqlite3_finalize(stmt)
+        lib.sqlite3_close(db)
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+    return {"path": path, "version": sqlite.version, "workloads": results, "not_emulated": missing}
+
+
+def compile_profiles(amalgamation, directory):
+    """Build a shared library of sqlite3.c for every profile with the C
+    compiler (CC, default cc), returns {profile: path}."""
+    libraries = {}
+    for profile in sorted(build_prepare.sqlite_profiles):
+        path = os.path.join(directory, "libsqlite3-%s.so" % profile)
+        command = [os.environ.get("CC", "cc"), "-O2", "-shared", "-fPIC", "-o", path]
+        command += build_prepare.sqlite_flags(profile).split()
+        command += [os.path.join(amalgamation, "sqlite3.c"), "-lpthread", "-ldl", "-lm"]
+        print("Compiling", profile + ":", " ".join(command))
+        subprocess.check_call(command)
+        libraries[profile] = path
+    return libraries
+
+
+def print_results(results):
+    labels = list(results)
+    base = results[labels[0]]["workloads"]
+    print("{:<14}".format("rows/s") + "".join("{:>20}".format(label[:19]) for label in labels))
+    for name in base:
+        row = "{:<14}".format(name)
+        for label in labels:
+            value = results[label]["workloads"][name]
+            row += "{:>12.0f} {:>6.2f}x".format(value, value / base[name] if base[name] else 0)
+        print(row)
+    for label in labels:
+        print("%s: sqlite %s, %s" % (label, results[label]["version"], results[label]["path"]))
+        if results[label]["not_emulated"]:
+            print("    not emulated: " + ", ".join(results[label]["not_emulated"]))
+
+
+if __name__ == "__main__":
+    rows = 100000
+    output = None
+    amalgamation = None
+    child = None
+    emulate = None
+    libraries = {}
+    for arg in sys.argv[1:]:
+        if arg.startswith("--rows="):
+            rows = int(arg[7:])
+        elif arg.startswith("--output="):
+            output = arg[9:]
+        elif arg.startswith("--amalgamation="):
+            amalgamation = os.path.abspath(arg[15:])
+        elif arg.startswith("--child="):
+            child = arg[8:]
+        elif arg.startswith("--emulate="):
+            emulate = arg[10:]
+        elif arg.startswith("-"):
+            raise ValueError("Unknown parameter: " + arg)
+        else:
+            profile, path = arg.split("=", 1)
+            libraries[profile] = os.path.abspath(path)
+
+    if child is not None:
+        defines = build_prepare.sqlite_profiles[emulate] if emulate else None
+        child_done(run(child, defines, rows))
+
+    build = tempfile.mkdtemp(prefix="bench_sqlite3_build_")
+    try:
+        if amalgamation is not None:
+            libraries.update(compile_profiles(amalgamation, build))
+        runs = []
+        if libraries:
+            for profile, path in libraries.items():
+                runs.append((profile, path, None))
+        else:
+            system = system_library("sqlite3")
+            for profile in sorted(build_prepare.sqlite_profiles):
+                runs.append((profile + " (emulated)", system, profile))
+
+        results = {}
+        for label, path, profile in runs:
+            # a fresh process each, sqlite3_config only works before the
+            # library is initialized
+            args = ["--rows=%d" % rows] + (["--emulate=" + profile] if profile is not None else [])
+            results.update(measure_in_children(__file__, [(label, path)], args))
+    finally:
+        shutil.rmtree(build, ignore_errors=True)
+    print_results(results)
+    save_results(output, results)
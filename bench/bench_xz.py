@@ -0,0 +1,209 @@
+r"""
+Single threaded against multithreaded xz compression and decompression
+through ctypes, to size the thread count of packing jobs with the liblzma
+of the lzma entry.
+
+Run as python3 bench/bench_xz.py [--threads=1,2,4] [--size=MB] [path\to\liblzma.dll]
+without a path the system liblzma is used (5.4 or later for the
+multithreaded decoder). The corpus is bin, lib and include of this
+repository, sorted by path and repeated up to --size (default 64 MB). The
+single threaded coders write one block, the multithreaded ones blocks of
+--block-size (default 4 MB), which all decoders are run on, as only those
+can be decoded in parallel.
+"""
+
+import ctypes
+import os
+import sys
+import time
+
+from harness import system_library
+
+LZMA_OK = 0
+LZMA_STREAM_END = 1
+LZMA_FINISH = 3
+LZMA_CHECK_CRC64 = 4
+LZMA_CONCATENATED = 0x08
+UINT64_MAX = 2 ** 64 - 1
+
+root = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+
+class lzma_stream(ctypes.Structure):
+    _fields_ = [
+        ("next_in", ctypes.c_void_p),
+        ("avail_in", ctypes.c_size_t),
+        ("total_in", ctypes.c_uint64),
+        ("next_out", ctypes.c_void_p),
+        ("avail_out", ctypes.c_size_t),
+        ("total_out", ctypes.c_uint64),
+        ("allocator", ctypes.c_void_p),
+        ("internal", ctypes.c_void_p),
+        ("reserved_ptr", ctypes.c_void_p * 4),
+        ("seek_pos", ctypes.c_uint64),
+        ("reserved_int2", ctypes.c_uint64),
+        ("reserved_int3", ctypes.c_size_t * 2),
+        ("reserved_enum", ctypes.c_int * 2),
+    ]
+
+
+class lzma_mt(ctypes.Structure):
+    _fields_ = [
+        ("flags", ctypes.c_uint32),
+        ("threads", ctypes.c_uint32),
+        ("block_size", ctypes.c_uint64),
+        ("timeout", ctypes.c_uint32),
+        ("preset", ctypes.c_uint32),
+        ("filters", ctypes.c_void_p),
+        ("check", ctypes.c_int),
+        ("reserved_enum", ctypes.c_int * 3),
+        ("reserved_int", ctypes.c_uint32 * 4),
+        ("memlimit_threading", ctypes.c_uint64),
+        ("memlimit_stop", ctypes.c_uint64),
+        ("reserved_int7", ctypes.c_uint64 * 2),
+        ("reserved_ptr", ctypes.c_void_p * 4),
+    ]
+
+
+class Library(object):
+    """The liblzma coders, each run on a whole buffer."""
+
+    def __init__(self, path):
+        lib = self.lib = ctypes.CDLL(path)
+        stream_p = ctypes.POINTER(lzma_stream)
+        mt_p = ctypes.POINTER(lzma_mt)
+        lib.lzma_version_string.restype = ctypes.c_char_p
+        lib.lzma_stream_buffer_bound.argtypes = [ctypes.c_size_t]
+        lib.lzma_stream_buffer_bound.restype = ctypes.c_size_t
+        lib.lzma_easy_encoder.argtypes = [stream_p, ctypes.c_uint32, ctypes.c_int]
+        lib.lzma_stream_encoder_mt.argtypes = [stream_p, mt_p]
+        lib.lzma_stream_decoder.argtypes = [stream_p, ctypes.c_uint64, ctypes.c_uint32]
+        lib.lzma_code.argtypes = [stream_p, ctypes.c_int]
+        lib.lzma_end.argtypes = [stream_p]
+        self.version = lib.lzma_version_string().decode()
+        self.mt_decoder = hasattr(lib, "lzma_stream_decoder_mt")
+        if self.mt_decoder:
+            lib.lzma_stream_decoder_mt.argtypes = [stream_p, mt_p]
+
+    def run(self, strm, data, out_size):
+        """Feed all of data to an initialized coder, returns its output."""
+        out = ctypes.create_string_buffer(out_size)
+        strm.next_in = ctypes.cast(ctypes.c_char_p(data), ctypes.c_void_p)
+        strm.avail_in = len(data)
+        strm.next_out = ctypes.cast(out, ctypes.c_void_p)
+        strm.avail_out = out_size
+        try:
+            while True:
+                ret = self.lib.lzma_code(ctypes.byref(strm), LZMA_FINISH)
+                if ret == LZMA_STREAM_END:
+                    break
+                if ret != LZMA_OK or strm.avail_out == 0:
+                    raise RuntimeError("lzma_code failed with %d" % ret)
+        finally:
+            self.lib.lzma_end(ctypes.byref(strm))
+        return out.raw[:strm.total_out]
+
+    def init(self, func, *args):
+        strm = lzma_stream()
+        ret = func(ctypes.byref(strm), *args)
+        if ret != LZMA_OK:
+            raise RuntimeError("%s failed with %d" % (func.__name__, ret))
+        return strm
+
+    def mt_options(self, threads, preset=0, block_size=0):
+        mt = lzma_mt(threads=threads, preset=preset, block_size=block_size, check=LZMA_CHECK_CRC64)
+        mt.flags = LZMA_CONCATENATED
+        mt.memlimit_threading = mt.memlimit_stop = UINT64_MAX
+        return mt
+
+    def compress(self, data, preset, threads, block_size):
+        bound = self.lib.lzma_stream_buffer_bound(len(data))
+        if threads == 0:
+            strm = self.init(self.lib.lzma_easy_encoder, preset, LZMA_CHECK_CRC64)
+        else:
+            mt = self.mt_options(threads, preset, block_size)
+            mt.flags = 0
+            strm = self.init(self.lib.lzma_stream_encoder_mt, ctypes.byref(mt))
+        return self.run(strm, data, bound)
+
+    def decompress(self, data, size, threads):
+        if threads == 0:
+            strm = self.init(self.lib.lzma_stream_decoder, UINT64_MAX, LZMA_CONCATENATED)
+        else:
+            mt = self.mt_options(threads)
+            strm = self.init(self.lib.lzma_stream_decoder_mt, ctypes.byref(mt))
+        # room for one more byte, so that a truncated output is noticed
+        return self.run(strm, data, size + 1)
+
+
+def load_corpus(size):
+    chunks = []
+    for top in ("bin", "lib", "include"):
+        for dirpath, dirnames, filenames in os.walk(os.path.join(root, top)):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                with open(os.path.join(dirpath, filename), "rb") as f:
+                    chunks.append(f.read())
+    data = b"".join(chunks)
+    if not data:
+        raise RuntimeError("The corpus is empty")
+    return (data * (size // len(data) + 1))[:size]
+
+
+if __name__ == "__main__":
+    size = 64
+    preset = 6
+    block_size = 4
+    thread_counts = None
+    path = None
+    for arg in sys.argv[1:]:
+        if arg.startswith("--size="):
+            size = int(arg[7:])
+        elif arg.startswith("--preset="):
+            preset = int(arg[9:])
+        elif arg.startswith("--block-size="):
+            block_size = int(arg[13:])
+        elif arg.startswith("--threads="):
+            thread_counts = [int(n) for n in arg[10:].split(",")]
+        elif arg.startswith("-"):
+            raise ValueError("Unknown parameter: " + arg)
+        else:
+            path = os.path.abspath(arg) if os.path.exists(arg) else arg
+    if path is None:
+        path = system_library("lzma")
+    if thread_counts is None:
+        cpus = os.cpu_count() or 1
+        thread_counts = sorted(set([1, 2, 4, cpus]) & set(range(1, cpus + 1)))
+
+    xz = Library(path)
+    data = load_corpus(size << 20)
+    print("liblzma %s (%s), %d MB corpus, preset %d, %d MB blocks"
+          % (xz.version, path, size, preset, block_size))
+    print("{:<14}{:>12}{:>12}{:>10}".format("coder", "compress", "decompress", "ratio"))
+
+    runs = [("single", 0)] + [("mt %d" % threads, threads) for threads in thread_counts]
+    results = []
+    packed = None
+    for label, threads in runs:
+        start = time.perf_counter()
+        compressed = xz.compress(data, preset, threads, block_size << 20)
+        results.append([label, threads, size / (time.perf_counter() - start), len(data) / len(compressed)])
+        if threads:
+            # the multithreaded encoders all write the same blocks
+            packed = compressed
+    for result in results:
+        label, threads = result[:2]
+        if threads and not xz.mt_decoder:
+            result.append(float("nan"))
+            continue
+        start = time.perf_counter()
+        if xz.decompress(packed, len(data), threads) != data:
+            raise RuntimeError("round trip failed")
+        result.append(size / (time.perf_counter() - start))
+    base = results[0]
+    for label, threads, compress_rate, ratio, decompress_rate in results:
+        print("{:<14}{:>7.1f} MB/s{:>7.1f} MB/s{:>10.3f}   {:.2f}x / {:.2f}x".format(
+            label, compress_rate, decompress_rate, ratio, compress_rate / base[2], decompress_rate / base[4],
+        ))
+    if not xz.mt_decoder:
+        print("liblzma %s has no multithreaded decoder (5.4 or later)" % xz.version)
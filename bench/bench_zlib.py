@@ -0,0 +1,155 @@
+r"""
+Compare zlib builds, e.g. zlib against zlib-ng in zlib compatible mode
+(--zlib-ng), by compressing and decompressing a fixed corpus through ctypes.
+
+Run as python3 bench/bench_zlib.py zlib=bin\zlib1.dll ng=build\zlib-ng-2.2.4\build-cmake\zlib1.dll
+or on Linux with libraries built locally, e.g. for zlib-ng
+    cmake -S zlib-ng-2.2.4 -B ng -DZLIB_COMPAT=ON && cmake --build ng
+    python3 bench/bench_zlib.py system=libz.so.1 ng=ng/libz.so
+(see bench/harness.py).
+
+The corpus is lib\tcl8.6 of this repository, sorted by path: every file is
+compressed on its own, like the members of a zip file or wheel, and all of
+them concatenated as one stream, like a large HTTP response.
+"""
+
+import ctypes
+import os
+import sys
+import time
+
+from harness import child_done, labelled, measure_in_children, median, save_results, system_library
+
+Z_OK = 0
+corpus_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), "lib", "tcl8.6")
+
+
+def load_corpus(root=corpus_dir):
+    files = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            with open(os.path.join(dirpath, filename), "rb") as f:
+                files.append(f.read())
+    if not files:
+        raise RuntimeError("The corpus %s is empty" % root)
+    return files
+
+
+class Library(object):
+    """compress2, uncompress and the checksums of a zlib build."""
+
+    def __init__(self, path):
+        lib = self.lib = ctypes.CDLL(path)
+        ulong_p = ctypes.POINTER(ctypes.c_ulong)
+        lib.zlibVersion.restype = ctypes.c_char_p
+        lib.compressBound.argtypes = [ctypes.c_ulong]
+        lib.compressBound.restype = ctypes.c_ulong
+        lib.compress2.argtypes = [ctypes.c_char_p, ulong_p, ctypes.c_char_p, ctypes.c_ulong, ctypes.c_int]
+        lib.uncompress.argtypes = [ctypes.c_char_p, ulong_p, ctypes.c_char_p, ctypes.c_ulong]
+        for name in ("crc32", "adler32"):
+            func = getattr(lib, name)
+            func.argtypes = [ctypes.c_ulong, ctypes.c_char_p, ctypes.c_uint]
+            func.restype = ctypes.c_ulong
+        self.version = lib.zlibVersion().decode()
+
+    def compress(self, data, level):
+        size = ctypes.c_ulong(self.lib.compressBound(len(data)))
+        out = ctypes.create_string_buffer(size.value)
+        if self.lib.compress2(out, ctypes.byref(size), data, len(data), level) != Z_OK:
+            raise RuntimeError("compress2 failed")
+        return out.raw[:size.value]
+
+    def decompress(self, data, length):
+        size = ctypes.c_ulong(length)
+        out = ctypes.create_string_buffer(length)
+        if self.lib.uncompress(out, ctypes.byref(size), data, len(data)) != Z_OK or size.value != length:
+            raise RuntimeError("uncompress failed")
+        return out.raw
+
+
+def measure(path, levels, repeat):
+    """Time the workloads, returns the median MB/s and the ratios."""
+    zlib = Library(path)
+    corpora = {"files": load_corpus()}
+    corpora["stream"] = [b"".join(corpora["files"])]
+    results = {}
+    ratios = {}
+
+    def timed(name, size, func):
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            func()
+            times.append(time.perf_counter() - start)
+        results[name] = size / median(times) / 1e6
+
+    for kind, data in corpora.items():
+        size = sum(len(chunk) for chunk in data)
+        for level in levels:
+            compressed = [zlib.compress(chunk, level) for chunk in data]
+            for chunk, packed in zip(data, compressed):
+                if zlib.decompress(packed, len(chunk)) != chunk:
+                    raise RuntimeError("round trip failed")
+            ratios["%s/%d" % (kind, level)] = size / sum(len(packed) for packed in compressed)
+            timed("deflate/%s/%d" % (kind, level), size, lambda: [zlib.compress(chunk, level) for chunk in data])
+            timed("inflate/%s/%d" % (kind, level), size, lambda: [
+                zlib.decompress(packed, len(chunk)) for chunk, packed in zip(data, compressed)
+            ])
+    stream = corpora["stream"][0]
+    for name in ("crc32", "adler32"):
+        func = getattr(zlib.lib, name)
+        timed(name, len(stream) * 10, lambda: [func(0, stream, len(stream)) for _ in range(10)])
+    return {"path": path, "version": zlib.version, "workloads": results, "ratios": ratios}
+
+
+def print_results(results):
+    labels = list(results)
+    base = results[labels[0]]["workloads"]
+    print("{:<20}".format("MB/s") + "".join("{:>16}".format(label[:15]) for label in labels))
+    for name in base:
+        row = "{:<20}".format(name)
+        for label in labels:
+            value = results[label]["workloads"][name]
+            row += "{:>9.1f} {:>5.2f}x".format(value, value / base[name] if base[name] else 0)
+        print(row)
+    print("{:<20}".format("ratio") + "".join("{:>16}".format(label[:15]) for label in labels))
+    for name in results[labels[0]]["ratios"]:
+        print("{:<20}".format(name) + "".join(
+            "{:>16.3f}".format(results[label]["ratios"][name]) for label in labels
+        ))
+    for label in labels:
+        print("%s: zlib %s, %s" % (label, results[label]["version"], results[label]["path"]))
+
+
+if __name__ == "__main__":
+    levels = [1, 6, 9]
+    repeat = 5
+    output = None
+    child = None
+    libraries = []
+    for arg in sys.argv[1:]:
+        if arg.startswith("--levels="):
+            levels = [int(level) for level in arg[9:].split(",")]
+        elif arg.startswith("--repeat="):
+            repeat = int(arg[9:])
+        elif arg.startswith("--output="):
+            output = arg[9:]
+        elif arg.startswith("--child="):
+            child = arg[8:]
+        elif arg.startswith("-"):
+            raise ValueError("Unknown parameter: " + arg)
+        else:
+            libraries.append(labelled(arg))
+
+    if child is not None:
+        child_done(measure(child, levels, repeat))
+
+    if not libraries:
+        libraries.append(("system", system_library("z")))
+
+    results = measure_in_children(__file__, libraries, [
+        "--levels=" + ",".join(str(level) for level in levels), "--repeat=%d" % repeat,
+    ])
+    print_results(results)
+    save_results(output, results)
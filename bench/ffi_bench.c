@@ -0,0 +1,178 @@
+/*
+ * Overhead of libffi calls and closures, driven by bench/bench_ffi.py.
+ * Every workload is timed over ITERATIONS calls and reported in ns per
+ * call: direct calls through a function pointer as the baseline, ffi_call
+ * with integer, double, pointer and struct signatures, calls into a
+ * closure trampoline and the preparation of a closure.
+ *
+ * Usage: ffi_bench ITERATIONS
+ * Prints one JSON object on stdout.
+ */
+
+#include <ffi.h>
+
+#include <stdio.h>
+#include <stdlib.h>
+
+#ifdef _WIN32
+#include <windows.h>
+#else
+#include <time.h>
+#endif
+
+struct point {
+    double x;
+    double y;
+};
+
+static double now(void)
+{
+#ifdef _WIN32
+    LARGE_INTEGER counter, frequency;
+    QueryPerformanceCounter(&counter);
+    QueryPerformanceFrequency(&frequency);
+    return (double)counter.QuadPart / (double)frequency.QuadPart;
+#else
+    struct timespec ts;
+    clock_gettime(CLOCK_MONOTONIC, &ts);
+    return ts.tv_sec + ts.tv_nsec * 1e-9;
+#endif
+}
+
+static int add(int a, int b) { return a + b; }
+
+static double sum4(double a, double b, double c, double d) { return a + b + c + d; }
+
+static void *pick(void *a, void *b, void *c, void *d, void *e, void *f) { return c ? c : f; }
+
+static struct point scale(struct point p, double k)
+{
+    struct point r;
+    r.x = p.x * k;
+    r.y = p.y * k;
+    return r;
+}
+
+static void add_handler(ffi_cif *cif, void *ret, void **args, void *data)
+{
+    *(ffi_arg *)ret = *(int *)args[0] + *(int *)args[1];
+}
+
+/* volatile, so that the baseline is not inlined */
+static int (*volatile direct_add)(int, int) = add;
+
+static void prep(ffi_cif *cif, unsigned nargs, ffi_type *rtype, ffi_type **atypes)
+{
+    if (ffi_prep_cif(cif, FFI_DEFAULT_ABI, nargs, rtype, atypes) != FFI_OK) {
+        fprintf(stderr, "ffi_prep_cif failed\n");
+        exit(1);
+    }
+}
+
+int main(int argc, char **argv)
+{
+    long n, i;
+    double start, direct, call_int, call_double, call_pointer, call_struct, closure_call, closure_prep;
+    volatile long sink = 0;
+    ffi_cif cif_int, cif_double, cif_pointer, cif_struct;
+    ffi_type *int_args[2] = {&ffi_type_sint, &ffi_type_sint};
+    ffi_type *double_args[4] = {&ffi_type_double, &ffi_type_double, &ffi_type_double, &ffi_type_double};
+    ffi_type *pointer_args[6];
+    ffi_type *point_elements[3] = {&ffi_type_double, &ffi_type_double, NULL};
+    ffi_type point_type;
+    ffi_type *struct_args[2];
+    int a = 1, b = 2;
+    double d = 0.5;
+    void *p = &a, *q = NULL;
+    struct point pt = {1.0, 2.0}, pt_result;
+    double k = 1.0;
+    ffi_arg int_result;
+    double double_result;
+    void *pointer_result;
+    void *int_values[2] = {&a, &b};
+    void *double_values[4] = {&d, &d, &d, &d};
+    void *pointer_values[6] = {&q, &q, &p, &q, &q, &q};
+    void *struct_values[2] = {&pt, &k};
+    ffi_closure *closure;
+    int (*closure_add)(int, int);
+
+    if (argc != 2) {
+        fprintf(stderr, "usage: %s ITERATIONS\n", argv[0]);
+        return 2;
+    }
+    n = atol(argv[1]);
+
+    for (i = 0; i < 6; i++)
+        pointer_args[i] = &ffi_type_pointer;
+    point_type.size = 0;
+    point_type.alignment = 0;
+    point_type.type = FFI_TYPE_STRUCT;
+    point_type.elements = point_elements;
+    struct_args[0] = &point_type;
+    struct_args[1] = &ffi_type_double;
+    prep(&cif_int, 2, &ffi_type_sint, int_args);
+    prep(&cif_double, 4, &ffi_type_double, double_args);
+    prep(&cif_pointer, 6, &ffi_type_pointer, pointer_args);
+    prep(&cif_struct, 2, &point_type, struct_args);
+
+    start = now();
+    for (i = 0; i < n; i++)
+        sink += direct_add(a, b);
+    direct = now() - start;
+
+    start = now();
+    for (i = 0; i < n; i++) {
+        ffi_call(&cif_int, FFI_FN(add), &int_result, int_values);
+        sink += (int)int_result;
+    }
+    call_int = now() - start;
+
+    start = now();
+    for (i = 0; i < n; i++) {
+        ffi_call(&cif_double, FFI_FN(sum4), &double_result, double_values);
+        sink += (long)double_result;
+    }
+    call_double = now() - start;
+
+    start = now();
+    for (i = 0; i < n; i++) {
+        ffi_call(&cif_pointer, FFI_FN(pick), &pointer_result, pointer_values);
+        sink += pointer_result != NULL;
+    }
+    call_pointer = now() - start;
+
+    start = now();
+    for (i = 0; i < n; i++) {
+        ffi_call(&cif_struct, FFI_FN(scale), &pt_result, struct_values);
+        sink += (long)pt_result.y;
+    }
+    call_struct = now() - start;
+
+    closure = ffi_closure_alloc(sizeof(ffi_closure), (void **)&closure_add);
+    if (closure == NULL || ffi_prep_closure_loc(closure, &cif_int, add_handler, NULL, closure_add) != FFI_OK) {
+        fprintf(stderr, "preparing a closure failed\n");
+        return 1;
+    }
+    start = now();
+    for (i = 0; i < n; i++)
+        sink += closure_add(a, b);
+    closure_call = now() - start;
+    ffi_closure_free(closure);
+
+    /* fewer iterations, allocating closures is much slower */
+    start = now();
+    for (i = 0; i < n / 100; i++) {
+        void *code;
+        closure = ffi_closure_alloc(sizeof(ffi_closure), &code);
+        ffi_prep_closure_loc(closure, &cif_int, add_handler, NULL, code);
+        ffi_closure_free(closure);
+    }
+    closure_prep = (now() - start) * 100;
+
+    printf("{\"iterations\": %ld, \"check\": %ld, \"ns_per_call\": {"
+           "\"direct\": %.2f, \"call/int\": %.2f, \"call/double\": %.2f, \"call/pointer\": %.2f, "
+           "\"call/struct\": %.2f, \"closure/call\": %.2f, \"closure/prep\": %.2f}}\n",
+           n, (long)sink, direct * 1e9 / n, call_int * 1e9 / n, call_double * 1e9 / n,
+           call_pointer * 1e9 / n, call_struct * 1e9 / n, closure_call * 1e9 / n, closure_prep * 1e9 / n);
+    return 0;
+}
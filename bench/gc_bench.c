@@ -0,0 +1,188 @@
+/*
+ * Allocation throughput and pause times of the Boehm GC, driven by
+ * bench/bench_gc.py. Each thread allocates small objects, keeping the last
+ * LIVE of them reachable from a ring, and now and then builds and drops a
+ * binary tree, much like a PyPy interpreter using the Boehm GC.
+ *
+ * GC_THREADS redirects the thread functions to the GC ones, so that the
+ * threads are registered. Works with gc 7.1, pause times need 7.4 or later.
+ *
+ * Usage: gc_bench THREADS ALLOCS_PER_THREAD
+ * Prints one JSON object on stdout.
+ */
+
+#define GC_THREADS
+#include <gc.h>
+
+#include <stdio.h>
+#include <stdlib.h>
+
+#ifdef _WIN32
+#include <windows.h>
+#else
+#include <pthread.h>
+#include <time.h>
+#endif
+
+#ifndef GC_VERSION_MICRO
+#define GC_VERSION_MICRO 0
+#endif
+
+#if GC_VERSION_MAJOR > 7 || (GC_VERSION_MAJOR == 7 && GC_VERSION_MINOR >= 2)
+#define collections() GC_get_gc_no()
+#else
+/* gc 7.1 only exports the counter itself */
+#define collections() GC_gc_no
+#endif
+
+#define LIVE 4096
+#define TREE_DEPTH 14
+#define MAX_PAUSES 100000
+
+struct node {
+    struct node *left;
+    struct node *right;
+    long value;
+};
+
+static long allocs_per_thread;
+static double pauses[MAX_PAUSES];
+static long pause_count;
+
+static double now(void)
+{
+#ifdef _WIN32
+    LARGE_INTEGER counter, frequency;
+    QueryPerformanceCounter(&counter);
+    QueryPerformanceFrequency(&frequency);
+    return (double)counter.QuadPart / (double)frequency.QuadPart;
+#else
+    struct timespec ts;
+    clock_gettime(CLOCK_MONOTONIC, &ts);
+    return ts.tv_sec + ts.tv_nsec * 1e-9;
+#endif
+}
+
+#if GC_VERSION_MAJOR > 7 || (GC_VERSION_MAJOR == 7 && GC_VERSION_MINOR >= 4)
+#define HAVE_COLLECTION_EVENTS
+static double pause_start;
+
+/* called with the allocation lock held, so no locking is needed here */
+static void on_collection_event(GC_EventType event)
+{
+    if (event == GC_EVENT_START) {
+        pause_start = now();
+    } else if (event == GC_EVENT_END && pause_count < MAX_PAUSES) {
+        pauses[pause_count++] = now() - pause_start;
+    }
+}
+#endif
+
+static struct node *make_tree(int depth)
+{
+    struct node *node = GC_MALLOC(sizeof(struct node));
+    node->value = depth;
+    if (depth > 0) {
+        node->left = make_tree(depth - 1);
+        node->right = make_tree(depth - 1);
+    }
+    return node;
+}
+
+static void run(void)
+{
+    struct node **ring = GC_MALLOC(LIVE * sizeof(struct node *));
+    long i;
+    for (i = 0; i < allocs_per_thread; i++) {
+        struct node *node = GC_MALLOC(sizeof(struct node) + (i % 8) * sizeof(void *));
+        node->value = i;
+        /* link to the previous node and cut the link of the oldest one
+           left to the node evicted below, so only the ring stays live */
+        node->left = ring[(i + LIVE - 1) % LIVE];
+        if (ring[(i + 1) % LIVE] != NULL) {
+            ring[(i + 1) % LIVE]->left = NULL;
+        }
+        ring[i % LIVE] = node;
+        if (i % 200000 == 0) {
+            node->right = make_tree(TREE_DEPTH);
+        }
+    }
+}
+
+#ifdef _WIN32
+static DWORD WINAPI thread_main(LPVOID arg)
+{
+    run();
+    return 0;
+}
+#else
+static void *thread_main(void *arg)
+{
+    run();
+    return NULL;
+}
+#endif
+
+static int compare_doubles(const void *a, const void *b)
+{
+    double x = *(const double *)a, y = *(const double *)b;
+    return (x > y) - (x < y);
+}
+
+int main(int argc, char **argv)
+{
+    int threads, i;
+    double start, seconds, total = 0.0, longest = 0.0, median = 0.0;
+    const char *markers;
+
+    if (argc != 3) {
+        fprintf(stderr, "usage: %s THREADS ALLOCS_PER_THREAD\n", argv[0]);
+        return 2;
+    }
+    threads = atoi(argv[1]);
+    allocs_per_thread = atol(argv[2]);
+
+    GC_INIT();
+#ifdef HAVE_COLLECTION_EVENTS
+    GC_set_on_collection_event(on_collection_event);
+#endif
+
+    start = now();
+    {
+#ifdef _WIN32
+        HANDLE *handles = malloc(threads * sizeof(HANDLE));
+        for (i = 0; i < threads; i++)
+            handles[i] = CreateThread(NULL, 0, thread_main, NULL, 0, NULL);
+        WaitForMultipleObjects(threads, handles, TRUE, INFINITE);
+        for (i = 0; i < threads; i++)
+            CloseHandle(handles[i]);
+#else
+        pthread_t *handles = malloc(threads * sizeof(pthread_t));
+        for (i = 0; i < threads; i++)
+            pthread_create(&handles[i], NULL, thread_main, NULL);
+        for (i = 0; i < threads; i++)
+            pthread_join(handles[i], NULL);
+#endif
+        free(handles);
+    }
+    seconds = now() - start;
+
+    if (pause_count > 0) {
+        qsort(pauses, pause_count, sizeof(double), compare_doubles);
+        for (i = 0; i < pause_count; i++)
+            total += pauses[i];
+        longest = pauses[pause_count - 1];
+        median = pauses[pause_count / 2];
+    }
+    markers = getenv("GC_MARKERS");
+    printf("{\"gc_version\": \"%d.%d.%d\", \"threads\": %d, \"markers\": \"%s\", "
+           "\"allocs\": %ld, \"seconds\": %.6f, \"allocs_per_s\": %.0f, "
+           "\"collections\": %lu, \"heap_bytes\": %lu, \"pauses\": %ld, "
+           "\"pause_total_ms\": %.3f, \"pause_max_ms\": %.3f, \"pause_p50_ms\": %.3f}\n",
+           GC_VERSION_MAJOR, GC_VERSION_MINOR, GC_VERSION_MICRO, threads,
+           markers ? markers : "default", allocs_per_thread * threads, seconds,
+           allocs_per_thread * threads / seconds, (unsigned long)collections(),
+           (unsigned long)GC_get_heap_size(), pause_count,
+           total * 1e3, longest * 1e3, median * 1e3);
+    return 0;
+}
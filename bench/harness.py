@@ -0,0 +1,112 @@
+r"""
+What the benchmarks comparing library builds share: finding the builds,
+compiling a C driver against each, and measuring libraries loaded through
+ctypes in a separate interpreter each.
+
+The benchmarks take the builds to compare as LABEL=PATH arguments, the
+first one being the baseline. Without arguments they measure the system
+library, which is enough to try them on Linux. A library measured through
+ctypes is loaded in a child process (the benchmark script itself, run with
+--child=), as Windows would otherwise reuse the first dll of a name for
+all of them.
+"""
+
+import ctypes.util
+import glob
+import json
+import os
+import shutil
+import subprocess
+import sys
+
+
+def labelled(arg):
+    """Split a LABEL=PATH argument, the label defaults to the path."""
+    label, sep, path = arg.rpartition("=")
+    return label if sep else path, path
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def system_library(name):
+    """The path of the system library name, as ctypes finds it."""
+    path = ctypes.util.find_library(name)
+    if path is None:
+        raise RuntimeError("No %s library found, pass the paths of the builds to compare" % name)
+    return path
+
+
+def find_build(root, header, names):
+    """Return (include dirs, library) of a build directory: the directory
+    of header, root or its include subdirectory, and the first library
+    matching one of names in root or a subdirectory."""
+    include = root
+    if not os.path.isfile(os.path.join(root, header)):
+        include = os.path.join(root, "include")
+    for name in names:
+        found = sorted(glob.glob(os.path.join(root, name)) + glob.glob(os.path.join(root, "*", name)))
+        if found:
+            return [include], found[0]
+    raise RuntimeError("No %s found in %s" % (" or ".join(names), root))
+
+
+def compile_driver(source, output, includes, library, link, package, dlls="*.dll"):
+    """Compile the C driver source into output with cl or cc (CC), against
+    library and the headers in includes, or the system library when library
+    is None. link are the cc flags linking the library (e.g. ["-lffi"]),
+    the dlls next to the library are copied next to the executable.
+    package names what to install when there is no system library.
+    Returns the path of the executable."""
+    if os.name == "nt":
+        exe = output + ".exe"
+        subprocess.check_call(
+            ["cl", "/nologo", "/O2", "/MD"] + ["/I" + include for include in includes]
+            + [source, "/Fe" + exe, "/Fo" + output + ".obj", library]
+        )
+        for dll in glob.glob(os.path.join(os.path.dirname(library), dlls)):
+            shutil.copy(dll, os.path.dirname(exe))
+        return exe
+    command = [os.environ.get("CC", "cc"), "-O2", "-o", output, source]
+    if library is not None:
+        lib_dir = os.path.dirname(library)
+        command[1:1] = ["-I" + include for include in includes] + ["-Wl,-rpath," + lib_dir]
+        command.append("-L" + lib_dir)
+    try:
+        subprocess.check_call(command + link)
+    except (OSError, subprocess.CalledProcessError):
+        raise RuntimeError(
+            "Compiling %s failed, install %s or pass the directory of a build"
+            % (source, package)
+        )
+    return output
+
+
+def measure_in_children(script, libraries, args):
+    """Run script with --child=PATH and args in a new interpreter for each
+    (label, path) of libraries, where the child prints the results of path
+    as JSON (see child_done). Returns {label: results}."""
+    results = {}
+    for label, path in libraries:
+        if os.path.exists(path):
+            path = os.path.abspath(path)
+        out = subprocess.check_output(
+            [sys.executable, os.path.realpath(script), "--child=" + path] + args
+        )
+        results[label] = json.loads(out.decode())
+    return results
+
+
+def child_done(results):
+    """Hand the results of a child to measure_in_children and exit."""
+    json.dump(results, sys.stdout)
+    sys.exit(0)
+
+
+def save_results(output, results):
+    """Write results to the --output file, if one was given."""
+    if output is not None:
+        with open(output, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
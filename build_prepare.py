@@ -2,6 +2,8 @@ r"""
 Run as python3 build_prepare.py --cpython-openssl
 then for each updated dependency run
 cmd.exe build\build_xxx.cmd
+
+The options are described in README.rst.
 """
 
 import os
@@ -9,6 +11,7 @@ import shutil
 import stat
 import subprocess
 import sys
+import threading
 from itertools import count
 
 
@@ -57,19 +60,23 @@ architectures = {
         "cpython_arch": "win32",
         "boehm_arch": "NT",
         "boehm_target": r"Release\gc",
-        "xz_arch": "i486",
+        # appended by CMake to the name of the bdwgc dll, giving the names
+        # of boehm_target
+        "boehm_postfix": "",
         "tcl_arch": "IX86",
         "vcvars_arch": "x86",
         "openssl_arch": "VC-WIN32",
+        "ffi_target": "X86_WIN32",
     },
     "x64": {
         "cpython_arch": "amd64",
         "boehm_arch": "NT_X64",
         "boehm_target": r"gc64_dll",
-        "xz_arch": "x86-64",
+        "boehm_postfix": "64_dll",
         "tcl_arch": "AMD64",
         "vcvars_arch": "x86_amd64",
-        "openssl_arch": "VC-WIN64A-masm",
+        "openssl_arch": "VC-WIN64A",
+        "ffi_target": "X86_WIN64",
     },
 }
 
@@ -80,175 +87,232 @@ header = [
     cmd_append("PATH", "{bin_dir}"),
 ]
 
-# dependencies, listed in order of compilation
-deps = {
-    "boehm": {
-        "url": "https://hboehm.info/gc/gc_source/gc-7.1.tar.gz",
-        "filename": "gc-7.1.tar.gz",
-        "dir": "gc-7.1",
-        "patch": {
-            r"misc.c": {
-                "void GC_abort(const char *msg)\n"
-                "{{\n"
-                "#   if defined(MSWIN32)":
-                    "void GC_abort(const char *msg)\n"
-                    "{{\n"
-                    "#   if 0",
-            },
-            r"include\private\gc_priv.h": {
-                "# ifndef abs": "#if 0",
-            },
-            r"NT_X64_THREADS_MAKEFILE": {
-                "cvarsmt": "cvarsdll",
-            },
-        },
-        "build": [
-            cmd_nmake("{boehm_arch}_THREADS_MAKEFILE", "CLEAN"),
-            cmd_nmake("{boehm_arch}_THREADS_MAKEFILE", params="nodebug=1"),
-        ],
-        "headers": [r"include\gc.h", r"include\gc_config_macros.h", r"include\gc_version.h"],
-        "libs": [r"{boehm_target}.lib"],
-        "bins": [r"{boehm_target}.dll"],
-    },
-    "zlib": {
-        "url": "https://zlib.net/zlib131.zip",
-        "filename": "zlib131.zip",
-        "dir": "zlib-1.3.1",
-        "build": [
-            cmd_nmake(r"win32\Makefile.msc", "clean"),
-            cmd_nmake(r"win32\Makefile.msc"),
-        ],
-        "headers": ["zconf.h", "zlib.h", "zutil.h"],
-        "libs": [r"zlib.lib"],
-        "bins": [r"zlib1.dll"],
-    },
-    "bz2": {
-        "url": "https://github.com/python/cpython-source-deps/archive/bzip2-1.0.8.zip",
-        "filename": "bzip2-1.0.8.zip",
-        "dir": "cpython-source-deps-bzip2-1.0.8",
-        "build": [
-            cmd_nmake(r"makefile.msc", "clean"),
-            cmd_nmake(r"makefile.msc"),
-        ],
-        "headers": [r"bzlib.h"],
-        "libs": [r"libbz2.lib"],
-    },
-    "sqlite3": {
-        "url": "https://sqlite.org/2022/sqlite-amalgamation-3400100.zip",
-        "filename": "sqlite-amalgamation-3400100.zip",
-        "dir": "sqlite-amalgamation-3400100",
-        "build": [
-            cmd_copy(r"{winbuild_dir}\sqlite3.nmake", r"makefile.msc"),
-            cmd_nmake(r"makefile.msc", "clean"),
-            cmd_nmake(r"makefile.msc"),
-        ],
-        "headers": ["sqlite3.h", "sqlite3ext.h"],
-        "libs": [r"sqlite3.lib"],
-        "bins": [r"sqlite3.dll"],
-    },
-    "libexpat": {
-        "url": "https://github.com/libexpat/libexpat/archive/R_2_5_0.zip",
-        "filename": "R_2_5_0.zip",
-        "dir": "libexpat-R_2_5_0",
-        "patch": {
-            r"expat\lib\xmltok.c": {
-                "  const ptrdiff_t bytesStorable = toLim - *toP;\n":
-                    "  const ptrdiff_t bytesStorable = toLim - *toP;\n"
-                    "  const char * fromLimBefore;\n"
-                    "  ptrdiff_t bytesToCopy;\n",
-                "  const char * const fromLimBefore = fromLim;\n":
-                    "  fromLimBefore = fromLim;\n",
-                "  const ptrdiff_t bytesToCopy = fromLim - *fromP;\n":
-                    "  bytesToCopy = fromLim - *fromP;\n",
-            },
-        },
-        "build": [
-            cmd_cd(r"expat"),
-            "mkdir build",
-            "cd build",
-            "cmake ..",
-            "cmake --build . --config Release",
-        ],
-        "headers": [r"..\lib\expat.h", r"..\lib\expat_external.h"],
-        "libs": [r"Release\libexpat.lib"],
-        "bins": [r"Release\libexpat.dll"],
-    },
-    "openssl-cpython": {
-        # use pre-built OpenSSL from CPython
-        "url": "https://github.com/python/cpython-bin-deps/archive/openssl-bin-1.1.1t.tar.gz",
-        "filename": "openssl-bin-1.1.1t.tar.gz",
-        "dir": "cpython-bin-deps-openssl-bin-1.1.1t",
-        "build": [
-            cmd_xcopy(r"{cpython_arch}\include", "{inc_dir}"),
-        ],
-        "libs": [r"{cpython_arch}\lib*.lib"],
-        "bins": [r"{cpython_arch}\lib*.dll"],
-    },
-    "unused openssl": {
-        "url": "https://www.openssl.org/source/openssl-1.1.1t.tar.gz",
-        "filename": "openssl-1.1.1t.tar.gz",
-        "dir": "openssl-1.1.1t",
-        "build": [
-            "perl configure {openssl_arch} no-asm",
-            cmd_nmake(),
-            cmd_xcopy(r"include\openssl", "{inc_dir}\openssl"),
-        ],
-        "libs": [r"libcrypto.lib", r"libssl.lib"],
-        "bins": [r"libcrypto-1_1.dll", r"libssl-1_1.dll"],
-    },
-    "lzma": {
-        "url": "https://tukaani.org/xz/xz-5.0.5-windows.zip",
-        "filename": "xz-5.0.5-windows.zip",
-        "dir": "xz-5.0.5-windows",
-        "dir-create": True,
-        "build": [
-            cmd_copy(r"bin_{xz_arch}\liblzma.a", r"bin_{xz_arch}\lzma.lib"),
-            cmd_xcopy(r"include", "{inc_dir}"),
-        ],
-        "libs": [r"bin_{xz_arch}\lzma.lib"],
-        "bins": [r"bin_{xz_arch}\liblzma.dll"],
-    },
-    "tcl": {
-        "url": "https://prdownloads.sourceforge.net/tcl/tcl8.6.9-src.tar.gz",
-        "filename": "tcl8.6.9-src.tar.gz",
-        "dir": "tcl8.6.9",
-        "build": [
-            cmd_cd("win"),
-            cmd_set("COMPILERFLAGS", "-DWINVER=0x0500"),
-            cmd_set("DEBUG", "0"),
-            cmd_set("INSTALLDIR", r"{tcltk_dir}"),
-            cmd_set("MACHINE", "{tcl_arch}"),
-            cmd_nmake("makefile.vc", "clean"),
-            cmd_nmake("makefile.vc", "all"),
-            cmd_nmake("makefile.vc", "install"),
-            cmd_xcopy(r"{tcltk_dir}\lib\tcl8.6", r"{lib_dir}\tcl8.6")
-        ],
-        "headers": [r"{tcltk_dir}\include\*.h"],
-        "libs": [r"{tcltk_dir}\lib\tcl*.lib"],
-        "bins": [r"{tcltk_dir}\bin\tcl*.dll"],
-    },
-    "tk": {
-        "url": "https://prdownloads.sourceforge.net/tcl/tk8.6.9.1-src.tar.gz",
-        "filename": "tk8.6.9.1-src.tar.gz",
-        "dir": "tk8.6.9",
-        "build": [
-            cmd_cd("win"),
-            cmd_set("COMPILERFLAGS", "-DWINVER=0x0500"),
-            cmd_set("DEBUG", "0"),
-            cmd_set("INSTALLDIR", r"{tcltk_dir}"),
-            cmd_set("MACHINE", "{tcl_arch}"),
-            cmd_set("TCLDIR", r"{build_dir}\tcl8.6.9"),
-            cmd_nmake("makefile.vc", "clean"),
-            cmd_nmake("makefile.vc", "all"),
-            cmd_nmake("makefile.vc", "install"),
-            cmd_xcopy(r"{tcltk_dir}\include\X11", r"{inc_dir}\X11"),
-            cmd_xcopy(r"{tcltk_dir}\lib\tk8.6", r"{lib_dir}\tk8.6")
-        ],
-        "headers": [r"{tcltk_dir}\include\tk*.h"],
-        "libs": [r"{tcltk_dir}\lib\tk*.lib"],
-        "bins": [r"{tcltk_dir}\bin\tk*.dll"],
-    },
+# keys of an entry of the "deps" table in deps.json: (types, required)
+dep_schema = {
+    "comment": (str, False),
+    "url": (str, True),
+    "filename": (str, True),
+    # pins the archive digest, or {filename: digest} when the filename
+    # depends on an option; --pin records the digests of unpinned entries
+    "sha256": ((str, dict), False),
+    # directory of the sources, relative to the build directory
+    "dir": (str, True),
+    # extract the archive into "dir" instead of the build directory
+    "dir-create": (bool, False),
+    # globs selecting archive members
+    "extract-include": (list, False),
+    "extract-exclude": (list, False),
+    # {file: {text: replacement}}
+    "patch": (dict, False),
+    # dependencies which must be built first
+    "requires": (list, False),
+    # commands: strings or {"cd": dir}, {"set": [name, value]},
+    # {"copy": [src, tgt]}, {"xcopy": [src, tgt]} and
+    # {"nmake": makefile, "target": target, "params": params}
+    "build": (list, True),
+    # copied to include, lib and bin
+    "headers": (list, False),
+    "libs": (list, False),
+    "bins": (list, False),
+    # [source, target] directories copied recursively
+    "trees": (list, False),
+    # {name: value} substituted for {name} in the build steps and the
+    # headers, libs and bins, can be overridden with --option=dep.name=value
+    "options": (dict, False),
+}
+
+deps_version = 1
+
+# dependencies, listed in order of compilation, see load_deps()
+deps = None
+
+
+def render_step(step):
+    """Turn a build step of deps.json into a command line."""
+    if isinstance(step, str):
+        return step
+    if "cd" in step:
+        return cmd_cd(step["cd"])
+    if "set" in step:
+        return cmd_set(*step["set"])
+    if "copy" in step:
+        return cmd_copy(*step["copy"])
+    if "xcopy" in step:
+        return cmd_xcopy(*step["xcopy"])
+    return cmd_nmake(step["nmake"], step.get("target", ""), step.get("params"))
+
+
+def validate_deps(data):
+    """Check the contents of deps.json, raising ValueError listing all
+    problems found."""
+    problems = []
+    if not isinstance(data, dict) or data.get("version") != deps_version:
+        raise ValueError("deps.json: expected a version %d manifest" % deps_version)
+    table = data.get("deps")
+    if not isinstance(table, dict):
+        raise ValueError('deps.json: "deps" must be an object')
+    step_keys = [("cd",), ("set",), ("copy",), ("xcopy",), ("nmake", "target", "params")]
+    seen = []
+    for name, dep in table.items():
+        if not isinstance(dep, dict):
+            problems.append("%s: must be an object" % name)
+            continue
+        for key in dep:
+            if key not in dep_schema:
+                problems.append("%s: unknown key %r" % (name, key))
+        for key, (kind, required) in dep_schema.items():
+            if key not in dep:
+                if required:
+                    problems.append("%s: missing %r" % (name, key))
+            elif not isinstance(dep[key], kind):
+                kinds = kind if isinstance(kind, tuple) else (kind,)
+                problems.append("%s: %r must be a %s" % (
+                    name, key, " or ".join(k.__name__ for k in kinds)
+                ))
+        for req in dep.get("requires", []):
+            if req not in seen:
+                problems.append("%s: requires %r, which is not listed before it" % (name, req))
+        for step in dep.get("build", []):
+            if isinstance(step, str):
+                continue
+            if not isinstance(step, dict) or not any(
+                set(step) <= set(keys) and keys[0] in step for keys in step_keys
+            ):
+                problems.append("%s: invalid build step %r" % (name, step))
+        for tree in dep.get("trees", []):
+            if not (isinstance(tree, list) and len(tree) == 2):
+                problems.append("%s: trees must be [source, target] pairs" % name)
+        seen.append(name)
+    if problems:
+        raise ValueError("deps.json:\n    " + "\n    ".join(problems))
+
+
+# compile time options of the sqlite3 build, selected with
+# --option=sqlite3.profile=NAME
+sqlite_profiles = {
+    # what has always been shipped
+    "compat": [
+        "SQLITE_ENABLE_JSON1",
+        "SQLITE_ENABLE_FTS4",
+        "SQLITE_ENABLE_FTS5",
+        "SQLITE_ENABLE_RTREE",
+        "SQLITE_ENABLE_MATH_FUNCTIONS",
+    ],
 }
+sqlite_profiles["throughput"] = sqlite_profiles["compat"] + [
+    # no global allocation statistics, which take a mutex on every malloc
+    "SQLITE_DEFAULT_MEMSTATUS=0",
+    # WAL databases are still consistent after a power loss, only the
+    # last transactions may be lost
+    "SQLITE_DEFAULT_WAL_SYNCHRONOUS=1",
+    # a connection must not be used by two threads at once, which the
+    # sqlite3 module checks unless check_same_thread=False
+    "SQLITE_THREADSAFE=2",
+    # 16 MiB page cache per connection instead of 2 MiB
+    "SQLITE_DEFAULT_CACHE_SIZE=-16384",
+    "SQLITE_USE_ALLOCA",
+]
+
+
+def sqlite_flags(profile):
+    """The compiler flags of a sqlite profile."""
+    if profile not in sqlite_profiles:
+        raise ValueError(
+            "Unknown sqlite profile %r, expected one of %s"
+            % (profile, ", ".join(sorted(sqlite_profiles)))
+        )
+    return " ".join("-D" + define for define in sqlite_profiles[profile])
+
+
+def openssl_mode(options):
+    """The Configure argument and installed dlls of an openssl build mode,
+    selected with --option=openssl.mode=shared|static."""
+    modes = {
+        "shared": ("shared", "lib*-3*.dll"),
+        # consumers link the static libraries, nothing to install in bin
+        "static": ("no-shared", ""),
+    }
+    if options["mode"] not in modes:
+        raise ValueError(
+            "Unknown openssl mode %r, expected one of %s"
+            % (options["mode"], ", ".join(sorted(modes)))
+        )
+    return modes[options["mode"]]
+
+
+def ffi_version(options):
+    """The ABI number (the suffix of libffi-N.dll) and the version number
+    (30406 for 3.4.6) of a libffi version, selected with
+    --option=libffi.version=3.3|3.4.x."""
+    parts = options["version"].split(".")
+    if len(parts) not in (2, 3) or not all(part.isdigit() for part in parts) or parts[:2] not in (
+        ["3", "3"], ["3", "4"]
+    ):
+        raise ValueError("Unsupported libffi version %r, expected 3.3 or 3.4.x" % options["version"])
+    number = sum(int(part) * 100 ** (2 - i) for i, part in enumerate(parts))
+    return ("7" if parts[1] == "3" else "8"), str(number)
+
+
+# values computed from the options of a dependency, usable in its build
+# steps and outputs like the options themselves
+derived_options = {
+    "sqlite_flags": lambda options: sqlite_flags(options["profile"]),
+    "openssl_configure": lambda options: openssl_mode(options)[0],
+    "openssl_dlls": lambda options: openssl_mode(options)[1],
+    "ffi_abi": lambda options: ffi_version(options)[0],
+    "ffi_version_number": lambda options: ffi_version(options)[1],
+}
+
+
+class OptionMap(dict):
+    """Format mapping of the options, leaving unknown fields, the prefs,
+    for later."""
+
+    def __missing__(self, key):
+        if key in derived_options:
+            return derived_options[key](self)
+        return "{" + key + "}"
+
+
+def load_deps(path=None, overrides=None):
+    """Load and validate the dependency table, by default from deps.json
+    next to this script. overrides is {dep: {option: value}}, replacing
+    the options of the entries."""
+    import json
+
+    global deps
+    if path is None:
+        path = os.path.join(os.path.dirname(os.path.realpath(__file__)), "deps.json")
+    with open(path, "r") as f:
+        data = json.load(f)
+    validate_deps(data)
+    deps = {}
+    for name, dep in (overrides or {}).items():
+        unknown = set(dep) - set(data["deps"].get(name, {}).get("options", {}))
+        if unknown:
+            raise ValueError("%s has no option %s" % (name, ", ".join(sorted(unknown))))
+    for name, dep in data["deps"].items():
+        build = [render_step(step) for step in dep["build"]]
+        if "options" in dep:
+            options = OptionMap(dep["options"], **(overrides or {}).get(name, {}))
+            dep = dict(dep, options=dict(options))
+            build = [line.format_map(options) for line in build]
+            for key in ("url", "filename", "dir"):
+                # e.g. a version to download
+                dep[key] = dep[key].format_map(options)
+            for key in ("headers", "libs", "bins"):
+                if key in dep:
+                    # patterns which format to nothing are not installed
+                    patterns = [pattern.format_map(options) for pattern in dep[key]]
+                    dep[key] = [pattern for pattern in patterns if pattern]
+        if isinstance(dep.get("sha256"), dict):
+            # the pin of the archive the options select, if any
+            pins = dep["sha256"]
+            dep = {key: value for key, value in dep.items() if key != "sha256"}
+            if dep["filename"] in pins:
+                dep["sha256"] = pins[dep["filename"]]
+        deps[name] = dict(dep, build=build)
+    return deps
 
 
 # based on setuptools._distutils._msvccompiler version 50.0.0
@@ -349,6 +413,24 @@ def find_msvs():
     return vs
 
 
+def find_nasm():
+    """Directory of nasm.exe, which the OpenSSL assembly needs: on the PATH
+    or where the NASM installer puts it. None if not found."""
+    nasm = shutil.which("nasm")
+    if nasm is not None:
+        return os.path.dirname(nasm)
+    candidates = [
+        os.path.join(os.environ.get("ProgramFiles", ""), "NASM"),
+        os.path.join(os.environ.get("ProgramFiles(x86)", ""), "NASM"),
+        # installed for the current user only
+        os.path.join(os.environ.get("LOCALAPPDATA", ""), "bin", "NASM"),
+    ]
+    for candidate in candidates:
+        if os.path.isfile(os.path.join(candidate, "nasm.exe")):
+            return candidate
+    return None
+
+
 def copy_win32mak():
     import winreg
     try:
@@ -382,39 +464,667 @@ def copy_win32mak():
                         return v
 
 
-def extract_dep(url, filename, dir=None):
+# directory for timing records, None disables them
+timings_dir = None
+timings_lock = threading.Lock()
+
+
+def record_timing(record):
+    """Append a record to timings/prepare.jsonl."""
+    import json
+
+    if timings_dir is None:
+        return
+    with timings_lock:
+        os.makedirs(timings_dir, exist_ok=True)
+        with open(os.path.join(timings_dir, "prepare.jsonl"), "a") as f:
+            f.write(json.dumps(record, sort_keys=True) + "\n")
+
+
+class ConnectionPool:
+    """Keeps idle HTTP(S) connections per host, so that several archives
+    fetched from the same server (e.g. GitHub or SourceForge) reuse them."""
+
+    def __init__(self, timeout=60, max_redirects=10):
+        self.timeout = timeout
+        self.max_redirects = max_redirects
+        self.lock = threading.Lock()
+        self.idle = {}
+
+    def _acquire(self, key):
+        import http.client
+
+        with self.lock:
+            conns = self.idle.get(key)
+            if conns:
+                return conns.pop(), True
+        scheme, netloc = key
+        if scheme == "https":
+            return http.client.HTTPSConnection(netloc, timeout=self.timeout), False
+        elif scheme == "http":
+            return http.client.HTTPConnection(netloc, timeout=self.timeout), False
+        raise ValueError("Unsupported URL scheme: " + scheme)
+
+    def _release(self, key, conn):
+        with self.lock:
+            self.idle.setdefault(key, []).append(conn)
+
+    def _send(self, key, method, path, headers, body=None):
+        import http.client
+
+        while True:
+            conn, reused = self._acquire(key)
+            try:
+                if hasattr(body, "seek"):
+                    # sent again after a dropped connection
+                    body.seek(0)
+                conn.request(method, path, body=body, headers=headers)
+                return conn, conn.getresponse()
+            except (http.client.HTTPException, OSError):
+                conn.close()
+                # the server may have dropped an idle connection, try a new one
+                if not reused:
+                    raise
+
+    def get(self, url, headers=None):
+        """Issue a GET request, following redirects.
+        Returns a response which must be passed to finish() when done."""
+        return self.request("GET", url, headers)
+
+    def request(self, method, url, headers=None, body=None):
+        """Issue a request, following redirects. body is bytes or a file
+        object. Returns a response which must be passed to finish() when
+        done; raises HTTPError for error statuses."""
+        import http.client
+        import urllib.error
+        import urllib.parse
+
+        headers = dict(headers or {})
+        headers.setdefault("User-Agent", "build_prepare.py")
+        for _ in range(self.max_redirects + 1):
+            parts = urllib.parse.urlsplit(url)
+            key = (parts.scheme, parts.netloc)
+            path = parts.path or "/"
+            if parts.query:
+                path += "?" + parts.query
+            try:
+                conn, response = self._send(key, method, path, headers, body)
+            except (http.client.HTTPException, OSError) as e:
+                raise urllib.error.URLError(e)
+            response.pool_key = key
+            response.pool_conn = conn
+            if response.status in (301, 302, 303, 307, 308):
+                location = response.getheader("Location")
+                self.finish(response)
+                url = urllib.parse.urljoin(url, location)
+                continue
+            if response.status >= 400:
+                self.finish(response)
+                raise urllib.error.HTTPError(
+                    url, response.status, response.reason, response.headers, None
+                )
+            return response
+        raise urllib.error.URLError("Too many redirects: " + url)
+
+    def finish(self, response):
+        """Drain the response and return its connection to the pool."""
+        try:
+            response.read()
+        except OSError:
+            response.pool_conn.close()
+            return
+        if response.will_close:
+            response.pool_conn.close()
+        else:
+            self._release(response.pool_key, response.pool_conn)
+
+    def close(self):
+        with self.lock:
+            for conns in self.idle.values():
+                for conn in conns:
+                    conn.close()
+            self.idle.clear()
+
+
+http_pool = ConnectionPool()
+
+
+def download(url, file, sha256=None, chunk_size=1 << 20):
+    """Stream url into file, resuming a partial download with an HTTP Range
+    request. The SHA-256 of the data is computed as it is written; returns
+    the hex digest."""
+    import hashlib
+    import http.client
+    import urllib.error
+
+    digest = hashlib.sha256()
+    offset = 0
+    headers = {}
+    if os.path.exists(file):
+        with open(file, "rb") as f:
+            for chunk in iter(lambda: f.read(chunk_size), b""):
+                digest.update(chunk)
+                offset += len(chunk)
+        if offset:
+            headers["Range"] = "bytes=%d-" % offset
+
+    try:
+        response = http_pool.get(url, headers)
+    except urllib.error.HTTPError as e:
+        if e.code != 416 or not offset:
+            raise
+        # range not satisfiable, the partial file is unusable
+        os.remove(file)
+        return download(url, file, sha256, chunk_size)
+
+    try:
+        if offset and response.status == 206:
+            print("Resuming %s at byte %d" % (url, offset))
+            mode = "ab"
+        else:
+            digest = hashlib.sha256()
+            mode = "wb"
+        with open(file, mode) as f:
+            while True:
+                try:
+                    chunk = response.read(chunk_size)
+                except (http.client.HTTPException, OSError) as e:
+                    raise urllib.error.URLError(e)
+                if not chunk:
+                    break
+                digest.update(chunk)
+                f.write(chunk)
+    finally:
+        http_pool.finish(response)
+
+    if sha256 is not None and digest.hexdigest() != sha256:
+        os.remove(file)
+        raise urllib.error.URLError(
+            "sha256 mismatch for %s: expected %s, got %s"
+            % (url, sha256, digest.hexdigest())
+        )
+    return digest.hexdigest()
+
+
+def archive_pin(filename):
+    """The sha256 deps.json pins for an archive, None if it is unpinned."""
+    for dep in deps.values():
+        if dep["filename"] == filename and "sha256" in dep:
+            return dep["sha256"]
+    return None
+
+
+# digests of the unpinned archives hashed by this run
+unpinned_digests = {}
+
+
+def archive_sha256(filename):
+    """Return the SHA-256 of a cached archive. Pinned archives have it
+    recorded next to them once verified, unpinned ones are hashed again by
+    every run, as nothing vouches for a digest recorded earlier."""
+    file = os.path.join(depends_dir, filename)
+    sidecar = file + ".sha256"
+    if archive_pin(filename) is not None and os.path.exists(sidecar):
+        with open(sidecar, "r") as f:
+            return f.read().strip()
+    if filename not in unpinned_digests:
+        unpinned_digests[filename] = file_sha256(file)
+    return unpinned_digests[filename]
+
+
+# local directories, prefetch bundles and HTTP base URLs holding copies
+# of the archives, see --mirror
+mirrors = []
+
+
+def mirror_order(mirrors):
+    """Return the mirrors in the order they are tried: local directories
+    and bundles first, then HTTP mirrors, each in the order given."""
+    local = [m for m in mirrors if "://" not in m or m.startswith("file://")]
+    return local + [m for m in mirrors if m not in local]
+
+
+def read_sums(f):
+    """Parse a SHA256SUMS file object into {filename: digest}."""
+    sums = {}
+    for line in f.read().decode("utf-8").splitlines():
+        if line.strip():
+            digest, filename = line.split(None, 1)
+            sums[filename.lstrip("*")] = digest
+    return sums
+
+
+def fetch_from_mirror(mirror, filename, file, sha256=None, chunk_size=1 << 20):
+    """Copy filename from mirror into file, verifying it against sha256 or
+    the checksums shipped with the mirror. Returns the hex digest, or None
+    if the mirror does not have the archive."""
+    import hashlib
+    import tarfile
+    import urllib.error
     import urllib.request
+
+    if "://" in mirror and not mirror.startswith("file://"):
+        try:
+            return download(mirror.rstrip("/") + "/" + filename, file, sha256)
+        except urllib.error.HTTPError as e:
+            if e.code == 404:
+                return None
+            raise
+
+    path = mirror
+    if mirror.startswith("file://"):
+        path = urllib.request.url2pathname(mirror[7:])
+    bundle = None
+    sums = {}
+    if os.path.isdir(path):
+        source = os.path.join(path, filename)
+        if not os.path.isfile(source):
+            return None
+        if os.path.isfile(os.path.join(path, "SHA256SUMS")):
+            with open(os.path.join(path, "SHA256SUMS"), "rb") as f:
+                sums = read_sums(f)
+        src = open(source, "rb")
+    else:
+        # a bundle written by --prefetch
+        bundle = tarfile.open(path, "r:")
+        try:
+            sums = read_sums(bundle.extractfile("SHA256SUMS"))
+            src = bundle.extractfile(filename)
+        except KeyError:
+            bundle.close()
+            return None
+
+    expected = sha256 or sums.get(filename)
+    digest = hashlib.sha256()
+    try:
+        with src, open(file, "wb") as f:
+            for chunk in iter(lambda: src.read(chunk_size), b""):
+                digest.update(chunk)
+                f.write(chunk)
+    finally:
+        if bundle is not None:
+            bundle.close()
+    if expected is not None and digest.hexdigest() != expected:
+        os.remove(file)
+        raise urllib.error.URLError(
+            "sha256 mismatch for %s in %s: expected %s, got %s"
+            % (filename, mirror, expected, digest.hexdigest())
+        )
+    return digest.hexdigest()
+
+
+def fetch_dep(url, filename, sha256=None):
     import tarfile
-    import zipfile
+    import urllib.error
 
     file = os.path.join(depends_dir, filename)
-    if not os.path.exists(file):
+    if os.path.exists(file):
+        actual = archive_sha256(filename)
+        if sha256 is None:
+            return file
+        if actual == sha256:
+            if not os.path.exists(file + ".sha256"):
+                with open(file + ".sha256", "w") as f:
+                    f.write(actual)
+            return file
+        print("Cached %s does not match sha256 %s, fetching again" % (filename, sha256))
+        os.remove(file)
+        if os.path.exists(file + ".sha256"):
+            os.remove(file + ".sha256")
+
+    import time
+
+    # download to a temporary name, so an interrupted fetch never looks
+    # like a complete archive. Only a pinned download is resumed on the
+    # next attempt, the digest then tells whether the pieces fit together.
+    part = file + ".part"
+    if sha256 is None and os.path.exists(part):
+        os.remove(part)
+    start = time.time()
+    actual = None
+    for mirror in mirror_order(mirrors):
+        try:
+            actual = fetch_from_mirror(mirror, filename, part, sha256)
+        except (OSError, tarfile.TarError) as e:
+            print("Mirror %s failed for %s: %s" % (mirror, filename, e))
+            if os.path.exists(part):
+                os.remove(part)
+        if actual is not None:
+            print("Fetched %s from %s" % (filename, mirror))
+            break
+    else:
         ex = None
         for i in range(3):
             try:
                 print("Fetching %s (attempt %d)..." % (url, i + 1))
-                content = urllib.request.urlopen(url).read()
-                with open(file, "wb") as f:
-                    f.write(content)
+                if sha256 is None and os.path.exists(part):
+                    os.remove(part)
+                actual = download(url, part, sha256)
                 break
             except urllib.error.URLError as e:
                 ex = e
         else:
             raise RuntimeError(ex)
+    if sha256 is None:
+        print("No sha256 pinned for %s, got %s (record it with --pin)" % (filename, actual))
+        unpinned_digests[filename] = actual
+    else:
+        with open(file + ".sha256", "w") as f:
+            f.write(actual)
+    os.replace(part, file)
+    record_timing({
+        "archive": filename,
+        "stage": "download",
+        "seconds": time.time() - start,
+        "bytes": os.path.getsize(file),
+    })
+    return file
+
+
+def prefetch_deps(names, jobs=4):
+    """Download the archives of all given dependencies concurrently,
+    using at most `jobs` simultaneous transfers."""
+    from concurrent.futures import ThreadPoolExecutor
+
+    archives = {}
+    for name in names:
+        dep = deps[name]
+        archives.setdefault(dep["filename"], (dep["url"], dep.get("sha256")))
+
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+        futures = {
+            filename: pool.submit(fetch_dep, url, filename, sha256)
+            for filename, (url, sha256) in archives.items()
+        }
+    failed = []
+    for filename, future in futures.items():
+        if future.exception() is not None:
+            failed.append("%s (%s)" % (filename, future.exception()))
+    if failed:
+        raise RuntimeError("Failed to fetch: " + ", ".join(failed))
+
+
+def write_bundle(names, output, jobs=4):
+    """Fetch the archives of the given dependencies and pack them with a
+    SHA256SUMS file into one uncompressed tar usable as a --mirror.
+    Returns the number of archives."""
+    import io
+    import tarfile
+
+    prefetch_deps(names, jobs)
+    filenames = sorted({deps[name]["filename"] for name in names})
+    sums = "".join(
+        "%s  %s\n" % (archive_sha256(filename), filename) for filename in filenames
+    ).encode("utf-8")
+
+    def normalize(info):
+        # the same archives always give the same bundle
+        info.mtime = 0
+        info.mode = 0o644
+        info.uid = info.gid = 0
+        info.uname = info.gname = ""
+        return info
+
+    tmp = output + ".tmp"
+    with tarfile.open(tmp, "w", format=tarfile.PAX_FORMAT) as tf:
+        info = normalize(tarfile.TarInfo("SHA256SUMS"))
+        info.size = len(sums)
+        tf.addfile(info, io.BytesIO(sums))
+        for filename in filenames:
+            path = os.path.join(depends_dir, filename)
+            with open(path, "rb") as f:
+                tf.addfile(normalize(tf.gettarinfo(path, filename)), f)
+    os.replace(tmp, output)
+    return len(filenames)
+
+
+def pin_deps(path, names, jobs=4):
+    """Fetch the archives of the given dependencies which the deps.json at
+    path does not pin yet and record their digests in it, keeping its
+    layout. Whatever the mirrors or upstream serve is trusted, so run it on
+    a trusted network when an entry is added or updated. The archives
+    which could be fetched are pinned even if others fail, which raises
+    RuntimeError afterwards. Returns the names of the newly pinned entries."""
+    import json
+    import re
+
+    unpinned = [name for name in names if "sha256" not in deps[name]]
+    failed = None
+    try:
+        prefetch_deps(unpinned, jobs)
+    except RuntimeError as e:
+        failed = e
+        unpinned = [
+            name for name in unpinned if os.path.exists(os.path.join(depends_dir, deps[name]["filename"]))
+        ]
+    with open(path, "r", newline="") as f:
+        text = f.read()
+    table = json.loads(text)["deps"]
+    for name in unpinned:
+        filename = deps[name]["filename"]
+        digest = archive_sha256(filename)
+        start = text.index('"%s": {' % name)
+        pins = table[name].get("sha256")
+        if isinstance(pins, dict):
+            match = re.compile(r'"sha256": \{[^}]*\}').search(text, start)
+            value = json.dumps(dict(pins, **{filename: digest}), sort_keys=True)
+            text = text[:match.start()] + '"sha256": ' + value + text[match.end():]
+            continue
+        if "{" in table[name]["filename"]:
+            # the filename depends on an option
+            value = json.dumps({filename: digest})
+        else:
+            value = json.dumps(digest)
+        match = re.compile(r'\n( *)"filename": "[^"\n]*",').search(text, start)
+        text = "%s\n%s\"sha256\": %s,%s" % (
+            text[:match.end()], match.group(1), value, text[match.end():]
+        )
+    validate_deps(json.loads(text))
+    with open(path + ".tmp", "w", newline="") as f:
+        f.write(text)
+    os.replace(path + ".tmp", path)
+    if failed is not None:
+        raise RuntimeError("Pinned only %s. %s" % (", ".join(unpinned) or "nothing", failed))
+    return unpinned
+
+
+def member_filter(include=None, exclude=None):
+    """Return a predicate selecting archive member names matching any of the
+    include globs (all if None) and none of the exclude globs."""
+    from fnmatch import fnmatchcase
+
+    def selected(name):
+        if include and not any(fnmatchcase(name, pattern) for pattern in include):
+            return False
+        return not any(fnmatchcase(name, pattern) for pattern in exclude or ())
+
+    return selected
+
+
+tar_modes = {
+    ".tar.gz": "r|gz",
+    ".tgz": "r|gz",
+    ".tar.bz2": "r|bz2",
+    ".tar.xz": "r|xz",
+}
+
+
+def extract_dep(url, filename, dir=None, sha256=None, include=None, exclude=None, root=None):
+    import tarfile
+    import time
+    import zipfile
+
+    file = fetch_dep(url, filename, sha256)
+    start = time.time()
 
     print("Extracting " + filename)
+    if root is None:
+        root = build_dir
     if dir:
-        dir = os.path.join(build_dir, dir)
+        dir = os.path.join(root, dir)
     else:
-        dir = build_dir
+        dir = root
+    selected = member_filter(include, exclude)
+    count = 0
     if filename.endswith(".zip"):
         with zipfile.ZipFile(file) as zf:
-            zf.extractall(dir)
-    elif filename.endswith(".tar.gz") or filename.endswith(".tgz"):
-        with tarfile.open(file, "r:gz") as tgz:
-            tgz.extractall(dir)
+            for member in zf.infolist():
+                if selected(member.filename):
+                    zf.extract(member, dir)
+                    count += 1
+    else:
+        for suffix, mode in tar_modes.items():
+            if filename.endswith(suffix):
+                break
+        else:
+            raise RuntimeError("Unknown archive type: " + filename)
+        kwargs = {}
+        if hasattr(tarfile, "tar_filter"):
+            kwargs["filter"] = "tar"
+        # stream mode reads the archive once, without seeking back
+        with tarfile.open(file, mode) as tf:
+            for member in tf:
+                if selected(member.name):
+                    tf.extract(member, dir, **kwargs)
+                    count += 1
+    if verbose:
+        print("    %d members extracted from %s" % (count, filename))
+    record_timing({
+        "archive": filename,
+        "stage": "extract",
+        "seconds": time.time() - start,
+        "members": count,
+    })
+
+
+def rmtree_onerror(fn, path, excinfo):
+    if excinfo[0] is PermissionError and excinfo[1].winerror == 5:
+        os.chmod(path, stat.S_IWRITE)
+        fn(path)
     else:
-        raise RuntimeError("Unknown archive type: " + filename)
+        raise
+
+
+def dep_fingerprint(name, digest=archive_sha256):
+    """Hash everything that influences the build of a dependency.
+    Returns the hex digest and the hashed inputs. digest returns the
+    SHA-256 of an archive given its filename."""
+    import hashlib
+    import json
+    import re
+
+    dep = deps[name]
+    text = json.dumps([dep, prefs["header"]])
+    # only the architecture settings the entry uses, the build paths are
+    # left out so that artifacts can be shared between build trees
+    used = set(re.findall(r"\{(\w+)\}", text))
+    arch = dict(architectures[prefs["architecture"]], architecture=prefs["architecture"])
+    inputs = {
+        "dep": {key: value for key, value in dep.items() if key != "comment"},
+        # rebuild when anything we build against changed
+        "requires": {req: dep_fingerprint(req, digest)[0] for req in dep.get("requires", [])},
+        "archive": digest(dep["filename"]),
+        # the makefiles, headers and workloads the steps copy from here
+        "files": {
+            os.path.basename(path): file_sha256(path)
+            for path in repo_files()
+            if "{winbuild_dir}\\" + os.path.basename(path) in "\n".join(dep["build"])
+        },
+        "architecture": {key: value for key, value in arch.items() if key in used},
+        "msvs": {key: prefs[key] for key in ("vs_dir", "nmake", "header")},
+    }
+    blob = json.dumps(inputs, sort_keys=True).encode("utf-8")
+    return hashlib.sha256(blob).hexdigest(), inputs
+
+
+def load_manifest():
+    import json
+
+    try:
+        with open(os.path.join(build_dir, "manifest.json"), "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {"version": 1, "deps": {}}
+
+
+def save_manifest(manifest):
+    import json
+
+    name = os.path.join(build_dir, "manifest.json")
+    with open(name + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(name + ".tmp", name)
+
+
+def built_fingerprint(name):
+    """Fingerprint written by build_xxx.cmd after a successful build."""
+    try:
+        with open(os.path.join(build_dir, "build_%s.done" % name), "r") as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def repo_files():
+    """The files next to this script which build steps copy or use: the
+    makefiles, the training workloads and the headers."""
+    import glob
+
+    here = os.path.dirname(os.path.realpath(__file__))
+    return sorted(
+        glob.glob(os.path.join(here, "*.nmake")) + glob.glob(os.path.join(here, "*.sql"))
+        + glob.glob(os.path.join(here, "*.h"))
+    )
+
+
+def input_files(deps_file):
+    """Files whose contents affect the generated scripts besides the
+    archives: the dependency table, this script and repo_files()."""
+    return [deps_file, os.path.realpath(__file__)] + repo_files()
+
+
+def save_state(path, deps_file, options, fingerprints):
+    """Record what the scripts were generated from, for check_state."""
+    import json
+
+    state = {
+        "inputs": {file: file_sha256(file) for file in input_files(deps_file)},
+        "options": options,
+        "fingerprints": fingerprints,
+    }
+    with open(path + ".tmp", "w") as f:
+        json.dump(state, f, indent=2, sort_keys=True)
+    os.replace(path + ".tmp", path)
+
+
+def check_state(path, deps_file, options):
+    """Compare the inputs and options with the state recorded by the last
+    run and the build stamps. Returns a list of reasons to run again, empty
+    if everything is up to date. This needs neither the compiler nor the
+    network."""
+    import json
+
+    try:
+        with open(path, "r") as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return ["no recorded build state in " + path]
+    reasons = []
+    if state["options"] != options:
+        reasons.append("options changed")
+    for file in input_files(deps_file):
+        if state["inputs"].get(file) != file_sha256(file):
+            reasons.append("%s changed" % os.path.basename(file))
+    for arch_build_dir, fingerprints in state["fingerprints"].items():
+        for name, fingerprint in fingerprints.items():
+            try:
+                with open(os.path.join(arch_build_dir, "build_%s.done" % name), "r") as f:
+                    built = f.read().strip()
+            except OSError:
+                built = None
+            if built != fingerprint:
+                reasons.append("%s is not built" % name)
+    return reasons
 
 
 def write_script(name, lines):
@@ -439,59 +1149,1422 @@ def get_footer(dep):
     for out in dep.get("bins", []):
         lines.append(cmd_copy(out, "{bin_dir}"))
         lines.append("@if errorlevel 1 exit /B 1")
+    for src, tgt in dep.get("trees", []):
+        lines.append(cmd_xcopy(src, tgt))
+        lines.append("@if errorlevel 1 exit /B 1")
     return lines
 
 
-def build_dep(name):
+def native_path(path):
+    return path.replace("\\", os.sep)
+
+
+def script_dir(dep, prefs):
+    """Directory the footer of a build script runs in, following the
+    cd commands of its build steps."""
+    dir = os.path.join(prefs["build_dir"], dep["dir"])
+    for line in dep.get("build", []):
+        if line.startswith("cd /D "):
+            dir = os.path.join(dir, native_path(line[6:].format(**prefs)))
+        elif line.startswith("cd "):
+            dir = os.path.join(dir, native_path(line[3:].format(**prefs)))
+    return os.path.normpath(dir)
+
+
+def dep_outputs(name, prefs, strict=False):
+    """List the files installed by a dependency as (source, kind, path)
+    tuples, kind being one of "include", "lib" and "bin" and path being
+    relative to the corresponding output directory. If strict, raise
+    RuntimeError for patterns which match no file."""
+    import glob
+
+    dep = deps[name]
+    cwd = script_dir(dep, prefs)
+    outputs = []
+    for key, kind in (("headers", "include"), ("libs", "lib"), ("bins", "bin")):
+        for pattern in dep.get(key, []):
+            pattern = os.path.join(cwd, native_path(pattern.format(**prefs)))
+            sources = sorted(glob.glob(pattern))
+            if strict and not sources:
+                raise RuntimeError("%s: no file matches %s" % (name, pattern))
+            for src in sources:
+                outputs.append((src, kind, os.path.basename(src)))
+    out_dirs = {"include": prefs["inc_dir"], "lib": prefs["lib_dir"], "bin": prefs["bin_dir"]}
+    for src, tgt in dep.get("trees", []):
+        src = os.path.join(cwd, native_path(src.format(**prefs)))
+        tgt = native_path(tgt.format(**prefs))
+        for kind, out_dir in out_dirs.items():
+            if os.path.normcase(tgt).startswith(os.path.normcase(out_dir)):
+                prefix = os.path.relpath(tgt, out_dir)
+                break
+        else:
+            raise RuntimeError("%s installs outside of the output directories: %s" % (name, tgt))
+        if strict and not os.path.isdir(src):
+            raise RuntimeError("%s: directory not found: %s" % (name, src))
+        for root, dirs, files in os.walk(src):
+            dirs.sort()
+            for file in sorted(files):
+                path = os.path.relpath(os.path.join(root, file), src)
+                outputs.append(
+                    (os.path.join(root, file), kind, os.path.normpath(os.path.join(prefix, path)))
+                )
+    return outputs
+
+
+def reflink(src, dst):
+    """Clone src to dst sharing its data blocks (Linux FICLONE ioctl on
+    btrfs, XFS and similar). Raises OSError where that is not supported."""
+    try:
+        import fcntl
+    except ImportError:
+        raise OSError("reflinks are not supported on this platform")
+    FICLONE = 0x40049409
+    with open(src, "rb") as s, open(dst, "wb") as d:
+        try:
+            fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+        except OSError:
+            d.close()
+            os.remove(dst)
+            raise
+
+
+def install_file(src, dst, mode="link"):
+    """Install src as dst, with mode "link" preferring a reflink and
+    falling back to a copy. "hardlink" also tries a hard link before
+    copying, which shares the file with the build tree: a rebuild writing
+    it in place changes the installed file too. Returns the method used."""
+    if os.path.lexists(dst):
+        os.remove(dst)
+    if mode in ("link", "hardlink"):
+        try:
+            reflink(src, dst)
+            return "reflink"
+        except OSError:
+            pass
+    if mode == "hardlink":
+        try:
+            os.link(src, dst)
+            return "hardlink"
+        except OSError:
+            pass
+    shutil.copy2(src, dst)
+    return "copy"
+
+
+def install_outputs(outputs, out_dirs, manifest_path, mode="link"):
+    """Install outputs as listed by dep_outputs into out_dirs, writing only
+    files whose content changed, and record them in the JSON manifest at
+    manifest_path. Returns the manifest."""
+    import json
+
+    try:
+        with open(manifest_path, "r") as f:
+            previous = json.load(f)["files"]
+    except (OSError, ValueError, KeyError):
+        previous = {}
+
+    files = {}
+    for src, kind, rel in outputs:
+        key = kind + "/" + rel.replace(os.sep, "/")
+        dst = os.path.join(out_dirs[kind], rel)
+        digest = file_sha256(src)
+        method = None
+        if os.path.isfile(dst):
+            st = os.stat(dst)
+            old = previous.get(key)
+            # trust the manifest for files which were not touched since,
+            # hash the others
+            if old is not None and (old["size"], old["mtime"]) == (st.st_size, st.st_mtime):
+                current = old["sha256"]
+            else:
+                current = file_sha256(dst)
+            if current == digest:
+                method = "unchanged"
+        if method is None:
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+            method = install_file(src, dst, mode)
+            if verbose:
+                print("Installed %s (%s)" % (dst, method))
+        st = os.stat(dst)
+        files[key] = {
+            "sha256": digest,
+            "size": st.st_size,
+            "mtime": st.st_mtime,
+            "method": method,
+        }
+
+    manifest = {"version": 1, "files": files}
+    with open(manifest_path + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(manifest_path + ".tmp", manifest_path)
+    return manifest
+
+
+def install_dep(name, prefs, mode="link"):
+    """Install the outputs of a built dependency, see install_outputs."""
+    out_dirs = {"include": prefs["inc_dir"], "lib": prefs["lib_dir"], "bin": prefs["bin_dir"]}
+    manifest = install_outputs(
+        dep_outputs(name, prefs, strict=True),
+        out_dirs,
+        os.path.join(prefs["build_dir"], "installed_%s.json" % name),
+        mode,
+    )
+    methods = {}
+    for entry in manifest["files"].values():
+        methods[entry["method"]] = methods.get(entry["method"], 0) + 1
+    print("Installed %s: %s" % (
+        name, ", ".join("%d %s" % (n, method) for method, n in sorted(methods.items()))
+    ))
+
+
+# "link", "hardlink" and "copy" install with install_dep, "cmd" with copy /Y /B
+install_mode = "link"
+
+
+def get_install_step(name):
+    """Write the install plan of a dependency and return the script lines
+    running it."""
+    import json
+
+    plan = os.path.join(build_dir, "install_%s.json" % name)
+    with open(plan, "w") as f:
+        json.dump(
+            {"name": name, "dep": deps[name], "prefs": prefs, "mode": install_mode},
+            f,
+            indent=2,
+        )
+    return [
+        r'"{python}" "{winbuild_dir}\build_prepare.py" --install="%s"' % plan,
+        "@if errorlevel 1 exit /B 1",
+    ]
+
+
+# script libraries packed by pack_library
+tcltk_library = ["tcl8.6", "tk8.6"]
+
+
+def pack_library(lib_dir, output, names=tcltk_library, compress=False):
+    """Pack the directories names of lib_dir (by default the Tcl/Tk script
+    libraries) into the single zip file output, which Tcl can mount with
+    zipfs or a tclkit-style VFS instead of opening the loose files. The
+    zip is reproducible: members are sorted and carry a fixed timestamp.
+    Members are stored uncompressed unless compress is set, so mounting
+    them costs no inflating. Returns the number of files packed."""
+    import zipfile
+
+    tmp = output + ".tmp"
+    packed = 0
+    with zipfile.ZipFile(tmp, "w", zipfile.ZIP_DEFLATED if compress else zipfile.ZIP_STORED) as zf:
+        for name in names:
+            top = os.path.join(lib_dir, name)
+            if not os.path.isdir(top):
+                raise RuntimeError("Script library not found: " + top)
+            for root, dirs, files in os.walk(top):
+                dirs.sort()
+                for file in sorted(files):
+                    path = os.path.join(root, file)
+                    info = zipfile.ZipInfo(
+                        os.path.relpath(path, lib_dir).replace(os.sep, "/"),
+                        (1980, 1, 1, 0, 0, 0),
+                    )
+                    info.compress_type = zf.compression
+                    info.external_attr = 0o644 << 16
+                    with open(path, "rb") as f:
+                        zf.writestr(info, f.read())
+                    packed += 1
+    os.replace(tmp, output)
+    return packed
+
+
+def verify_library(lib_dir, output, names=tcltk_library):
+    """Check that the zip file output holds exactly the files of the
+    directories names of lib_dir, byte for byte. Returns a list of
+    differences, empty if they match."""
+    import zipfile
+
+    problems = []
+    loose = set()
+    for name in names:
+        for root, dirs, files in os.walk(os.path.join(lib_dir, name)):
+            for file in files:
+                loose.add(os.path.relpath(os.path.join(root, file), lib_dir).replace(os.sep, "/"))
+    with zipfile.ZipFile(output) as zf:
+        members = set(info.filename for info in zf.infolist() if not info.is_dir())
+        for member in sorted(members - loose):
+            problems.append("only in %s: %s" % (os.path.basename(output), member))
+        for member in sorted(loose - members):
+            problems.append("missing from %s: %s" % (os.path.basename(output), member))
+        for member in sorted(loose & members):
+            with open(os.path.join(lib_dir, native_path(member.replace("/", os.sep))), "rb") as f:
+                if f.read() != zf.read(member):
+                    problems.append("differs: " + member)
+    return problems
+
+
+# directories shipped to downstream builds by --release
+release_dirs = ["bin", "lib", "include"]
+
+
+def release_manifest(root, version, dirs=release_dirs):
+    """Describe the files of dirs under root: their sha256 and size by
+    "/"-separated path, and an id hashing all of them, which identifies
+    the content whatever the version is called."""
+    import hashlib
+    import json
+
+    files = {}
+    for name in dirs:
+        for dirpath, dirnames, filenames in os.walk(os.path.join(root, name)):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                files[os.path.relpath(path, root).replace(os.sep, "/")] = {
+                    "sha256": file_sha256(path),
+                    "size": os.path.getsize(path),
+                }
+    content = json.dumps(files, sort_keys=True).encode("utf-8")
+    return {
+        "format": 1,
+        "version": version,
+        "id": hashlib.sha256(content).hexdigest(),
+        "dirs": list(dirs),
+        "files": files,
+    }
+
+
+def read_release_manifest(path):
+    """Load a manifest from its JSON file or from a release bundle."""
+    import json
+    import tarfile
+
+    if tarfile.is_tarfile(path):
+        with tarfile.open(path, "r:*") as tf:
+            return json.loads(tf.extractfile("MANIFEST.json").read().decode("utf-8"))
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def write_release(root, output, version, base=None):
+    """Pack the release directories of root into the xz-compressed tar
+    output, with MANIFEST.json as first member, and write the manifest next
+    to it as well, named like output with .json instead of .tar.xz. Given the manifest of a previous release, the bundle is
+    a delta carrying only the added and changed files. Like the --prefetch
+    bundles, the same files always give the same bundle. Returns the
+    manifest."""
+    import io
+    import json
+    import tarfile
+
+    manifest = release_manifest(root, version)
+    files = manifest["files"]
+    if base is None:
+        manifest.update(kind="full", base=None, removed={})
+        carried = sorted(files)
+    else:
+        old = base["files"]
+        manifest.update(
+            kind="delta",
+            base={"version": base["version"], "id": base["id"]},
+            removed={path: old[path]["sha256"] for path in sorted(set(old) - set(files))},
+        )
+        carried = sorted(
+            path for path in files if path not in old or old[path]["sha256"] != files[path]["sha256"]
+        )
+    manifest["carried"] = carried
+    data = json.dumps(manifest, indent=1, sort_keys=True).encode("utf-8")
+
+    def normalize(info):
+        info.mtime = 0
+        info.mode = 0o644
+        info.uid = info.gid = 0
+        info.uname = info.gname = ""
+        return info
+
+    tmp = output + ".tmp"
+    with tarfile.open(tmp, "w:xz", format=tarfile.PAX_FORMAT) as tf:
+        info = normalize(tarfile.TarInfo("MANIFEST.json"))
+        info.size = len(data)
+        tf.addfile(info, io.BytesIO(data))
+        for path in carried:
+            src = os.path.join(root, native_path(path.replace("/", os.sep)))
+            with open(src, "rb") as f:
+                tf.addfile(normalize(tf.gettarinfo(src, path)), f)
+    os.replace(tmp, output)
+    with open(os.path.splitext(os.path.splitext(output)[0])[0] + ".json", "w") as f:
+        f.write(data.decode("utf-8"))
+    return manifest
+
+
+def apply_release(bundle, root):
+    """Update the release directories of root in place to the bundle.
+    Everything is verified before the tree is touched: a delta needs the
+    files it does not carry, and those it removes, to match their hashes,
+    and every carried file must match the manifest. Files already up to
+    date are not rewritten. Returns (written, removed) counts."""
+    import hashlib
+    import tarfile
+
+    manifest = read_release_manifest(bundle)
+    if manifest.get("format") != 1:
+        raise RuntimeError("Unknown release manifest format: %r" % manifest.get("format"))
+    files = manifest["files"]
+    carried = set(manifest["carried"])
+
+    def local(path):
+        return os.path.join(root, native_path(path.replace("/", os.sep)))
+
+    def current(path):
+        try:
+            return file_sha256(local(path))
+        except OSError:
+            return None
+
+    problems = []
+    removed = dict(manifest["removed"])
+    if manifest["kind"] == "full":
+        # anything else in the directories is not part of the release
+        stale = release_manifest(root, None, manifest["dirs"])["files"]
+        removed.update((path, stale[path]["sha256"]) for path in stale if path not in files)
+    else:
+        for path in sorted(set(files) - carried):
+            if current(path) != files[path]["sha256"]:
+                problems.append("not at %s: %s" % (manifest["base"]["version"], path))
+        for path, sha256 in sorted(removed.items()):
+            if current(path) not in (None, sha256):
+                problems.append("modified, not removing: " + path)
+    if problems:
+        raise RuntimeError(
+            "Cannot apply %s to %s:\n%s" % (os.path.basename(bundle), root, "\n".join(problems))
+        )
+
+    # stage the carried files next to their targets, then move them in
+    staged = []
+    try:
+        seen = set()
+        with tarfile.open(bundle, "r:*") as tf:
+            for info in tf:
+                if info.name == "MANIFEST.json":
+                    continue
+                if info.name not in carried or not info.isfile():
+                    raise RuntimeError("Unexpected member in %s: %s" % (bundle, info.name))
+                seen.add(info.name)
+                if current(info.name) == files[info.name]["sha256"]:
+                    continue
+                target = local(info.name)
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                tmp = target + ".release-tmp"
+                digest = hashlib.sha256()
+                src = tf.extractfile(info)
+                with open(tmp, "wb") as f:
+                    staged.append((tmp, target))
+                    for chunk in iter(lambda: src.read(1 << 20), b""):
+                        digest.update(chunk)
+                        f.write(chunk)
+                if digest.hexdigest() != files[info.name]["sha256"]:
+                    raise RuntimeError("sha256 mismatch of %s in %s" % (info.name, bundle))
+        if seen != carried:
+            raise RuntimeError("Missing from %s: %s" % (bundle, ", ".join(sorted(carried - seen))))
+    except BaseException:
+        for tmp, target in staged:
+            os.remove(tmp)
+        raise
+    for tmp, target in staged:
+        os.replace(tmp, target)
+    count = 0
+    for path in sorted(removed):
+        if os.path.exists(local(path)):
+            os.remove(local(path))
+            count += 1
+    return len(staged), count
+
+
+# headers each precompiled header of --pch includes, those missing from
+# the include directory are left out
+pch_libraries = {
+    "bz2": ["bzlib.h"],
+    "expat": ["expat.h"],
+    "ffi": ["ffi.h"],
+    "gc": ["gc.h"],
+    "lzma": ["lzma.h"],
+    "openssl": [
+        "openssl/ssl.h",
+        "openssl/err.h",
+        "openssl/evp.h",
+        "openssl/hmac.h",
+        "openssl/pem.h",
+        "openssl/pkcs12.h",
+        "openssl/rand.h",
+        "openssl/x509v3.h",
+    ],
+    "sqlite3": ["sqlite3.h"],
+    "tcl": ["tcl.h"],
+    "tk": ["tcl.h", "tk.h"],
+    "zlib": ["zlib.h"],
+}
+
+
+def header_index(inc_dir):
+    """Index the headers of inc_dir by "/"-separated path: the headers of
+    inc_dir each one includes, and the others (system headers), and all
+    headers in dependency order, included ones first. "" includes are
+    looked up next to the including header first. Cycles, which include
+    guards make harmless, are broken where they are found. Every #include
+    counts, whatever the conditions around it."""
+    import posixpath
+    import re
+
+    include_line = re.compile(rb'^[ \t]*#[ \t]*include[ \t]*([<"])([^>"]+)[>"]', re.M)
+    headers = {}
+    for root, dirs, files in os.walk(inc_dir):
+        for file in files:
+            if file.endswith((".h", ".H")):
+                rel = os.path.relpath(os.path.join(root, file), inc_dir).replace(os.sep, "/")
+                headers[rel] = None
+    for rel in sorted(headers):
+        includes = []
+        external = []
+        with open(os.path.join(inc_dir, native_path(rel.replace("/", os.sep))), "rb") as f:
+            found = include_line.findall(f.read())
+        for delim, name in found:
+            delim, name = delim.decode(), name.decode("latin-1")
+            candidates = [name]
+            if delim == '"' and "/" in rel:
+                candidates.insert(0, posixpath.normpath(posixpath.join(posixpath.dirname(rel), name)))
+            for candidate in candidates:
+                if candidate in headers:
+                    if candidate not in includes:
+                        includes.append(candidate)
+                    break
+            else:
+                if name not in external:
+                    external.append(name)
+        headers[rel] = {"includes": includes, "external": external}
+
+    order = []
+    seen = set()
+
+    def visit(rel):
+        seen.add(rel)
+        for dep in headers[rel]["includes"]:
+            if dep not in seen:
+                visit(dep)
+        order.append(rel)
+
+    for rel in sorted(headers):
+        if rel not in seen:
+            visit(rel)
+    return {"headers": headers, "order": order}
+
+
+def header_closure(index, roots):
+    """The headers of the index roots pull in, in dependency order."""
+    needed = set()
+    stack = list(roots)
+    while stack:
+        rel = stack.pop()
+        if rel not in needed:
+            needed.add(rel)
+            stack.extend(index["headers"][rel]["includes"])
+    return [rel for rel in index["order"] if rel in needed]
+
+
+def write_pch(inc_dir, output):
+    """Write the header index of inc_dir to output\\headers.json and, for
+    every library of pch_libraries, a stub header and source to build a
+    precompiled header from, with the compiler flags to build and use it in
+    output\\pch.json and an nmake snippet in output\\pch.nmake. Returns the
+    libraries written."""
+    import json
+
+    index = header_index(inc_dir)
+    os.makedirs(output, exist_ok=True)
+    libraries = {}
+    for name, wanted in sorted(pch_libraries.items()):
+        roots = [rel for rel in wanted if rel in index["headers"]]
+        if not roots:
+            continue
+        stub = "pch_%s.h" % name
+        source = "pch_%s.c" % name
+        pch = "pch_%s.pch" % name
+        with open(os.path.join(output, stub), "w") as f:
+            f.write("/* precompiled header of %s, generated by build_prepare.py --pch */\n" % name)
+            f.write("#ifndef PCH_%s_H\n#define PCH_%s_H\n" % (name.upper(), name.upper()))
+            for rel in roots:
+                f.write("#include <%s>\n" % rel)
+            f.write("#endif\n")
+        with open(os.path.join(output, source), "w") as f:
+            f.write('#include "%s"\n' % stub)
+        libraries[name] = {
+            "header": stub,
+            "source": source,
+            "depends": header_closure(index, roots),
+            # the flags must otherwise match those of the consumers
+            "msvc_create": ["/c", "/Yc" + stub, "/Fp" + pch, "/I" + inc_dir, source],
+            "msvc_use": ["/FI" + stub, "/Yu" + stub, "/Fp" + pch, "/I" + inc_dir],
+            "gcc_create": ["-x", "c-header", "-I" + inc_dir, stub, "-o", stub + ".gch"],
+            "gcc_use": ["-include", stub, "-I" + inc_dir],
+        }
+
+    with open(os.path.join(output, "pch.json"), "w") as f:
+        json.dump(libraries, f, indent=2, sort_keys=True)
+    with open(os.path.join(output, "pch.nmake"), "w") as f:
+        f.write("# generated by build_prepare.py --pch, !INCLUDE it and add $(PCH_<NAME>)\n")
+        f.write("# to the objects and $(PCH_<NAME>_FLAGS) to CFLAGS\n")
+        for name, lib in sorted(libraries.items()):
+            var = "PCH_" + name.upper()
+            pch = "pch_%s.pch" % name
+            depends = " ".join('"%s"' % os.path.join(inc_dir, native_path(rel.replace("/", os.sep)))
+                               for rel in lib["depends"])
+            f.write("\n%s=%s\n" % (var, pch))
+            f.write('%s_FLAGS=/FI"%s" /Yu"%s" /Fp"%s" /I"%s"\n' % (var, lib["header"], lib["header"], pch, inc_dir))
+            f.write("%s: %s %s\n" % (pch, lib["source"], depends))
+            f.write('\t$(CC) $(CFLAGS) /c /Yc"%s" /Fp"%s" /I"%s" %s\n' % (lib["header"], pch, inc_dir, lib["source"]))
+    with open(os.path.join(output, "headers.json"), "w") as f:
+        json.dump(index, f, indent=2, sort_keys=True)
+    return sorted(libraries)
+
+
+class ArtifactCache:
+    """Content-addressed store of the outputs of built dependencies, keyed by
+    their fingerprint. Entries are zip files written atomically, so several
+    build agents can share the directory. The least recently used entries are
+    evicted once the store grows beyond max_size bytes."""
+
+    def __init__(self, root, max_size=2 << 30):
+        self.root = root
+        self.max_size = max_size
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, fingerprint):
+        return os.path.join(self.root, fingerprint[:2], fingerprint + ".zip")
+
+    def has(self, fingerprint):
+        return os.path.isfile(self.path(fingerprint))
+
+    def store(self, fingerprint, outputs):
+        import zipfile
+
+        path = self.path(fingerprint)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = "%s.%d.%d.tmp" % (path, os.getpid(), threading.get_ident())
+        with zipfile.ZipFile(tmp, "w", zipfile.ZIP_DEFLATED) as zf:
+            for src, kind, rel in outputs:
+                zf.write(src, kind + "/" + rel.replace(os.sep, "/"))
+        os.replace(tmp, path)
+        self.evict()
+
+    def restore(self, fingerprint, out_dirs):
+        """Extract an entry into out_dirs, which maps each kind to a directory.
+        Returns False on a cache miss."""
+        import zipfile
+
+        path = self.path(fingerprint)
+        try:
+            zf = zipfile.ZipFile(path)
+        except (OSError, zipfile.BadZipFile):
+            return False
+        with zf:
+            for info in zf.infolist():
+                kind, rel = info.filename.split("/", 1)
+                tgt = os.path.join(out_dirs[kind], native_path(rel.replace("/", os.sep)))
+                os.makedirs(os.path.dirname(tgt), exist_ok=True)
+                # do not write through a hard link made by install_file
+                if os.path.lexists(tgt):
+                    os.remove(tgt)
+                with zf.open(info) as src, open(tgt, "wb") as f:
+                    shutil.copyfileobj(src, f)
+        # mark as recently used
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return True
+
+    def evict(self):
+        entries = []
+        for root, dirs, files in os.walk(self.root):
+            for file in files:
+                if file.endswith(".zip"):
+                    try:
+                        st = os.stat(os.path.join(root, file))
+                    except OSError:
+                        continue
+                    entries.append((st.st_mtime, st.st_size, os.path.join(root, file)))
+        total = sum(size for mtime, size, path in entries)
+        for mtime, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                # in use by another agent
+                continue
+            try:
+                # recorded by cache_server.py
+                os.remove(path + ".sha256")
+            except OSError:
+                pass
+            total -= size
+
+
+class RemoteCache:
+    """Shares the entries of a local ArtifactCache between build agents
+    through an HTTP server, such as cache_server.py, which answers GET, HEAD
+    and PUT of <url>/<fingerprint[:2]>/<fingerprint>.zip. Entries are pulled
+    into the local cache before they are restored and pushed once they are
+    stored. An unreachable server only costs the cache hits."""
+
+    def __init__(self, url, local, push=True, token=None, pool=None):
+        self.url = url.rstrip("/")
+        self.local = local
+        self.push = push
+        self.headers = {"Authorization": "Bearer " + token} if token else {}
+        self.pool = pool or http_pool
+        # fingerprint -> whether the server has it
+        self.remote = {}
+
+    def url_of(self, fingerprint):
+        return "%s/%s/%s.zip" % (self.url, fingerprint[:2], fingerprint)
+
+    def lookup(self, fingerprint):
+        import urllib.error
+
+        try:
+            response = self.pool.request("HEAD", self.url_of(fingerprint), self.headers)
+        except urllib.error.HTTPError as e:
+            if e.code != 404:
+                print("Remote cache lookup of %s failed: %s" % (fingerprint, e))
+            return False
+        except urllib.error.URLError as e:
+            print("Remote cache lookup of %s failed: %s" % (fingerprint, e))
+            return False
+        self.pool.finish(response)
+        return True
+
+    def probe(self, fingerprints, jobs=4):
+        """Look up the entries missing from the local cache concurrently."""
+        from concurrent.futures import ThreadPoolExecutor
+
+        wanted = [fp for fp in set(fingerprints) if fp not in self.remote and not self.local.has(fp)]
+        with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+            for fp, found in zip(wanted, pool.map(self.lookup, wanted)):
+                self.remote[fp] = found
+
+    def has(self, fingerprint):
+        if self.local.has(fingerprint):
+            return True
+        if fingerprint not in self.remote:
+            self.remote[fingerprint] = self.lookup(fingerprint)
+        return self.remote[fingerprint]
+
+    def pull(self, fingerprint, chunk_size=1 << 20):
+        """Download an entry into the local cache, verifying the SHA-256 the
+        server sends as ETag. Returns False if that failed."""
+        import hashlib
+        import http.client
+        import urllib.error
+
+        if self.local.has(fingerprint):
+            return True
+        path = self.local.path(fingerprint)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = "%s.%d.%d.tmp" % (path, os.getpid(), threading.get_ident())
+        digest = hashlib.sha256()
+        try:
+            response = self.pool.get(self.url_of(fingerprint), self.headers)
+            try:
+                with open(tmp, "wb") as f:
+                    for chunk in iter(lambda: response.read(chunk_size), b""):
+                        digest.update(chunk)
+                        f.write(chunk)
+            finally:
+                self.pool.finish(response)
+            expected = (response.getheader("ETag") or "").strip('"')
+            if expected and expected != digest.hexdigest():
+                raise urllib.error.URLError("sha256 mismatch for " + self.url_of(fingerprint))
+            os.replace(tmp, path)
+        except (http.client.HTTPException, OSError) as e:
+            print("Remote cache download of %s failed: %s" % (fingerprint, e))
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            return False
+        self.local.evict()
+        return True
+
+    def pull_all(self, fingerprints, jobs=4):
+        """Download entries concurrently, returns those now available."""
+        from concurrent.futures import ThreadPoolExecutor
+
+        fingerprints = sorted(set(fingerprints))
+        with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+            return set(fp for fp, ok in zip(fingerprints, pool.map(self.pull, fingerprints)) if ok)
+
+    def restore(self, fingerprint, out_dirs):
+        return self.pull(fingerprint) and self.local.restore(fingerprint, out_dirs)
+
+    def store(self, fingerprint, outputs):
+        import urllib.error
+
+        self.local.store(fingerprint, outputs)
+        if not self.push:
+            return
+        path = self.local.path(fingerprint)
+        headers = dict(self.headers)
+        try:
+            headers["Content-Length"] = str(os.path.getsize(path))
+            headers["X-Content-SHA256"] = file_sha256(path)
+            with open(path, "rb") as f:
+                response = self.pool.request("PUT", self.url_of(fingerprint), headers, f)
+            self.pool.finish(response)
+            self.remote[fingerprint] = True
+        except (urllib.error.URLError, OSError) as e:
+            # evicted already, or the server is away
+            print("Remote cache upload of %s failed: %s" % (fingerprint, e))
+
+
+def file_sha256(path):
+    import hashlib
+
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def apply_patches(path, patches):
+    """Replace all keys of patches by their values in a single pass over the
+    file. Raises RuntimeError if any pattern does not match. Returns the
+    number of matches per pattern."""
+    import re
+
+    with open(path, "r") as f:
+        text = f.read()
+    # longest first, so that a pattern which is a prefix of another
+    # does not shadow it
+    matcher = re.compile(
+        "|".join(re.escape(p) for p in sorted(patches, key=len, reverse=True))
+    )
+    counts = dict.fromkeys(patches, 0)
+
+    def replace(match):
+        counts[match.group(0)] += 1
+        return patches[match.group(0)]
+
+    text = matcher.sub(replace, text)
+    for pattern, n in counts.items():
+        if verbose:
+            print("    %d x %r" % (n, pattern[:60]))
+    missing = [pattern for pattern, n in counts.items() if n == 0]
+    if missing:
+        raise RuntimeError(
+            "Patch failed for %s, no match for: %s" % (path, ", ".join(repr(p) for p in missing))
+        )
+
+    # replace rather than rewrite the file, it may be hard linked to the
+    # shared source cache
+    with open(path + ".tmp", "w") as f:
+        f.write(text)
+    os.replace(path + ".tmp", path)
+    return counts
+
+
+# shared directory of extracted, unpatched sources, used when preparing
+# several architectures at once; None extracts straight into build_dir
+source_cache_dir = None
+source_cache_locks = {}
+source_cache_lock = threading.Lock()
+
+
+def tree_stats(root):
+    """Map the files below root to their size and modification time."""
+    stats = {}
+    for dir, dirs, files in os.walk(root):
+        for file in files:
+            st = os.stat(os.path.join(dir, file))
+            stats[os.path.relpath(os.path.join(dir, file), root)] = [st.st_size, st.st_mtime_ns]
+    return stats
+
+
+def cached_source(name):
+    """Extract the archive of a dependency into the source cache, once.
+    The build trees hard link to it, so a file written in place through
+    one of them changes the cache: such a cache is extracted again.
+    Returns the extracted tree."""
+    import json
+
+    dep = deps[name]
+    root = os.path.join(source_cache_dir, name)
+    stamp = json.dumps([
+        archive_sha256(dep["filename"]),
+        dep.get("extract-include"),
+        dep.get("extract-exclude"),
+    ])
+    with source_cache_lock:
+        lock = source_cache_locks.setdefault(name, threading.Lock())
+    with lock:
+        try:
+            with open(root + ".stamp", "r") as f:
+                current = f.readline().rstrip("\n") == stamp
+                if current and json.loads(f.readline()) != tree_stats(root):
+                    print("The source cache of %s was modified in place, extracting it again" % name)
+                    current = False
+        except (OSError, ValueError):
+            current = False
+        if not current:
+            if os.path.isdir(root):
+                shutil.rmtree(root, onerror=rmtree_onerror)
+            extract_dep(
+                dep["url"],
+                dep["filename"],
+                dep["dir"] if dep.get("dir-create", False) else None,
+                dep.get("sha256"),
+                dep.get("extract-include"),
+                dep.get("extract-exclude"),
+                root,
+            )
+            with open(root + ".stamp", "w") as f:
+                f.write(stamp + "\n" + json.dumps(tree_stats(root)))
+    return os.path.join(root, dep["dir"])
+
+
+def private_files(dep):
+    """Patterns, relative to the tree of dep, of the files its patches or
+    build steps may write in place: the patched files and the outputs."""
+    tree = os.path.join(build_dir, dep["dir"])
+    cwd = os.path.relpath(script_dir(dep, prefs), tree)
+    patterns = [native_path(file.format(**prefs)) for file in dep.get("patch", {})]
+    for key in ("headers", "libs", "bins"):
+        for pattern in dep.get(key, []):
+            patterns.append(os.path.normpath(os.path.join(cwd, native_path(pattern.format(**prefs)))))
+    for src, tgt in dep.get("trees", []):
+        src = os.path.normpath(os.path.join(cwd, native_path(src.format(**prefs))))
+        patterns.append(os.path.join(src, "*"))
+    return patterns
+
+
+def link_tree(src, dst, private=()):
+    """Recreate the tree src at dst with hard links, copying the files
+    where the file system does not support them. Files matching one of the
+    private patterns (relative to dst) are always copied."""
+    import fnmatch
+
+    def link(a, b):
+        rel = os.path.relpath(b, dst)
+        if not any(fnmatch.fnmatch(rel, pattern) for pattern in private):
+            try:
+                os.link(a, b)
+                return
+            except OSError:
+                pass
+        shutil.copy2(a, b)
+
+    shutil.copytree(src, dst, copy_function=link)
+
+
+def prepare_dep(name):
+    """Extract and patch the sources of a dependency."""
     dep = deps[name]
     dir = dep["dir"]
-    file = "build_{name}.cmd".format(**locals())
 
-    extract_dep(dep["url"], dep["filename"], dep["dir"] if dep.get("dir-create", False) else None)
+    # start from a pristine tree, the previous one may be patched or built
+    if os.path.isdir(os.path.join(build_dir, dir)):
+        shutil.rmtree(os.path.join(build_dir, dir), onerror=rmtree_onerror)
+    if source_cache_dir is None:
+        extract_dep(
+            dep["url"],
+            dep["filename"],
+            dep["dir"] if dep.get("dir-create", False) else None,
+            dep.get("sha256"),
+            dep.get("extract-include"),
+            dep.get("extract-exclude"),
+        )
+    else:
+        link_tree(cached_source(name), os.path.join(build_dir, dir), private_files(dep))
 
     for patch_file, patch_list in dep.get("patch", {}).items():
         if verbose:
             print("Patching " + patch_file)
-        patch_file = os.path.join(build_dir, dir, patch_file.format(**prefs))
-        with open(patch_file, "r") as f:
-            text = f.read()
-        for patch_from, patch_to in patch_list.items():
-            text = text.replace(patch_from.format(**prefs), patch_to.format(**prefs))
-        with open(patch_file, "w") as f:
-            f.write(text)
+        patch_file = os.path.join(build_dir, dir, native_path(patch_file.format(**prefs)))
+        apply_patches(
+            patch_file,
+            {
+                patch_from.format(**prefs): patch_to.format(**prefs)
+                for patch_from, patch_to in patch_list.items()
+            },
+        )
+
+
+def timed_steps(name, steps):
+    """Wrap every command in steps with start and end records appended to
+    timings/build_xxx.jsonl. The commands themselves are listed in
+    timings/build_xxx.steps.json, records refer to them by index."""
+    import json
+
+    log = '@>>"{build_dir}\\timings\\build_%s.jsonl" echo ' % name
+    record = '{{"step": %d, "event": "%s", "time": "%%TIME%%"%s}}'
+    commands = []
+    lines = ['@if not exist "{build_dir}\\timings" mkdir "{build_dir}\\timings"']
+    for step in steps:
+        if step.startswith("@"):
+            # echo, errorlevel checks
+            lines.append(step)
+            continue
+        lines.append(log + record % (len(commands), "start", ""))
+        lines.append(step)
+        lines.append(log + record % (len(commands), "end", ', "exit": %ERRORLEVEL%'))
+        commands.append(step.format(**prefs))
+    os.makedirs(timings_dir, exist_ok=True)
+    with open(os.path.join(timings_dir, "build_%s.steps.json" % name), "w") as f:
+        json.dump(commands, f, indent=2)
+    return lines
+
+
+def build_dep(name, fingerprint=None):
+    dep = deps[name]
+    dir = dep["dir"]
+    file = "build_{name}.cmd".format(**locals())
 
     banner = "Building {name} ({dir})".format(**locals())
+    steps = [
+        "cd /D %s" % os.path.join(build_dir, dir),
+        *prefs["header"],
+        *dep.get("build", []),
+        *(get_footer(dep) if install_mode == "cmd" else get_install_step(name)),
+    ]
+    if timings_dir is not None:
+        steps = timed_steps(name, steps)
     lines = [
         "@echo " + ("=" * 70),
         "@echo ==== {:<60} ====".format(banner),
         "@echo " + ("=" * 70),
-        "cd /D %s" % os.path.join(build_dir, dir),
-        *prefs["header"],
-        *dep.get("build", []),
-        *get_footer(dep),
+        *steps,
     ]
+    if fingerprint is not None:
+        lines.append(r'@echo {}> "{{build_dir}}\build_{}.done"'.format(fingerprint, name))
 
     write_script(file, lines)
     return file
 
 
-def build_all():
+def build_all(jobs=4):
+    """Fetch, extract and patch the changed dependencies and write their
+    build scripts. Up to `jobs` downloads and `jobs` extractions run
+    concurrently, each dependency is extracted as soon as its own archive
+    is there, while others are still downloading."""
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+
     lines = ["@echo on"]
+    scripts = {}
     enabled = []
+    unchanged = []
     skipped = []
-    for dep_name in deps:
-        if dep_name in disabled:
-            skipped.append(dep_name)
-            continue
-        enabled.append(dep_name)
-        lines.append(r'cmd.exe /c "{{build_dir}}\{}"'.format(build_dep(dep_name)))
+    manifest = load_manifest()
+    # separate pools, so that extractions do not queue up behind downloads
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as download_pool, \
+            ThreadPoolExecutor(max_workers=max(1, jobs)) as prepare_pool:
+        downloads = {}
+        waiting = {}
+        for dep_name in deps:
+            if dep_name in disabled:
+                skipped.append(dep_name)
+                continue
+            dep = deps[dep_name]
+            if dep["filename"] not in waiting:
+                future = download_pool.submit(fetch_dep, dep["url"], dep["filename"], dep.get("sha256"))
+                downloads[future] = dep["filename"]
+            waiting.setdefault(dep["filename"], []).append(dep_name)
+
+        preparing = []
+        for future in as_completed(downloads):
+            # the fingerprint needs the archive digest
+            future.result()
+            for dep_name in waiting[downloads[future]]:
+                fingerprint, inputs = dep_fingerprint(dep_name)
+                manifest["deps"][dep_name] = {"fingerprint": fingerprint, "inputs": inputs}
+                if built_fingerprint(dep_name) == fingerprint:
+                    unchanged.append(dep_name)
+                    continue
+                enabled.append(dep_name)
+                preparing.append(prepare_pool.submit(prepare_dep, dep_name))
+        for future in preparing:
+            future.result()
+
+    # in the order of deps, whichever archive came first
+    enabled = [dep_name for dep_name in deps if dep_name in enabled]
+    unchanged = [dep_name for dep_name in deps if dep_name in unchanged]
+    for dep_name in enabled:
+        scripts[dep_name] = build_dep(dep_name, manifest["deps"][dep_name]["fingerprint"])
+        lines.append(r'cmd.exe /c "{{build_dir}}\{}"'.format(scripts[dep_name]))
         lines.append("@if errorlevel 1 @echo Build failed! && exit /B 1")
     lines.append("@echo All PyPy dependencies built successfully!")
     write_script("build_all.cmd", lines)
+    save_manifest(manifest)
 
     print()
     print("Finished writing scripts for: " + ", ".join(enabled))
+    print("Unchanged since last build: " + ", ".join(unchanged))
     print("Skipped disabled targets: " + ", ".join(skipped))
+    return scripts
+
+
+def parse_cmd_time(value):
+    """Seconds since midnight of a cmd.exe %TIME% value such as " 9:05:01.23"."""
+    hours, minutes, seconds = value.strip().split(":")
+    return int(hours) * 3600 + int(minutes) * 60 + float(seconds.replace(",", "."))
+
+
+def timing_report(directory):
+    """Aggregate the timing records in directory. Returns a dict mapping each
+    dependency to its download, extract and build times in seconds and its
+    list of build steps. Only the latest run of each dependency is used."""
+    import json
+
+    archives = {}
+    for name, dep in deps.items():
+        archives.setdefault(dep["filename"], []).append(name)
+    report = {}
+
+    def entry(name):
+        return report.setdefault(
+            name, {"download": None, "extract": None, "build": None, "steps": []}
+        )
+
+    try:
+        files = sorted(os.listdir(directory))
+    except OSError:
+        return report
+    if "prepare.jsonl" in files:
+        with open(os.path.join(directory, "prepare.jsonl"), "r") as f:
+            for line in f:
+                record = json.loads(line)
+                for name in archives.get(record["archive"], [record["archive"]]):
+                    entry(name)[record["stage"]] = record["seconds"]
+
+    for file in files:
+        if not (file.startswith("build_") and file.endswith(".jsonl")):
+            continue
+        name = file[6:-6]
+        try:
+            with open(os.path.join(directory, "build_%s.steps.json" % name), "r") as f:
+                commands = json.load(f)
+        except (OSError, ValueError):
+            commands = []
+        steps = []
+        starts = {}
+        with open(os.path.join(directory, file), "r") as f:
+            for line in f:
+                record = json.loads(line)
+                step = record["step"]
+                time = parse_cmd_time(record["time"])
+                if record["event"] == "start":
+                    if step == 0:
+                        # a new run of the script
+                        steps = []
+                    starts[step] = time
+                    continue
+                if step not in starts:
+                    continue
+                seconds = time - starts.pop(step)
+                if seconds < 0:
+                    # ran past midnight
+                    seconds += 24 * 3600
+                steps.append({
+                    "step": step,
+                    "command": commands[step] if step < len(commands) else None,
+                    "seconds": seconds,
+                    "exit": record.get("exit"),
+                })
+        entry(name)["steps"] = steps
+        entry(name)["build"] = sum(step["seconds"] for step in steps)
+    return report
+
+
+def print_timing_report(report):
+    def fmt(seconds):
+        return "       -" if seconds is None else "{:7.1f}s".format(seconds)
+
+    print("{:<20} {:>8} {:>8} {:>8}".format("dependency", "download", "extract", "build"))
+    for name, entry in report.items():
+        print("{:<20} {} {} {}".format(
+            name, fmt(entry["download"]), fmt(entry["extract"]), fmt(entry["build"])
+        ))
+    for name, entry in report.items():
+        if not entry["steps"]:
+            continue
+        print()
+        print(name + ":")
+        for step in entry["steps"]:
+            status = "" if not step["exit"] else " (exit %s)" % step["exit"]
+            print("    {} {}{}".format(fmt(step["seconds"]), step["command"], status))
+
+
+def diff_inputs(old, new, path=""):
+    """List the dotted paths of the values which differ between the
+    fingerprint inputs old and new."""
+    if isinstance(old, dict) and isinstance(new, dict):
+        changed = []
+        for key in sorted(set(old) | set(new)):
+            changed += diff_inputs(old.get(key), new.get(key), path + "." + key if path else key)
+        return changed
+    if isinstance(old, list) and isinstance(new, list) and len(old) == len(new):
+        changed = []
+        for i, (a, b) in enumerate(zip(old, new)):
+            changed += diff_inputs(a, b, "%s[%d]" % (path, i))
+        return changed
+    return [] if old == new else [path]
+
+
+def plan_builds(artifact_cache=None, jobs=1):
+    """Work out what preparing and building would do, without touching the
+    network or the build tree: the status of each dependency and why it is
+    rebuilt, whether its archive and artifact are cached, and the expected
+    duration from the recorded timings. Returns a JSON serializable dict."""
+    import json
+
+    manifest = load_manifest()
+    history = timing_report(os.path.join(build_dir, "timings"))
+    cache = None
+    if artifact_cache is not None and os.path.isdir(artifact_cache):
+        cache = ArtifactCache(artifact_cache)
+
+    def digest(filename):
+        # the pin, else the digest of the cached archive, None when an
+        # unpinned archive is not there
+        if archive_pin(filename) is not None:
+            return archive_pin(filename)
+        if os.path.exists(os.path.join(depends_dir, filename)):
+            return archive_sha256(filename)
+        return None
+
+    entries = {}
+    fingerprints = {}
+    for name, dep in deps.items():
+        entry = entries[name] = {"status": "disabled", "reasons": [], "estimate": None}
+        if name in disabled:
+            continue
+        file = os.path.join(depends_dir, dep["filename"])
+        if os.path.exists(file):
+            entry["archive"] = "cached"
+        elif os.path.exists(file + ".part"):
+            entry["archive"] = "partial"
+        else:
+            entry["archive"] = "missing"
+        fingerprint, inputs = dep_fingerprint(name, digest)
+        inputs = json.loads(json.dumps(inputs))
+        entry["fingerprint"] = fingerprints[name] = fingerprint
+        if built_fingerprint(name) == fingerprint:
+            entry["status"] = "up to date"
+            continue
+        entry["status"] = "build"
+        recorded = manifest["deps"].get(name)
+        if inputs["archive"] is None:
+            entry["reasons"].append("archive digest unknown until it is downloaded")
+        if recorded is None:
+            entry["reasons"].append("never prepared")
+        elif recorded["fingerprint"] != fingerprint:
+            entry["reasons"] += ["changed " + path for path in diff_inputs(recorded["inputs"], inputs)]
+        else:
+            entry["reasons"].append("prepared but not built")
+
+    scripts = [name for name in entries if entries[name]["status"] == "build"]
+    restorable = set()
+    if cache is not None:
+        requires = {name: deps[name].get("requires", []) for name in scripts}
+        restorable = restorable_deps(scripts, requires, cache, fingerprints)
+    for name in scripts:
+        entry = entries[name]
+        entry["artifact"] = None if cache is None else "hit" if name in restorable else "miss"
+        if name in restorable:
+            entry["status"] = "restore"
+
+    # expected seconds of the work left for each dependency, None if
+    # there is no recorded timing for some of it
+    unknown = []
+    for name in scripts:
+        entry = entries[name]
+        recorded = history.get(name, {})
+        stages = ["extract", "build"] if entry["status"] == "build" else []
+        if entry["archive"] != "cached":
+            stages.insert(0, "download")
+        seconds = [recorded.get(stage) for stage in stages]
+        if None in seconds:
+            unknown.append(name)
+        else:
+            entry["estimate"] = sum(seconds)
+
+    # longest chain of work through the requirements, listed in build order
+    finish = {}
+    for name, dep in deps.items():
+        start = max([finish.get(req, 0.0) for req in dep.get("requires", [])] or [0.0])
+        finish[name] = start + (entries[name]["estimate"] or 0.0)
+    serial = sum(entry["estimate"] or 0.0 for entry in entries.values())
+    critical_path = max(finish.values() or [0.0])
+    seconds = max(critical_path, serial / max(1, jobs))
+    if unknown:
+        # a partial sum would look like an estimate
+        seconds = serial = critical_path = None
+    counts = {}
+    for entry in entries.values():
+        counts[entry["status"]] = counts.get(entry["status"], 0) + 1
+    return {
+        "architecture": prefs["architecture"],
+        "build_dir": build_dir,
+        "deps": entries,
+        "counts": counts,
+        "downloads": sorted(set(
+            deps[name]["filename"] for name, entry in entries.items()
+            if entry.get("archive") in ("missing", "partial")
+        )),
+        "estimate": {
+            "jobs": jobs,
+            "seconds": seconds,
+            "serial": serial,
+            "critical_path": critical_path,
+            "unknown": unknown,
+        },
+    }
+
+
+def print_plan(plan):
+    def fmt(seconds):
+        if seconds is None:
+            return "?"
+        return "%dm%02ds" % divmod(int(round(seconds)), 60)
+
+    print("Plan for %s in %s" % (plan["architecture"], plan["build_dir"]))
+    for name, entry in plan["deps"].items():
+        details = ""
+        if entry["status"] in ("build", "restore"):
+            details = "archive %-8s artifact %-5s ~%s" % (
+                entry["archive"], entry["artifact"] or "-", fmt(entry["estimate"])
+            )
+        print("  {:<20} {:<11} {}".format(name, entry["status"], details).rstrip())
+        for reason in entry["reasons"]:
+            print("      " + reason)
+    print(", ".join("%d %s" % (n, status) for status, n in sorted(plan["counts"].items())))
+    if plan["downloads"]:
+        print("To download: " + ", ".join(plan["downloads"]))
+    estimate = plan["estimate"]
+    if estimate["unknown"]:
+        print("No estimate, there are no recorded timings for " + ", ".join(estimate["unknown"])
+              + ", run with --timings")
+    else:
+        print("Estimated %s with %d jobs (critical path %s, serial %s)" % (
+            fmt(estimate["seconds"]), estimate["jobs"],
+            fmt(estimate["critical_path"]), fmt(estimate["serial"]),
+        ))
+
+
+def script_command(script):
+    if os.name == "nt":
+        return ["cmd.exe", "/c", script]
+    return ["sh", script]
+
+
+def run_build_script(name, script):
+    """Run one build script, logging its output to build_xxx.log."""
+    script = os.path.join(build_dir, script)
+    log = os.path.splitext(script)[0] + ".log"
+    with open(log, "wb") as f:
+        return subprocess.call(
+            script_command(script),
+            stdout=f,
+            stderr=subprocess.STDOUT,
+            cwd=os.path.dirname(script),
+        )
+
+
+def restorable_deps(scripts, requires, cache, fingerprints):
+    """The dependencies which can be restored from the artifact cache."""
+    hits = set(name for name in scripts if cache.has(fingerprints[name]))
+    # a dependency that is rebuilt may need the build tree of what it
+    # requires (e.g. Tk uses TCLDIR), so only restore those too if the
+    # dependent is restored
+    return set(
+        name for name in hits
+        if all(name not in requires[other] or other in hits for other in scripts)
+    )
+
+
+def cached_build_script(cache, restorable, fingerprints, prefs):
+    """Wrap run_build_script to restore dependencies in restorable from the
+    artifact cache instead of building them, and to store what was built.
+    prefs are those of the architecture the scripts were written for."""
+    out_dirs = {"include": prefs["inc_dir"], "lib": prefs["lib_dir"], "bin": prefs["bin_dir"]}
+
+    def run(name, script):
+        fingerprint = fingerprints[name]
+        if name in restorable and cache.restore(fingerprint, out_dirs):
+            print("Restored %s from the artifact cache" % name)
+            with open(os.path.join(prefs["build_dir"], "build_%s.done" % name), "w") as f:
+                f.write(fingerprint)
+            return 0
+        result = run_build_script(name, script)
+        if result == 0:
+            cache.store(fingerprint, dep_outputs(name, prefs))
+        return result
+
+    return run
+
+
+def schedule_builds(scripts, requires, jobs=1, run=run_build_script):
+    """Run the build scripts concurrently, starting each dependency once all
+    the dependencies it requires have been built. No new builds are started
+    after the first failure. Returns a dict mapping each name to its status."""
+    import time
+    from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+    # requirements which are not being built now are built already
+    pending = {
+        name: set(req for req in requires.get(name, []) if req in scripts)
+        for name in scripts
+    }
+    status = {name: "skipped" for name in scripts}
+    elapsed = {}
+    running = {}
+    failed = False
+
+    def timed_run(name):
+        start = time.monotonic()
+        try:
+            return run(name, scripts[name])
+        finally:
+            elapsed[name] = time.monotonic() - start
+
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+        while True:
+            if not failed:
+                ready = [name for name, reqs in pending.items() if not reqs]
+                for name in ready[: max(1, jobs) - len(running)]:
+                    del pending[name]
+                    print("Starting build of " + name)
+                    status[name] = "running"
+                    running[pool.submit(timed_run, name)] = name
+            if not running:
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                if future.exception() is None and future.result() == 0:
+                    status[name] = "ok"
+                    for reqs in pending.values():
+                        reqs.discard(name)
+                else:
+                    status[name] = "failed"
+                    failed = True
+                print("Finished build of %s: %s" % (name, status[name]))
+
+    if pending and not failed:
+        raise RuntimeError("Circular requirements between: " + ", ".join(sorted(pending)))
+
+    print()
+    print("Build summary:")
+    for name in scripts:
+        if name in elapsed:
+            print("    {:<20} {:<8} {:8.1f}s".format(name, status[name], elapsed[name]))
+        else:
+            print("    {:<20} {}".format(name, status[name]))
+    return status
 
 
 if __name__ == "__main__":
@@ -502,11 +2575,34 @@ if __name__ == "__main__":
     winbuild_dir = os.path.dirname(os.path.realpath(__file__))
 
     verbose = False
-    disabled = ["openssl"]
+    disabled = ["openssl", "bdwgc", "libatomic_ops", "zlib-ng"]
     depends_dir = os.path.join(winbuild_dir, "cache")
     architecture = "x64"
     build_dir = os.path.join(winbuild_dir, "build")
     force_tk = False
+    fetch_jobs = 4
+    clean = False
+    run_build = False
+    artifact_cache = None
+    remote_cache = None
+    remote_push = True
+    timings = False
+    report = False
+    deps_file = os.path.join(winbuild_dir, "deps.json")
+    check = False
+    install_plan = None
+    pack = None
+    verify_pack = None
+    release = None
+    release_base = None
+    apply_bundle = None
+    pch_dir = None
+    prefetch = None
+    pin = False
+    plan = None
+    dep_options = {}
+    artifact_cache_size = 2048
+    jobs = os.cpu_count() or 1
     for arg in sys.argv[1:]:
         if arg == "-v":
             verbose = True
@@ -523,99 +2619,333 @@ if __name__ == "__main__":
             force_tk = True
         elif arg == "--no-boehm":
             disabled.append("boehm")
+        elif arg == "--bdwgc":
+            disabled.append("boehm")
+            disabled.remove("bdwgc")
+            disabled.remove("libatomic_ops")
+        elif arg == "--zlib-ng":
+            disabled.append("zlib")
+            disabled.remove("zlib-ng")
+        elif arg == "--build":
+            run_build = True
+        elif arg.startswith("--jobs="):
+            jobs = int(arg[7:])
+        elif arg.startswith("--artifact-cache="):
+            artifact_cache = os.path.abspath(arg[17:])
+        elif arg.startswith("--artifact-cache-size="):
+            artifact_cache_size = int(arg[22:])
+        elif arg.startswith("--remote-cache="):
+            remote_cache = arg[15:]
+        elif arg == "--remote-cache-readonly":
+            remote_push = False
+        elif arg == "--timings":
+            timings = True
+        elif arg == "--report":
+            report = True
+        elif arg.startswith("--install-mode="):
+            install_mode = arg[15:]
+            if install_mode not in ("link", "hardlink", "copy", "cmd"):
+                raise ValueError("Unknown install mode: " + install_mode)
+        elif arg.startswith("--install="):
+            install_plan = arg[10:]
+        elif arg == "--pack-tcltk":
+            pack = os.path.abspath(os.path.join("lib", "tcltk8.6.zip"))
+        elif arg.startswith("--pack-tcltk="):
+            pack = os.path.abspath(arg[13:])
+        elif arg == "--verify-pack":
+            verify_pack = os.path.abspath(os.path.join("lib", "tcltk8.6.zip"))
+        elif arg.startswith("--verify-pack="):
+            verify_pack = os.path.abspath(arg[14:])
+        elif arg.startswith("--release="):
+            release = arg[10:]
+        elif arg.startswith("--release-base="):
+            release_base = os.path.abspath(arg[15:])
+        elif arg.startswith("--apply-release="):
+            apply_bundle = os.path.abspath(arg[16:])
+        elif arg == "--pch":
+            pch_dir = os.path.abspath("pch")
+        elif arg.startswith("--pch="):
+            pch_dir = os.path.abspath(arg[6:])
+        elif arg.startswith("--deps="):
+            deps_file = os.path.abspath(arg[7:])
+        elif arg == "--check":
+            check = True
+        elif arg == "--clean":
+            clean = True
+        elif arg.startswith("--fetch-jobs="):
+            fetch_jobs = int(arg[13:])
+        elif arg.startswith("--mirror="):
+            mirror = arg[9:]
+            mirrors.append(mirror if "://" in mirror else os.path.abspath(mirror))
+        elif arg.startswith("--prefetch="):
+            prefetch = os.path.abspath(arg[11:])
+        elif arg == "--pin":
+            pin = True
+        elif arg == "--plan":
+            plan = "text"
+        elif arg == "--plan=json":
+            plan = "json"
+        elif arg.startswith("--option="):
+            # --option=sqlite3.variant=pgo
+            key, value = arg[9:].split("=", 1)
+            dep_name, option = key.rsplit(".", 1)
+            dep_options.setdefault(dep_name, {})[option] = value
         else:
-            raise ValueError("Unknown parameter: " + arg)
+            raise ValueError("Unknown parameter: %s, see README.rst for the options" % arg)
+
+    plan_output = sys.stdout
+    if plan == "json":
+        # only the plan goes to stdout
+        sys.stdout = sys.stderr
+
+    # everything that selects what gets built, compared by --check
+    options = {
+        "architecture": architecture,
+        "build_dir": build_dir,
+        "disabled": sorted(disabled),
+        "force_tk": force_tk,
+        "install_mode": install_mode,
+        "timings": timings,
+        "options": dep_options,
+    }
+    state_file = os.path.join(build_dir, "state.json")
+    if check:
+        reasons = check_state(state_file, deps_file, options)
+        for reason in reasons:
+            print(reason)
+        if reasons:
+            sys.exit(1)
+        print("Nothing to do")
+        sys.exit(0)
+
+    if install_plan is not None:
+        import json
+
+        # run from a build script, after the build
+        with open(install_plan, "r") as f:
+            plan = json.load(f)
+        deps = {plan["name"]: plan["dep"]}
+        install_dep(plan["name"], plan["prefs"], plan["mode"])
+        sys.exit(0)
+
+    if pack is not None or verify_pack is not None:
+        if pack is not None:
+            n = pack_library(os.path.abspath("lib"), pack)
+            print("Packed %d files of %s into %s" % (n, ", ".join(tcltk_library), pack))
+        if verify_pack is not None:
+            problems = verify_library(os.path.abspath("lib"), verify_pack)
+            for problem in problems:
+                print(problem)
+            if problems:
+                sys.exit(1)
+            print("%s matches the loose files" % verify_pack)
+        sys.exit(0)
+
+    if release is not None:
+        base = None
+        output = "release-%s.tar.xz" % release
+        if release_base is not None:
+            base = read_release_manifest(release_base)
+            output = "release-%s-from-%s.tar.xz" % (release, base["version"])
+        manifest = write_release(os.getcwd(), os.path.abspath(output), release, base)
+        print("Packed %d of %d files of %s into %s (%s)" % (
+            len(manifest["carried"]), len(manifest["files"]), ", ".join(release_dirs), output, manifest["id"]
+        ))
+        sys.exit(0)
+
+    if apply_bundle is not None:
+        written, removed = apply_release(apply_bundle, os.getcwd())
+        print("Applied %s: %d files written, %d removed" % (os.path.basename(apply_bundle), written, removed))
+        sys.exit(0)
+
+    if pch_dir is not None:
+        names = write_pch(os.path.abspath("include"), pch_dir)
+        print("Wrote precompiled header stubs of %s and the header index to %s" % (", ".join(names), pch_dir))
+        sys.exit(0)
+
+    architecture_list = architecture.split(",")
+    matrix = len(architecture_list) > 1
+    root_build_dir = build_dir
+
+    if report:
+        load_deps(deps_file, dep_options)
+        for architecture in architecture_list:
+            if matrix:
+                print(architecture + ":")
+                build_dir = os.path.join(root_build_dir, architecture)
+            print_timing_report(timing_report(os.path.join(build_dir, "timings")))
+        sys.exit(0)
+
+    load_deps(deps_file, dep_options)
 
     # dependency cache directory
-    os.makedirs(depends_dir, exist_ok=True)
+    if plan is None:
+        os.makedirs(depends_dir, exist_ok=True)
     print("Caching dependencies in:", depends_dir)
 
-    arch_prefs = architectures[architecture]
-    print("Target Architecture:", architecture)
+    if prefetch is not None:
+        # every archive, whatever the options, so the bundle serves any run
+        n = write_bundle(sorted(deps), prefetch, fetch_jobs)
+        print("Packed %d archives into %s" % (n, prefetch))
+        sys.exit(0)
 
-    msvs = find_msvs2015()
+    if pin:
+        pinned = pin_deps(deps_file, sorted(deps), fetch_jobs)
+        print("Pinned %d archives in %s" % (len(pinned), deps_file))
+        sys.exit(0)
+
+    print("Target Architecture:", ", ".join(architecture_list))
+
+    # a plan can be made elsewhere, e.g. by a scheduler
+    msvs = find_msvs2015() if os.name == "nt" else None
     if msvs is None:
-        msvs = find_msvs()
-        if not force_tk:
+        msvs = find_msvs() if os.name == "nt" else None
+        if msvs is not None and not force_tk:
             # see warning below
             disabled.extend(["tcl", "tk"])
-    if msvs is None:
+    if msvs is None and plan is None:
         raise RuntimeError(
             "Visual Studio not found. Please install Visual Studio 2015 or newer."
         )
-    print("Found Visual Studio at:", msvs["vs_dir"])
+    if msvs is not None:
+        print("Found Visual Studio at:", msvs["vs_dir"])
+    nasm_dir = find_nasm()
 
     print("Using output directory:", build_dir)
 
-    # build directory for *.h files
-    inc_dir = os.path.abspath("include")
-    # build directory for *.lib files
-    lib_dir = os.path.abspath("lib")
-    # build directory for *.bin files
-    bin_dir = os.path.abspath("bin")
-    # build directory for auxiliary include files (win32.mak)
-    aux_dir = os.path.join(build_dir, "auxiliary")
-
-    tcltk_dir = os.path.join(build_dir, "tcltk")
-
-    def rmtree_onerror(fn, path, excinfo):
-        if excinfo[0] is PermissionError and excinfo[1].winerror == 5:
-            os.chmod(path, stat.S_IWRITE)
-            fn(path)
+    if plan is not None:
+        import json
+
+        plans = []
+        try:
+            with open(state_file, "r") as f:
+                built = json.load(f)["fingerprints"]
+        except (OSError, ValueError, KeyError):
+            built = {}
+        requested = list(disabled)
+        for architecture in architecture_list:
+            if matrix:
+                build_dir = os.path.join(root_build_dir, architecture)
+            prefs = {"architecture": architecture, **architectures[architecture]}
+            if msvs is not None:
+                prefs.update(msvs, header=sum([header, msvs["header"], ["@echo on"]], []))
+            else:
+                # plan for the compiler of the last run
+                for entry in load_manifest()["deps"].values():
+                    prefs.update(entry["inputs"]["msvs"])
+                    break
+                else:
+                    prefs.update(vs_dir=None, nmake=None, header=None)
+                # and whether that compiler built Tcl/Tk
+                disabled = requested + [
+                    name for name in ("tcl", "tk")
+                    if not force_tk and build_dir in built and name not in built[build_dir]
+                    and name not in requested
+                ]
+            plans.append(plan_builds(artifact_cache, jobs))
+        if plan == "json":
+            json.dump({"plans": plans}, plan_output, indent=2, sort_keys=True)
+            plan_output.write("\n")
         else:
-            raise
+            for arch_plan in plans:
+                print()
+                print_plan(arch_plan)
+        sys.exit(0)
 
-    if os.path.isdir(build_dir):
+    if clean and os.path.isdir(build_dir):
         shutil.rmtree(build_dir, onerror=rmtree_onerror)
-    for path in [build_dir, inc_dir, lib_dir, bin_dir, aux_dir, tcltk_dir]:
-        if not os.path.exists(path):
-            os.makedirs(path)
-
-    prefs = {
-        # Target architecture
-        "architecture": architecture,
-        **arch_prefs,
-        # Build paths
-        "winbuild_dir": winbuild_dir,
-        "build_dir": build_dir,
-        "inc_dir": inc_dir,
-        "lib_dir": lib_dir,
-        "bin_dir": bin_dir,
-        "aux_dir": aux_dir,
-        "tcltk_dir": tcltk_dir,
-        # Compilers / Tools
-        **msvs,
-        # script header
-        "header": sum([header, msvs["header"], ["@echo on"]], []),
-    }
+    if matrix:
+        # extract every archive once, the per-architecture trees link to it
+        source_cache_dir = os.path.join(root_build_dir, "src")
+
+    prepared = []
+    for architecture in architecture_list:
+        arch_prefs = architectures[architecture]
+        if matrix:
+            # separate build and output trees for each architecture
+            build_dir = os.path.join(root_build_dir, architecture)
+            out_dir = os.path.abspath(architecture)
+            print()
+            print("Preparing", architecture)
+        else:
+            out_dir = os.path.abspath(".")
+
+        # build directory for *.h files
+        inc_dir = os.path.join(out_dir, "include")
+        # build directory for *.lib files
+        lib_dir = os.path.join(out_dir, "lib")
+        # build directory for *.bin files
+        bin_dir = os.path.join(out_dir, "bin")
+        # build directory for auxiliary include files (win32.mak)
+        aux_dir = os.path.join(build_dir, "auxiliary")
+
+        tcltk_dir = os.path.join(build_dir, "tcltk")
+
+        for path in [build_dir, inc_dir, lib_dir, bin_dir, aux_dir, tcltk_dir]:
+            if not os.path.exists(path):
+                os.makedirs(path)
+        if timings:
+            timings_dir = os.path.join(build_dir, "timings")
+
+        prefs = {
+            # Target architecture
+            "architecture": architecture,
+            **arch_prefs,
+            # Build paths
+            "winbuild_dir": winbuild_dir,
+            "build_dir": build_dir,
+            "inc_dir": inc_dir,
+            "lib_dir": lib_dir,
+            "bin_dir": bin_dir,
+            "aux_dir": aux_dir,
+            "tcltk_dir": tcltk_dir,
+            # Compilers / Tools
+            "python": sys.executable,
+            "nasm_dir": nasm_dir or "",
+            **msvs,
+            # script header
+            "header": sum([header, msvs["header"], ["@echo on"]], []),
+        }
 
-    print()
-    write_script(
-        ".gitignore",
-        [
-            "/*",
-            "!/bin",
-            "!/bin/*.dll",
-            "!/lib",
-            "!/lib/*.lib",
-            "!/include",
-        ],
-    )
+        print()
+        write_script(
+            ".gitignore",
+            [
+                "/*",
+                "!/bin",
+                "!/bin/*.dll",
+                "!/lib",
+                "!/lib/*.lib",
+                "!/include",
+            ],
+        )
 
-    build_dep()
+        scripts = build_all(fetch_jobs)
+        manifest = load_manifest()
+        fingerprints = {
+            name: manifest["deps"][name]["fingerprint"] for name in deps if name not in disabled
+        }
+        prepared.append((architecture, prefs, scripts, fingerprints))
 
-    if "boehm" not in disabled:
-        print()
-        xp_sdk = copy_win32mak()
-        if xp_sdk is None:
-            print("!!! ntwin32.mak or win32.mak not found, required by Boehm GC.")
-            print("!!! Install Windows XP support in VS2015 or older and rerun %s, "
-                  "or copy win32.mak and ntwin32.mak to '%s' before running build_all.cmd."
-                  % (os.path.basename(__file__), aux_dir))
-            print("!!! You can skip Boehm GC compilation by running '%s --no-boehm'."
-                  % os.path.basename(__file__))
-        else:
-            print("Copied ntwin32.mak and win32.mak from Windows SDK %s" % xp_sdk)
+        if "boehm" not in disabled:
+            print()
+            xp_sdk = copy_win32mak()
+            if xp_sdk is None:
+                print("!!! ntwin32.mak or win32.mak not found, required by Boehm GC.")
+                print("!!! Install Windows XP support in VS2015 or older and rerun %s, "
+                      "or copy win32.mak and ntwin32.mak to '%s' before running build_all.cmd."
+                      % (os.path.basename(__file__), aux_dir))
+                print("!!! You can skip Boehm GC compilation by running '%s --no-boehm'."
+                      % os.path.basename(__file__))
+            else:
+                print("Copied ntwin32.mak and win32.mak from Windows SDK %s" % xp_sdk)
+
+    save_state(
+        state_file,
+        deps_file,
+        options,
+        {prefs["build_dir"]: fingerprints for architecture, prefs, scripts, fingerprints in prepared},
+    )
 
     if "tk" in disabled:
         print()
@@ -627,7 +2957,66 @@ if __name__ == "__main__":
               "by replacing 'call \"{}\" {{vcvars_arch}}' with 'call \"{}\" {{vcvars_arch}} <sdk_version>'."
               % os.path.basename(__file__))
 
+    cmake_deps = [name for name in ("bdwgc", "zlib-ng", "lzma") if name not in disabled]
+    if cmake_deps:
+        vs_cmake = os.path.join(
+            msvs["vs_dir"], "Common7", "IDE", "CommonExtensions", "Microsoft", "CMake", "CMake", "bin", "cmake.exe"
+        )
+        if shutil.which("cmake") is None and not os.path.isfile(vs_cmake):
+            print()
+            print("!!! cmake.exe not found in PATH or Visual Studio, which is needed for %s. "
+                  "Install the 'C++ CMake tools for Windows' component." % " and ".join(cmake_deps))
+
     if "openssl" not in disabled:
         if shutil.which("perl") is None:
             print()
             print("!!! perl.exe not found in PATH, compiling OpenSSL might fail.")
+        if nasm_dir is None:
+            print()
+            print("!!! nasm.exe not found in PATH or in the default NASM install locations, "
+                  "OpenSSL needs it for its assembly. Install it from https://www.nasm.us/")
+
+    if run_build:
+        print()
+        # in matrix mode, the builds of all architectures are scheduled
+        # together as "arch:name"
+        tasks = {}
+        requires = {}
+        runners = {}
+        cache = None
+        if remote_cache is not None and artifact_cache is None:
+            # the remote entries are pulled into a local cache
+            artifact_cache = os.path.join(root_build_dir, "artifacts")
+        if artifact_cache is not None:
+            cache = ArtifactCache(artifact_cache, artifact_cache_size << 20)
+        if remote_cache is not None:
+            cache = RemoteCache(
+                remote_cache, cache, remote_push, os.environ.get("BUILD_CACHE_TOKEN")
+            )
+            cache.probe(
+                [fingerprints[name] for architecture, prefs, scripts, fingerprints in prepared
+                 for name in scripts],
+                fetch_jobs,
+            )
+        for architecture, prefs, scripts, fingerprints in prepared:
+            prefix = architecture + ":" if matrix else ""
+            arch_requires = {name: deps[name].get("requires", []) for name in scripts}
+            run = run_build_script
+            if cache is not None:
+                restorable = restorable_deps(scripts, arch_requires, cache, fingerprints)
+                if remote_cache is not None:
+                    # download everything up front, while nothing is building
+                    cache.pull_all([fingerprints[name] for name in restorable], fetch_jobs)
+                run = cached_build_script(cache, restorable, fingerprints, prefs)
+            for name, script in scripts.items():
+                tasks[prefix + name] = os.path.join(prefs["build_dir"], script)
+                requires[prefix + name] = [prefix + req for req in arch_requires[name]]
+                runners[prefix + name] = (run, name)
+
+        def run_task(task, script):
+            run, name = runners[task]
+            return run(name, script)
+
+        status = schedule_builds(tasks, requires, jobs, run_task)
+        if any(result != "ok" for result in status.values()):
+            sys.exit(1)
@@ -0,0 +1,176 @@
+r"""
+Reference server for the remote artifact cache of build_prepare.py
+(--remote-cache=URL). Run as
+python3 cache_server.py --root=DIR [--host=127.0.0.1] [--port=8765]
+    [--max-size=MB] [--token=TOKEN]
+
+Entries are stored like a local --artifact-cache, as DIR\<fp[:2]>\<fp>.zip:
+GET and HEAD return an entry with its SHA-256 as ETag, PUT stores one,
+checking the X-Content-SHA256 header. The SHA-256 is computed while the
+entry is received and kept next to it in <fp>.zip.sha256. With --token, requests must send
+"Authorization: Bearer TOKEN". The least recently used entries are evicted
+beyond --max-size (default 10240 MB).
+"""
+
+import hashlib
+import http.server
+import os
+import re
+import socketserver
+import sys
+import threading
+
+from build_prepare import ArtifactCache
+
+entry_path = re.compile(r"^/([0-9a-f]{2})/([0-9a-f]{64})\.zip$")
+
+
+def write_digest(path, digest):
+    """Record the SHA-256 of the entry at path next to it."""
+    tmp = "%s.sha256.%d.tmp" % (path, threading.get_ident())
+    with open(tmp, "w") as f:
+        f.write(digest)
+    os.replace(tmp, path + ".sha256")
+
+
+class CacheHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    cache = None
+    token = None
+
+    def log_message(self, format, *args):
+        sys.stderr.write("%s %s\n" % (self.address_string(), format % args))
+
+    def entry(self):
+        """The fingerprint requested, or None after sending an error."""
+        if self.token is not None and self.headers.get("Authorization") != "Bearer " + self.token:
+            self.send_error(401)
+            return None
+        match = entry_path.match(self.path)
+        if match is None or not match.group(2).startswith(match.group(1)):
+            self.send_error(404)
+            return None
+        return match.group(2)
+
+    def digest(self, path, f):
+        """The SHA-256 of the open entry f, as recorded when it was stored.
+        Entries copied into the directory by other means are hashed once."""
+        try:
+            with open(path + ".sha256", "r") as sidecar:
+                return sidecar.read().strip()
+        except OSError:
+            pass
+        digest = hashlib.sha256()
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+        f.seek(0)
+        write_digest(path, digest.hexdigest())
+        return digest.hexdigest()
+
+    def send_entry(self, body):
+        fingerprint = self.entry()
+        if fingerprint is None:
+            return
+        path = self.cache.path(fingerprint)
+        try:
+            f = open(path, "rb")
+        except OSError:
+            self.send_error(404)
+            return
+        with f:
+            digest = self.digest(path, f)
+            self.send_response(200)
+            self.send_header("Content-Type", "application/zip")
+            self.send_header("Content-Length", str(os.fstat(f.fileno()).st_size))
+            self.send_header("ETag", '"%s"' % digest)
+            self.end_headers()
+            if body:
+                for chunk in iter(lambda: f.read(1 << 20), b""):
+                    self.wfile.write(chunk)
+        # mark as recently used
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+    def do_GET(self):
+        self.send_entry(True)
+
+    def do_HEAD(self):
+        self.send_entry(False)
+
+    def do_PUT(self):
+        fingerprint = self.entry()
+        if fingerprint is None:
+            return
+        try:
+            length = int(self.headers["Content-Length"])
+        except (TypeError, ValueError):
+            self.send_error(411)
+            return
+        path = self.cache.path(fingerprint)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = "%s.%d.tmp" % (path, threading.get_ident())
+        digest = hashlib.sha256()
+        with open(tmp, "wb") as f:
+            while length:
+                chunk = self.rfile.read(min(length, 1 << 20))
+                if not chunk:
+                    break
+                digest.update(chunk)
+                f.write(chunk)
+                length -= len(chunk)
+        expected = self.headers.get("X-Content-SHA256")
+        if length or (expected and expected != digest.hexdigest()):
+            os.remove(tmp)
+            self.send_error(400, "Incomplete upload or sha256 mismatch")
+            return
+        # the digest first, an entry is never served without it
+        write_digest(path, digest.hexdigest())
+        os.replace(tmp, path)
+        self.cache.evict()
+        self.send_response(201)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+
+class CacheServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+def serve(root, host="127.0.0.1", port=8765, max_size=10240 << 20, token=None):
+    """Create the server, call serve_forever() on it to run it."""
+    handler = type(
+        "Handler", (CacheHandler,), {"cache": ArtifactCache(root, max_size), "token": token}
+    )
+    return CacheServer((host, port), handler)
+
+
+if __name__ == "__main__":
+    root = None
+    host = "127.0.0.1"
+    port = 8765
+    max_size = 10240
+    token = None
+    for arg in sys.argv[1:]:
+        if arg.startswith("--root="):
+            root = os.path.abspath(arg[7:])
+        elif arg.startswith("--host="):
+            host = arg[7:]
+        elif arg.startswith("--port="):
+            port = int(arg[7:])
+        elif arg.startswith("--max-size="):
+            max_size = int(arg[11:])
+        elif arg.startswith("--token="):
+            token = arg[8:]
+        else:
+            raise ValueError("Unknown parameter: " + arg)
+    if root is None:
+        raise ValueError("--root=DIR is required")
+
+    server = serve(root, host, port, max_size << 20, token)
+    print("Serving the artifact cache in %s on http://%s:%d/" % (root, host, server.server_port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,30 @@
+/* fficonfig.h of libffi for MSVC, copied by the libffi entry of deps.json
+   in place of the one configure generates. libffi.nmake fills the
+   version into ffi.h. */
+
+#define HAVE_ALLOCA 1
+#define HAVE_INTTYPES_H 1
+#define HAVE_MEMCPY 1
+#define HAVE_MEMORY_H 1
+#define HAVE_STDINT_H 1
+#define HAVE_STDLIB_H 1
+#define HAVE_STRING_H 1
+#define HAVE_SYS_STAT_H 1
+#define HAVE_SYS_TYPES_H 1
+#define STDC_HEADERS 1
+
+#define SIZEOF_DOUBLE 8
+#define SIZEOF_LONG_DOUBLE 8
+#ifdef _WIN64
+#define SIZEOF_SIZE_T 8
+#else
+#define SIZEOF_SIZE_T 4
+/* C symbols of 32 bit Windows start with an underscore */
+#define SYMBOL_UNDERSCORE 1
+#endif
+
+#ifdef LIBFFI_ASM
+#define FFI_HIDDEN(name)
+#else
+#define FFI_HIDDEN
+#endif
@@ -0,0 +1,108 @@
+-- Training workload for the pgo variant of sqlite3.nmake, run with
+--     sqlite3_train.exe :memory: < sqlite3_train.sql
+-- It should exercise what the _sqlite3 module does most: small statements
+-- against the schema, inserts and lookups by key, and some sorting,
+-- grouping and the enabled extensions, without taking more than a few
+-- seconds on the instrumented build.
+
+PRAGMA foreign_keys = ON;
+
+CREATE TABLE package (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE,
+    version TEXT,
+    summary TEXT
+);
+CREATE TABLE file (
+    id INTEGER PRIMARY KEY,
+    package INTEGER NOT NULL REFERENCES package(id),
+    path TEXT NOT NULL,
+    size INTEGER,
+    mtime REAL,
+    digest BLOB
+);
+CREATE TABLE meta (key TEXT PRIMARY KEY, value) WITHOUT ROWID;
+
+BEGIN;
+WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n WHERE i < 2000)
+INSERT INTO package (name, version, summary)
+SELECT 'pkg' || i, (i % 7) || '.' || (i % 13) || '.' || (i % 3),
+       'package number ' || i || ' ' || hex(randomblob(8))
+FROM n;
+
+WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n WHERE i < 50000)
+INSERT INTO file (package, path, size, mtime, digest)
+SELECT 1 + i % 2000, 'lib/dir' || (i % 97) || '/file' || i || '.py',
+       (i * 7919) % 100000, 1600000000.0 + i / 3.0, randomblob(16)
+FROM n;
+
+WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n WHERE i < 1000)
+INSERT INTO meta SELECT 'key' || i, json_object('i', i, 'even', i % 2 = 0) FROM n;
+COMMIT;
+
+CREATE INDEX file_package ON file(package);
+CREATE INDEX file_path ON file(path);
+ANALYZE;
+
+-- schema introspection, as done on every connection and cursor
+SELECT name, sql FROM sqlite_master WHERE type = 'table' ORDER BY name;
+PRAGMA table_info(file);
+PRAGMA index_list(file);
+
+-- point lookups
+SELECT count(*) FROM (
+    WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n WHERE i < 20000)
+    SELECT (SELECT version FROM package WHERE id = 1 + n.i % 2000) FROM n
+);
+SELECT count(*) FROM (
+    WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n WHERE i < 20000)
+    SELECT (SELECT size FROM file WHERE path = 'lib/dir' || (n.i % 97) || '/file' || n.i || '.py') FROM n
+);
+
+-- joins, grouping, sorting and string functions
+SELECT p.name, count(f.id), sum(f.size), max(f.mtime)
+FROM package p JOIN file f ON f.package = p.id
+GROUP BY p.id ORDER BY sum(f.size) DESC LIMIT 10;
+SELECT substr(path, 1, instr(path, '/file') - 1) AS dir, count(*), avg(size)
+FROM file GROUP BY dir ORDER BY dir;
+SELECT count(*) FROM file WHERE path LIKE '%dir1_/%' AND size BETWEEN 1000 AND 50000;
+SELECT name FROM package WHERE summary GLOB '*number 1?? *' ORDER BY version, name;
+SELECT version, group_concat(name, ',') FROM package GROUP BY version ORDER BY 1 LIMIT 5;
+SELECT count(DISTINCT hex(digest)) FROM file;
+
+-- window functions and math
+SELECT package, size, rank() OVER (PARTITION BY package ORDER BY size DESC)
+FROM file WHERE package < 50 ORDER BY package, 3 LIMIT 20;
+SELECT round(avg(log(size + 1)), 6), round(sqrt(sum(size)), 3) FROM file;
+
+-- json
+SELECT count(*) FROM meta WHERE json_extract(value, '$.even');
+SELECT sum(j.value) FROM meta, json_each(meta.value) AS j WHERE j.key = 'i';
+
+-- full text search
+CREATE VIRTUAL TABLE summary_fts USING fts5(name, summary);
+INSERT INTO summary_fts SELECT name, summary FROM package;
+SELECT count(*) FROM summary_fts WHERE summary_fts MATCH 'number AND 12*';
+CREATE VIRTUAL TABLE summary_fts4 USING fts4(name, summary);
+INSERT INTO summary_fts4 SELECT name, summary FROM package;
+SELECT count(*) FROM summary_fts4 WHERE summary_fts4 MATCH 'package';
+
+-- r-tree
+CREATE VIRTUAL TABLE box USING rtree(id, x0, x1, y0, y1);
+WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n WHERE i < 5000)
+INSERT INTO box SELECT i, i % 100, i % 100 + 5, i / 50, i / 50 + 5 FROM n;
+SELECT count(*) FROM box WHERE x0 < 50 AND x1 > 40 AND y0 < 30 AND y1 > 20;
+
+-- updates and deletes in savepoints
+BEGIN;
+UPDATE file SET size = size + 1 WHERE package % 10 = 0;
+SAVEPOINT sp;
+DELETE FROM file WHERE package % 10 = 1;
+ROLLBACK TO sp;
+DELETE FROM file WHERE package % 10 = 2;
+RELEASE sp;
+INSERT OR REPLACE INTO meta VALUES ('key1', json_object('i', -1));
+COMMIT;
+
+SELECT count(*), sum(size) FROM file;
+VACUUM;